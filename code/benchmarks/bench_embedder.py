@@ -0,0 +1,39 @@
+"""Micro-benchmark of the Fourier embedders.
+
+    cd code
+    python benchmarks/bench_embedder.py --device cpu
+"""
+import os
+import sys
+import argparse
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from lib.model.embedders import get_embedder
+from common import timeit
+
+
+def main(args):
+    torch.manual_seed(0)
+    # foreground (3D, multires 6) and background (4D, multires 10) configurations
+    for input_dims, multires in [(3, 6), (4, 10)]:
+        x = torch.randn(args.num_points, input_dims, device=args.device)
+        embed_loop, out_dim = get_embedder(multires, input_dims=input_dims, mode='fourier_loop')
+        embed_vec, _ = get_embedder(multires, input_dims=input_dims, mode='fourier')
+        assert torch.equal(embed_loop(x), embed_vec(x))
+
+        t_loop = timeit(embed_loop, x, args.device, args.num_iters)
+        t_vec = timeit(embed_vec, x, args.device, args.num_iters)
+        print(f'd_in={input_dims} multires={multires} out_dim={out_dim}: '
+              f'loop {args.num_points / t_loop / 1e6:.1f} Mpts/s, '
+              f'vectorized {args.num_points / t_vec / 1e6:.1f} Mpts/s, '
+              f'speedup {t_loop / t_vec:.2f}x')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Embedder micro-benchmark")
+    parser.add_argument('--device', type=str, default='cpu', help="cpu or cuda")
+    parser.add_argument('--num_points', type=int, default=512 * 98)
+    parser.add_argument('--num_iters', type=int, default=20)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,311 @@
+"""Micro-benchmarks of the rendering hot path on synthetic inputs.
+
+The networks have random weights and the SMPL model is replaced by a stand-in template,
+so neither data nor the licensed SMPL files are needed. Each case runs in its own process,
+its peak memory is the peak reached while running it above the memory after its setup.
+Forward passes are timed without autograd.
+
+    cd code
+    python benchmarks/bench_suite.py --device cpu --save_baseline benchmarks/baseline.json
+    python benchmarks/bench_suite.py --device cpu --baseline benchmarks/baseline.json
+"""
+import os
+import sys
+import json
+import argparse
+import multiprocessing
+import numpy as np
+import torch
+import torch.nn as nn
+from omegaconf import OmegaConf
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from lib.model.embedders import get_embedder
+from lib.model.networks import ImplicitNet, RenderingNet
+from lib.model.density import LaplaceDensity, AbsDensity
+from lib.model.ray_sampler import ErrorBoundSampler
+from lib.model.deformer import SMPLDeformer, skinning
+from lib.model.v2a import V2A
+from lib.utils import utils
+from lib.utils.meshing import generate_mesh
+from common import timeit, get_peak_memory
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'confs', 'model', 'model_w_bg.yaml')
+NUM_JOINTS = 24
+
+
+def get_template(device, num_verts=6890):
+    """Stand-in for the canonical SMPL template: vertices on an ellipsoid of the size of a body and
+    skinning weights decaying with the distance to 24 joints along its vertical axis."""
+    verts = torch.randn(num_verts, 3, device=device)
+    verts = verts / verts.norm(dim=-1, keepdim=True) * torch.tensor([0.25, 0.85, 0.15], device=device)
+    joints = torch.zeros(NUM_JOINTS, 3, device=device)
+    joints[:, 1] = torch.linspace(-0.85, 0.85, NUM_JOINTS, device=device)
+    weights = torch.softmax(-torch.cdist(verts, joints) ** 2 / 0.02, dim=-1)
+    return verts[None], weights[None]
+
+
+def get_bone_transforms(device, max_angle=0.3):
+    """Random rotations about the joints of the template. shape: [1, J, 4, 4]"""
+    axis_angle = (torch.rand(NUM_JOINTS, 3, device=device) * 2 - 1) * max_angle
+    angle = axis_angle.norm(dim=-1, keepdim=True)[..., None]
+    k = torch.zeros(NUM_JOINTS, 3, 3, device=device)
+    axis = axis_angle / angle[..., 0]
+    k[:, 0, 1], k[:, 0, 2], k[:, 1, 2] = -axis[:, 2], axis[:, 1], -axis[:, 0]
+    k = k - k.transpose(1, 2)
+    rot = torch.eye(3, device=device) + torch.sin(angle) * k + (1 - torch.cos(angle)) * k @ k
+    tfs = torch.eye(4, device=device).repeat(NUM_JOINTS, 1, 1)
+    tfs[:, :3, :3] = rot
+    return tfs[None]
+
+
+def get_deformer(opt, device):
+    """SMPLDeformer on the stand-in template, bypassing the SMPL model its constructor loads."""
+    deformer = SMPLDeformer.__new__(SMPLDeformer)
+    deformer.max_dist = 0.1
+    deformer.K = 1
+    deformer.smpl_verts, deformer.smpl_weights = get_template(device)
+    deformer.use_grid = False
+    deformer.grid_cano = None
+    return deformer
+
+
+def get_model(opt, device):
+    """V2A with random networks and the stand-in deformer, bypassing the SMPL and data files its constructor loads."""
+    model = V2A.__new__(V2A)
+    nn.Module.__init__(model)
+    model.implicit_network = ImplicitNet(opt.implicit_network)
+    model.rendering_network = RenderingNet(opt.rendering_network)
+    model.density = LaplaceDensity(**opt.density)
+    model.bg_density = AbsDensity()
+    model.sdf_bounding_sphere = 3.0
+    model.occupancy_grid = None
+    model.ray_sampler = ErrorBoundSampler(model.sdf_bounding_sphere, inverse_sphere_bg=True, **opt.ray_sampler)
+    model.deformer = get_deformer(opt, device)
+    return model.to(device).eval()
+
+
+def get_rays(num_rays, device):
+    """Rays from a camera at distance 2 towards the template."""
+    cam_loc = torch.tensor([0., 0., 2.], device=device).expand(num_rays, 3)
+    target = (torch.rand(num_rays, 3, device=device) * 2 - 1) * torch.tensor([0.4, 1., 0.], device=device)
+    ray_dirs = nn.functional.normalize(target - cam_loc, dim=-1)
+    return ray_dirs, cam_loc
+
+
+def get_num_samples(opt):
+    return opt.ray_sampler.N_samples + opt.ray_sampler.N_samples_extra + 2
+
+
+def bench_embedder(opt, args, mode=None):
+    embed, _ = get_embedder(opt.implicit_network.multires, input_dims=3, mode=mode or opt.implicit_network.embedder_mode)
+    num_points = args.num_rays * get_num_samples(opt)
+    x = torch.randn(num_points, 3, device=args.device)
+    return embed, x, num_points, 'points'
+
+
+def bench_embedder_loop(opt, args):
+    return bench_embedder(opt, args, mode='fourier_loop')
+
+
+def bench_implicit_network(opt, args):
+    network = ImplicitNet(opt.implicit_network).to(args.device)
+    num_points = args.num_rays * get_num_samples(opt)
+    x = torch.randn(num_points, 3, device=args.device) * 0.5
+    cond = {'smpl': torch.zeros(1, 69, device=args.device)}
+    return lambda x: network(x, cond), x, num_points, 'points'
+
+
+def bench_rendering_network(opt, args):
+    network = RenderingNet(opt.rendering_network).to(args.device)
+    num_points = args.num_rays * get_num_samples(opt)
+    points = torch.randn(num_points, 3, device=args.device)
+    normals = nn.functional.normalize(torch.randn(num_points, 3, device=args.device), dim=-1)
+    body_pose = torch.zeros(1, 69, device=args.device)
+    features = torch.randn(num_points, opt.rendering_network.feature_vector_size, device=args.device)
+    return lambda x: network(x, normals, None, body_pose, features), points, num_points, 'points'
+
+
+def bench_deformer_knn(opt, args):
+    deformer = get_deformer(opt, args.device)
+    num_points = args.num_rays * get_num_samples(opt)
+    x = torch.randn(1, num_points, 3, device=args.device) * 0.5
+    return lambda x: deformer.query_skinning_weights_smpl_multi(x, deformer.smpl_verts[0], deformer.smpl_weights), x, num_points, 'points'
+
+
+def bench_skinning(opt, args):
+    num_points = args.num_rays * get_num_samples(opt)
+    x = torch.randn(1, num_points, 3, device=args.device) * 0.5
+    weights = torch.softmax(torch.randn(1, num_points, NUM_JOINTS, device=args.device), dim=-1)
+    tfs = get_bone_transforms(args.device)
+    return lambda x: skinning(x, weights, tfs, inverse=True), x, num_points, 'points'
+
+
+def bench_ray_sampler(opt, args):
+    model = get_model(opt, args.device)
+    ray_dirs, cam_loc = get_rays(args.num_rays, args.device)
+    cond = {'smpl': torch.zeros(1, 69, device=args.device)}
+    smpl_tfs = get_bone_transforms(args.device)
+    smpl_verts = model.deformer.smpl_verts
+    return lambda x: model.ray_sampler.get_z_vals(x, cam_loc, model, cond, smpl_tfs, eval_mode=True, smpl_verts=smpl_verts), \
+        ray_dirs, args.num_rays, 'rays'
+
+
+def bench_beta_line_search(opt, args):
+    model = get_model(opt, args.device)
+    sampler = model.ray_sampler
+    # as many samples per ray as after the last upsampling round, crossing the surface at depth 2
+    num_samples = opt.ray_sampler.N_samples_eval * opt.ray_sampler.max_total_iters
+    z_vals = torch.sort(torch.rand(args.num_rays, num_samples, device=args.device) * 4, dim=-1)[0]
+    sdf = 2 - z_vals
+    dists = z_vals[:, 1:] - z_vals[:, :-1]
+    d_star = torch.minimum(sdf[:, :-1].abs(), sdf[:, 1:].abs())
+    beta0 = model.density.get_beta().detach()
+    beta_max = torch.sqrt((dists ** 2.).sum(-1) / (4 * np.log(1 + sampler.eps)))
+    return lambda x: sampler.beta_line_search(beta0, x, model, sdf, dists, d_star), beta_max, args.num_rays, 'rays'
+
+
+def bench_volume_rendering(opt, args):
+    model = get_model(opt, args.device)
+    num_samples = get_num_samples(opt)
+    z_vals = torch.sort(torch.rand(args.num_rays, num_samples, device=args.device) * 4, dim=-1)[0]
+    z_max = torch.full((args.num_rays,), 4., device=args.device)
+    sdf = (2 - z_vals).reshape(-1, 1)
+    return lambda x: model.volume_rendering(x, z_max, sdf), z_vals, args.num_rays, 'rays'
+
+
+def bench_depth2pts_outside(opt, args):
+    model = get_model(opt, args.device)
+    num_samples = opt.ray_sampler.N_samples_inverse_sphere
+    ray_dirs, cam_loc = get_rays(args.num_rays, args.device)
+    ray_d = ray_dirs.unsqueeze(1).repeat(1, num_samples, 1)
+    ray_o = cam_loc.unsqueeze(1).repeat(1, num_samples, 1)
+    depth = torch.linspace(0., 1., num_samples, device=args.device).expand(args.num_rays, num_samples)
+    return lambda x: model.depth2pts_outside(ray_o, ray_d, x), depth, args.num_rays * num_samples, 'points'
+
+
+def bench_weighted_sampling(opt, args):
+    height, width = 540, 960
+    object_mask = np.zeros((height, width), dtype=bool)
+    object_mask[100:500, 350:600] = True
+    uv = np.stack(np.meshgrid(np.arange(width), np.arange(height)), axis=-1).astype(np.float32)
+    data = {'rgb': np.random.rand(height, width, 3).astype(np.float32), 'uv': uv, 'object_mask': object_mask}
+    return lambda x: utils.weighted_sampling(x, (height, width), args.num_rays), data, args.num_rays, 'rays'
+
+
+def bench_generate_mesh(opt, args):
+    network = ImplicitNet(opt.implicit_network).to(args.device)
+    cond = {'smpl': torch.zeros(1, 69, device=args.device)}
+    verts, _ = get_template(args.device)
+    func = lambda x: {'sdf': network(x, cond)[:, :, 0].reshape(-1, 1)}
+    return lambda x: generate_mesh(func, x, point_batch=10000, res_up=2, sparse=opt.sparse_marching_cubes), verts[0], 1, 'meshes'
+
+
+CASES = {
+    'embedder': bench_embedder,
+    'embedder_loop': bench_embedder_loop,
+    'implicit_network': bench_implicit_network,
+    'rendering_network': bench_rendering_network,
+    'deformer_knn': bench_deformer_knn,
+    'skinning': bench_skinning,
+    'ray_sampler': bench_ray_sampler,
+    'beta_line_search': bench_beta_line_search,
+    'volume_rendering': bench_volume_rendering,
+    'depth2pts_outside': bench_depth2pts_outside,
+    'weighted_sampling': bench_weighted_sampling,
+    'generate_mesh': bench_generate_mesh,
+}
+
+
+def run_case(name, args, queue):
+    torch.manual_seed(0)
+    np.random.seed(0)
+    torch.set_grad_enabled(False)
+    torch.set_num_threads(args.num_threads)
+    opt = OmegaConf.load(CONFIG_PATH)
+    fn, x, num_items, unit = CASES[name](opt, args)
+    if args.device == 'cuda':
+        torch.cuda.reset_peak_memory_stats()
+        memory_before = torch.cuda.memory_allocated() / 2 ** 20
+    else:
+        memory_before = get_peak_memory(args.device)
+    time = timeit(fn, x, args.device, args.num_iters)
+    queue.put({
+        'time_ms': 1000 * time,
+        f'{unit}_per_s': num_items / time,
+        'peak_memory_mb': max(get_peak_memory(args.device) - memory_before, 0.),
+    })
+
+
+def compare(results, baseline, tolerance, names=None):
+    """Cases slower or using more memory than the baseline by more than tolerance, and baseline cases
+    without a result. names restricts the baseline cases expected to have run."""
+    regressions = [f'{name} missing from the results' for name in baseline
+                   if name not in results and (names is None or name in names)]
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for key, value in result.items():
+            reference = baseline[name].get(key)
+            if reference is None or key == 'time_ms':
+                continue
+            if key.endswith('_per_s'):
+                regressed = value < reference * (1 - tolerance)
+            else:
+                # memory is too noisy to compare below a MB
+                regressed = value > reference * (1 + tolerance) + 1.
+            if regressed:
+                regressions.append(f'{name} {key}: {value:.4g} vs baseline {reference:.4g}')
+    return regressions
+
+
+def main(args):
+    ctx = multiprocessing.get_context('spawn')
+    names = args.cases if args.cases else list(CASES)
+    results = {}
+    failures = []
+    for name in names:
+        queue = ctx.Queue()
+        process = ctx.Process(target=run_case, args=(name, args, queue))
+        process.start()
+        process.join()
+        if process.exitcode != 0:
+            print(f'{name:>20}: failed with exit code {process.exitcode}')
+            failures.append(name)
+            continue
+        results[name] = queue.get()
+        throughput = ', '.join(f'{v:.4g} {k.replace("_per_s", "/s")}' for k, v in results[name].items() if k.endswith('_per_s'))
+        print(f'{name:>20}: {results[name]["time_ms"]:9.2f} ms, {throughput}, peak memory {results[name]["peak_memory_mb"]:.1f} MB')
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump({'device': args.device, 'num_rays': args.num_rays, 'results': results, 'failures': failures}, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        assert baseline['device'] == args.device and baseline['num_rays'] == args.num_rays, \
+            'the baseline was recorded with other settings'
+        regressions = compare(results, baseline['results'], args.tolerance, args.cases)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        if regressions:
+            sys.exit(1)
+
+    if failures:
+        print(f'FAILED {", ".join(failures)}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Rendering hot path micro-benchmarks")
+    parser.add_argument('--device', type=str, default='cpu', help="cpu or cuda")
+    parser.add_argument('--cases', type=str, nargs='*', choices=list(CASES), help="cases to run, all by default")
+    parser.add_argument('--num_rays', type=int, default=512)
+    parser.add_argument('--num_iters', type=int, default=5)
+    parser.add_argument('--num_threads', type=int, default=torch.get_num_threads())
+    parser.add_argument('--baseline', type=str, default=None, help="baseline json to compare against")
+    parser.add_argument('--save_baseline', type=str, default=None, help="save the results as a baseline json")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="relative slowdown or memory increase flagged as regression, cpu timings are noisy")
+    args = parser.parse_args()
+    main(args)
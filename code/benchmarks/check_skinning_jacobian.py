@@ -0,0 +1,63 @@
+"""Numeric check of SMPLDeformer.forward_skinning_jacobian against the autograd Jacobian of forward_skinning,
+for a single frame (frame_idx=None) and for points of several frames. Uses the stand-in template of
+bench_suite, so the SMPL files are not needed. Exits with 1 if the Jacobians differ.
+
+    cd code
+    python benchmarks/check_skinning_jacobian.py --device cpu
+"""
+import os
+import sys
+import argparse
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from bench_suite import get_deformer, get_bone_transforms
+
+
+def autograd_jacobian(deformer, xc, smpl_tfs, frame_idx=None):
+    """Jacobian of forward_skinning w.r.t. xc by autograd, as in V2A.forward_gradient. shape: [1, N, 3, 3]"""
+    xc = xc.clone().requires_grad_(True)
+    x_transformed = deformer.forward_skinning(xc, None, smpl_tfs, frame_idx=frame_idx)
+    grads = []
+    for i in range(3):
+        d_out = torch.zeros_like(x_transformed)
+        d_out[:, :, i] = 1
+        grads.append(torch.autograd.grad(x_transformed, xc, grad_outputs=d_out, retain_graph=True)[0])
+    return torch.stack(grads, dim=-2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the analytic skinning Jacobian with autograd')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--num_points', type=int, default=4096)
+    parser.add_argument('--num_frames', type=int, default=4)
+    parser.add_argument('--tol', type=float, default=1e-5)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    deformer = get_deformer(None, args.device)
+    # points around the template surface, some of them outliers
+    verts = deformer.smpl_verts[0]
+    xc = verts[torch.randint(verts.shape[0], (args.num_points,), device=args.device)]
+    xc = (xc + torch.randn_like(xc) * 0.05)[None]
+
+    cases = {}
+    smpl_tfs = get_bone_transforms(args.device)
+    cases['single_frame'] = (smpl_tfs, None)
+    smpl_tfs = torch.cat([get_bone_transforms(args.device) for _ in range(args.num_frames)], dim=0)
+    frame_idx = torch.randint(args.num_frames, (args.num_points,), device=args.device)
+    cases['multi_frame'] = (smpl_tfs, frame_idx)
+
+    failed = False
+    for name, (smpl_tfs, frame_idx) in cases.items():
+        expected = autograd_jacobian(deformer, xc, smpl_tfs, frame_idx=frame_idx)
+        analytic = deformer.forward_skinning_jacobian(xc, smpl_tfs, frame_idx=frame_idx)
+        error = (analytic - expected).abs().max().item()
+        ok = analytic.shape == expected.shape and error <= args.tol
+        failed = failed or not ok
+        print(f'{name}: max abs error {error:.2e} {"ok" if ok else "FAILED"}')
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,22 @@
+import time
+import resource
+import torch
+
+
+def timeit(fn, x, device, num_iters):
+    fn(x)
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(num_iters):
+        fn(x)
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / num_iters
+
+
+def get_peak_memory(device):
+    """Peak allocated device memory on cuda, peak resident memory of the process on cpu, in MB."""
+    if device == 'cuda':
+        return torch.cuda.max_memory_allocated() / 2 ** 20
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
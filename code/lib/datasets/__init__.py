@@ -1,4 +1,5 @@
 from .dataset import Dataset, ValDataset, TestDataset
+from .pixel_sampler import PixelSampler
 from torch.utils.data import DataLoader
 
 def find_dataset_using_name(name):
@@ -13,7 +14,7 @@ def find_dataset_using_name(name):
     return cls
 
 
-def create_dataset(metainfo, split):
+def create_dataset(metainfo, split, device='cuda'):
     dataset_cls = find_dataset_using_name(split.type)
     dataset = dataset_cls(metainfo, split)
     return DataLoader(
@@ -22,5 +23,6 @@ def create_dataset(metainfo, split):
         drop_last=split.drop_last,
         shuffle=split.shuffle,
         num_workers=split.worker,
-        pin_memory=True
+        pin_memory=(device == 'cuda'),
+        collate_fn=getattr(dataset_cls, 'collate_fn', None)
     )
\ No newline at end of file
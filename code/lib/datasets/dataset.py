@@ -1,10 +1,13 @@
 import os
 import glob
+import warnings
 import hydra
 import cv2
 import numpy as np
 import torch
+from torch.utils.data.dataloader import default_collate
 from lib.utils import utils
+from .frame_cache import FrameCache, pack_frames
 
 
 class Dataset(torch.utils.data.Dataset):
@@ -22,65 +25,131 @@ class Dataset(torch.utils.data.Dataset):
         img_dir = os.path.join(root, "image")
         self.img_paths = sorted(glob.glob(f"{img_dir}/*.png"))
 
-        # only store the image paths to avoid OOM
-        self.img_paths = [self.img_paths[i] for i in self.training_indices]
-        self.img_size = cv2.imread(self.img_paths[0]).shape[:2]
-        self.n_images = len(self.img_paths)
-
         # coarse projected SMPL masks, only for sampling
         mask_dir = os.path.join(root, "mask")
         self.mask_paths = sorted(glob.glob(f"{mask_dir}/*.png"))
+
+        camera_path = os.path.join(root, "cameras_normalize.npz")
+        camera_dict = np.load(camera_path)
+
+        # decoded frames, masks and cameras packed once into a memory-mapped file
+        self.frame_cache = None
+        if split.get('frame_cache', False):
+            cache_dir = os.path.join(root, "frame_cache")
+            if not FrameCache.exists(cache_dir, self.img_paths, self.mask_paths, camera_path):
+                pack_frames(cache_dir, self.img_paths, self.mask_paths, camera_path)
+            self.frame_cache = FrameCache(cache_dir, lru_size=split.get('frame_cache_lru', 0))
+
+        # only store the image paths to avoid OOM
+        self.img_paths = [self.img_paths[i] for i in self.training_indices]
         self.mask_paths = [self.mask_paths[i] for i in self.training_indices]
+        if self.frame_cache is not None:
+            self.img_size = self.frame_cache.img_size
+        else:
+            self.img_size = cv2.imread(self.img_paths[0]).shape[:2]
+        self.n_images = len(self.img_paths)
 
         self.shape = np.load(os.path.join(root, "mean_shape.npy"))
         self.poses = np.load(os.path.join(root, 'poses.npy'))[self.training_indices]
         self.trans = np.load(os.path.join(root, 'normalize_trans.npy'))[self.training_indices]
         # cameras
-        camera_dict = np.load(os.path.join(root, "cameras_normalize.npz"))
-        scale_mats = [camera_dict['scale_mat_%d' % idx].astype(np.float32) for idx in self.training_indices]
-        world_mats = [camera_dict['world_mat_%d' % idx].astype(np.float32) for idx in self.training_indices]
-
-        self.scale = 1 / scale_mats[0][0, 0]
-
-        self.intrinsics_all = []
-        self.pose_all = []
-        for scale_mat, world_mat in zip(scale_mats, world_mats):
-            P = world_mat @ scale_mat
-            P = P[:3, :4]
-            intrinsics, pose = utils.load_K_Rt_from_P(None, P)
-            self.intrinsics_all.append(torch.from_numpy(intrinsics).float())
-            self.pose_all.append(torch.from_numpy(pose).float())
+        if self.frame_cache is not None:
+            self.scale = 1 / self.frame_cache.scale[self.training_indices[0]]
+            self.intrinsics_all = [torch.from_numpy(self.frame_cache.intrinsics[idx]) for idx in self.training_indices]
+            self.pose_all = [torch.from_numpy(self.frame_cache.pose[idx]) for idx in self.training_indices]
+        else:
+            scale_mats = [camera_dict['scale_mat_%d' % idx].astype(np.float32) for idx in self.training_indices]
+            world_mats = [camera_dict['world_mat_%d' % idx].astype(np.float32) for idx in self.training_indices]
+
+            self.scale = 1 / scale_mats[0][0, 0]
+
+            self.intrinsics_all = []
+            self.pose_all = []
+            for scale_mat, world_mat in zip(scale_mats, world_mats):
+                P = world_mat @ scale_mat
+                P = P[:3, :4]
+                intrinsics, pose = utils.load_K_Rt_from_P(None, P)
+                self.intrinsics_all.append(torch.from_numpy(intrinsics).float())
+                self.pose_all.append(torch.from_numpy(pose).float())
         assert len(self.intrinsics_all) == len(self.pose_all)
 
         # other properties
         self.num_sample = split.num_sample
         self.sampling_strategy = "weighted"
+        # pixels are sampled after collation on the target device (see PixelSampler)
+        self.device_sampling = split.get('device_sampling', False)
+        # PixelSampler keeps all RGB frames on the device, fall back to sampling in the workers for long videos
+        frames_mb = self.n_images * self.img_size[0] * self.img_size[1] * 3 / 2 ** 20
+        max_frames_mb = split.get('device_sampling_max_mb', 1024)
+        if self.device_sampling and frames_mb > max_frames_mb:
+            warnings.warn(f'device_sampling disabled: the frames take {frames_mb:.0f} MB, more than device_sampling_max_mb={max_frames_mb}')
+            self.device_sampling = False
 
     def __len__(self):
         return self.n_images
 
+    def load_frames(self):
+        """Decode all RGB frames once and compute the bounding box of each mask.
+        Returns:
+            frames (tensor): RGB frames. shape: [N, H, W, 3], uint8
+            bboxes (tensor): mask bounding boxes (min, max) in (row, col). shape: [N, 2, 2]
+        """
+        if self.frame_cache is not None:
+            frames = torch.from_numpy(self.frame_cache.frames[self.training_indices][..., :3].copy())
+            bboxes = torch.from_numpy(self.frame_cache.bboxes[self.training_indices])
+            return frames, bboxes
+
+        frames, bboxes = [], []
+        for img_path, mask_path in zip(self.img_paths, self.mask_paths):
+            frames.append(cv2.imread(img_path)[:, :, ::-1])
+            mask = cv2.cvtColor(cv2.imread(mask_path), cv2.COLOR_BGR2GRAY) > 0
+            where = np.asarray(np.where(mask))
+            bboxes.append(np.stack([where.min(axis=1), where.max(axis=1)], axis=0))
+        frames = torch.from_numpy(np.stack(frames, axis=0))
+        bboxes = torch.from_numpy(np.stack(bboxes, axis=0)).float()
+        return frames, bboxes
+
+    def get_smpl_params(self, idx):
+        smpl_params = torch.zeros([86]).float()
+        smpl_params[0] = torch.from_numpy(np.asarray(self.scale)).float() 
+
+        smpl_params[1:4] = torch.from_numpy(self.trans[idx]).float()
+        smpl_params[4:76] = torch.from_numpy(self.poses[idx]).float()
+        smpl_params[76:] = torch.from_numpy(self.shape).float()
+        return smpl_params
+
     def __getitem__(self, idx):
-        # normalize RGB
-        img = cv2.imread(self.img_paths[idx])
-        # preprocess: BGR -> RGB -> Normalize
+        if self.num_sample > 0 and self.device_sampling:
+            # pixels and colors are filled in by PixelSampler after collation
+            inputs = {
+                "intrinsics": self.intrinsics_all[idx],
+                "pose": self.pose_all[idx],
+                "smpl_params": self.get_smpl_params(idx),
+                "idx": idx
+            }
+            return inputs, {}
 
-        img = img[:, :, ::-1] / 255
+        if self.frame_cache is not None:
+            frame = self.frame_cache[self.training_indices[idx]]
+            img = frame[:, :, :3] / 255
+            mask = frame[:, :, 3] > 0
+        else:
+            # normalize RGB
+            img = cv2.imread(self.img_paths[idx])
+            # preprocess: BGR -> RGB -> Normalize
 
-        mask = cv2.imread(self.mask_paths[idx])
-        # preprocess: BGR -> Gray -> Mask
-        mask = cv2.cvtColor(mask, cv2.COLOR_BGR2GRAY) > 0
+            img = img[:, :, ::-1] / 255
+
+            mask = cv2.imread(self.mask_paths[idx])
+            # preprocess: BGR -> Gray -> Mask
+            mask = cv2.cvtColor(mask, cv2.COLOR_BGR2GRAY) > 0
 
         img_size = self.img_size
 
         uv = np.mgrid[:img_size[0], :img_size[1]].astype(np.int32)
         uv = np.flip(uv, axis=0).copy().transpose(1, 2, 0).astype(np.float32)
 
-        smpl_params = torch.zeros([86]).float()
-        smpl_params[0] = torch.from_numpy(np.asarray(self.scale)).float() 
-
-        smpl_params[1:4] = torch.from_numpy(self.trans[idx]).float()
-        smpl_params[4:76] = torch.from_numpy(self.poses[idx]).float()
-        smpl_params[76:] = torch.from_numpy(self.shape).float()
+        smpl_params = self.get_smpl_params(idx)
 
         if self.num_sample > 0:
             data = {
@@ -114,6 +183,19 @@ class Dataset(torch.utils.data.Dataset):
             }
             return inputs, images
 
+    @staticmethod
+    def collate_fn(batch):
+        """default_collate, except that index_outside of the frames, whose lengths differ, are offset
+        into the flattened rays of the batch, like the index_outside of PixelSampler."""
+        if 'index_outside' not in batch[0][0]:
+            return default_collate(batch)
+        index_outside = [inputs.pop('index_outside') for inputs, _ in batch]
+        inputs, images = default_collate(batch)
+        num_sample = inputs['uv'].shape[1]
+        index_outside = [index + i * num_sample for i, index in enumerate(index_outside)]
+        inputs['index_outside'] = torch.from_numpy(np.concatenate(index_outside)).unsqueeze(0)
+        return inputs, images
+
 class ValDataset(torch.utils.data.Dataset):
     def __init__(self, metainfo, split):
         self.dataset = Dataset(metainfo, split)
@@ -0,0 +1,107 @@
+import os
+from collections import OrderedDict
+import cv2
+import numpy as np
+from lib.utils import utils
+
+
+def source_stats(paths):
+    """Modification times and sizes of the source files, stored in the index to detect a stale cache."""
+    stats = [os.stat(path) for path in paths]
+    return np.array([[stat.st_mtime_ns, stat.st_size] for stat in stats], dtype=np.int64).reshape(-1, 2)
+
+
+def pack_frames(cache_dir, img_paths, mask_paths, camera_path):
+    """Decode all frames once into a memory-mapped uint8 array of shape [N, H, W, 4]
+    (RGB + mask) and store per-frame mask bounding boxes and cameras in an index,
+    along with the source paths and their stats."""
+    os.makedirs(cache_dir, exist_ok=True)
+    # an interrupted repack must not leave the index of the previous sources
+    index_path = os.path.join(cache_dir, 'index.npz')
+    if os.path.exists(index_path):
+        os.remove(index_path)
+    camera_dict = np.load(camera_path)
+    img_size = cv2.imread(img_paths[0]).shape[:2]
+    num_frames = len(img_paths)
+
+    frames_path = os.path.join(cache_dir, 'frames.npy')
+    frames = np.lib.format.open_memmap(frames_path + '.tmp', mode='w+', dtype=np.uint8, shape=(num_frames, *img_size, 4))
+    bboxes, intrinsics_all, pose_all, scales = [], [], [], []
+    for idx, (img_path, mask_path) in enumerate(zip(img_paths, mask_paths)):
+        # preprocess: BGR -> RGB
+        frames[idx, :, :, :3] = cv2.imread(img_path)[:, :, ::-1]
+        # preprocess: BGR -> Gray
+        mask = cv2.cvtColor(cv2.imread(mask_path), cv2.COLOR_BGR2GRAY)
+        frames[idx, :, :, 3] = mask
+
+        where = np.asarray(np.where(mask > 0))
+        bboxes.append(np.stack([where.min(axis=1), where.max(axis=1)], axis=0))
+
+        scale_mat = camera_dict['scale_mat_%d' % idx].astype(np.float32)
+        world_mat = camera_dict['world_mat_%d' % idx].astype(np.float32)
+        P = world_mat @ scale_mat
+        intrinsics, pose = utils.load_K_Rt_from_P(None, P[:3, :4])
+        intrinsics_all.append(intrinsics)
+        pose_all.append(pose)
+        scales.append(scale_mat[0, 0])
+    frames.flush()
+    del frames
+    os.replace(frames_path + '.tmp', frames_path)
+
+    # the index is written last and marks the cache as complete
+    source_paths = [*img_paths, *mask_paths, camera_path]
+    np.savez(index_path,
+             bboxes=np.stack(bboxes, axis=0).astype(np.float32),
+             intrinsics=np.stack(intrinsics_all, axis=0).astype(np.float32),
+             pose=np.stack(pose_all, axis=0).astype(np.float32),
+             scale=np.array(scales, dtype=np.float32),
+             source_paths=np.array(source_paths, dtype=str),
+             source_stats=source_stats(source_paths))
+
+
+class FrameCache:
+    """Zero-copy access to frames packed by pack_frames, with an optional bounded
+    in-RAM LRU for hot frames."""
+    def __init__(self, cache_dir, lru_size=0):
+        self.frames = np.load(os.path.join(cache_dir, 'frames.npy'), mmap_mode='r')
+        with np.load(os.path.join(cache_dir, 'index.npz')) as index:
+            self.bboxes = index['bboxes']
+            self.intrinsics = index['intrinsics']
+            self.pose = index['pose']
+            self.scale = index['scale']
+
+        self.lru_size = lru_size
+        self.lru = OrderedDict()
+
+    @staticmethod
+    def exists(cache_dir, img_paths, mask_paths, camera_path):
+        """Whether the cache was packed from the same source files, unchanged since."""
+        index_path = os.path.join(cache_dir, 'index.npz')
+        if not os.path.exists(index_path):
+            return False
+        source_paths = [*img_paths, *mask_paths, camera_path]
+        with np.load(index_path) as index:
+            # caches packed before the sources were recorded are rebuilt
+            if 'source_paths' not in index.files or index['source_paths'].tolist() != source_paths:
+                return False
+            return np.array_equal(index['source_stats'], source_stats(source_paths))
+
+    def __len__(self):
+        return self.frames.shape[0]
+
+    @property
+    def img_size(self):
+        return self.frames.shape[1:3]
+
+    def __getitem__(self, idx):
+        if self.lru_size <= 0:
+            return self.frames[idx]
+
+        if idx in self.lru:
+            self.lru.move_to_end(idx)
+            return self.lru[idx]
+        frame = np.array(self.frames[idx])
+        self.lru[idx] = frame
+        if len(self.lru) > self.lru_size:
+            self.lru.popitem(last=False)
+        return frame
@@ -0,0 +1,57 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+class PixelSampler(nn.Module):
+    """Batched, on-device counterpart of utils.weighted_sampling.
+
+    Frames are decoded once and kept on the module so that pixel sampling runs after
+    collation on the target device instead of in the DataLoader workers.
+    """
+    def __init__(self, dataset, num_sample, bbox_ratio=0.9):
+        super().__init__()
+        frames, bboxes = dataset.load_frames()
+        self.img_size = frames.shape[1:3]
+        self.num_sample = num_sample
+        self.bbox_ratio = bbox_ratio
+
+        self.register_buffer('frames', frames.permute(0, 3, 1, 2).contiguous(), persistent=False)
+        self.register_buffer('bboxes', bboxes, persistent=False)
+
+    def forward(self, idx):
+        """Sample pixels, more within the mask bounding box.
+        Args:
+            idx (tensor): frame indices. shape: [B]
+        Returns:
+            uv (tensor): pixel coordinates. shape: [B, N, 2]
+            rgb (tensor): interpolated colors. shape: [B, N, 3]
+            index_outside (tensor): flattened indices of the uniform samples outside the bbox. shape: [1, K]
+        """
+        batch_size = idx.shape[0]
+        device = self.frames.device
+        bbox_min = self.bboxes[idx, 0].unsqueeze(1)
+        bbox_max = self.bboxes[idx, 1].unsqueeze(1)
+
+        num_sample_bbox = int(self.num_sample * self.bbox_ratio)
+        samples_bbox = torch.rand(batch_size, num_sample_bbox, 2, device=device)
+        samples_bbox = samples_bbox * (bbox_max - bbox_min) + bbox_min
+
+        num_sample_uniform = self.num_sample - num_sample_bbox
+        samples_uniform = torch.rand(batch_size, num_sample_uniform, 2, device=device)
+        samples_uniform = samples_uniform * torch.tensor([self.img_size[0] - 1, self.img_size[1] - 1], device=device)
+
+        # get indices for uniform samples outside of bbox
+        outside = ((samples_uniform < bbox_min) | (samples_uniform > bbox_max)).any(dim=-1)
+        outside = torch.cat([torch.zeros(batch_size, num_sample_bbox, dtype=torch.bool, device=device), outside], dim=1)
+        index_outside = torch.nonzero(outside.reshape(-1))[:, 0].unsqueeze(0)
+
+        # samples are (row, col), uv and grid_sample expect (col, row)
+        uv = torch.cat([samples_bbox, samples_uniform], dim=1).flip(-1)
+        grid = uv / torch.tensor([self.img_size[1] - 1, self.img_size[0] - 1], device=device) * 2 - 1
+
+        frames = self.frames[idx].float() / 255
+        rgb = F.grid_sample(frames, grid.unsqueeze(1), mode='bilinear', align_corners=True)
+        rgb = rgb.squeeze(2).permute(0, 2, 1)
+
+        return uv, rgb, index_outside
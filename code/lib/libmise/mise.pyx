@@ -3,7 +3,8 @@ cimport cython
 from libc.stdint cimport int32_t, int64_t
 from cython.operator cimport dereference as dref
 from libcpp.vector cimport vector
-from libcpp.map cimport map
+from libcpp.unordered_map cimport unordered_map
+from libcpp.utility cimport pair
 from libc.math cimport isnan, NAN
 import numpy as np
 
@@ -25,7 +26,7 @@ cdef struct GridPoint:
     bint known
 
 
-cdef inline unsigned long vec_to_idx(Vector3D coord, long resolution):
+cdef inline unsigned long vec_to_idx(Vector3D coord, long resolution) noexcept nogil:
     cdef unsigned long idx
     idx = resolution * resolution * coord.x + resolution * coord.y + coord.z
     return idx
@@ -34,7 +35,7 @@ cdef inline unsigned long vec_to_idx(Vector3D coord, long resolution):
 cdef class MISE:
     cdef vector[Voxel] voxels
     cdef vector[GridPoint] grid_points
-    cdef map[long, long] grid_point_hash
+    cdef unordered_map[long, long] grid_point_hash
     cdef readonly int resolution_0
     cdef readonly int depth
     cdef readonly double threshold
@@ -50,16 +51,16 @@ cdef class MISE:
 
         # Create initial voxels
         self.voxels.reserve(resolution_0 * resolution_0 * resolution_0)
-        
+
         cdef Voxel voxel
         cdef GridPoint point
         cdef Vector3D loc
         cdef int i, j, k
         for i in range(resolution_0):
-            for j in range(resolution_0): 
+            for j in range(resolution_0):
                 for  k in range (resolution_0):
                     loc = Vector3D(
-                        i * self.voxel_size_0, 
+                        i * self.voxel_size_0,
                         j * self.voxel_size_0,
                         k * self.voxel_size_0,
                     )
@@ -78,7 +79,7 @@ cdef class MISE:
             for j in range(resolution_0 + 1):
                 for k in range(resolution_0 + 1):
                     loc = Vector3D(
-                        i * self.voxel_size_0, 
+                        i * self.voxel_size_0,
                         j * self.voxel_size_0,
                         k * self.voxel_size_0,
                     )
@@ -91,111 +92,182 @@ cdef class MISE:
         assert(points.shape[1] == 3)
         cdef Vector3D loc
         cdef long idx
-        cdef int i
+        cdef long i
+        cdef long n_missing = 0
 
         # Find all indices of point and set value
-        for i in range(points.shape[0]):
-            loc = Vector3D(points[i, 0], points[i, 1], points[i, 2])
-            idx = self.get_grid_point_idx(loc)
-            if idx == -1:
-                raise ValueError('Point not in grid!')
-            self.grid_points[idx].value = values[i]
-            self.grid_points[idx].known = True
+        with nogil:
+            for i in range(points.shape[0]):
+                loc = Vector3D(<int>points[i, 0], <int>points[i, 1], <int>points[i, 2])
+                idx = self.get_grid_point_idx(loc)
+                if idx == -1:
+                    n_missing += 1
+                    continue
+                self.grid_points[idx].value = values[i]
+                self.grid_points[idx].known = True
+        if n_missing > 0:
+            raise ValueError('Point not in grid!')
+
         # Subdivide activate voxels and add new points
-        self.subdivide_voxels()
+        with nogil:
+            self.subdivide_voxels()
 
     def query(self):
         """Query points to evaluate."""
         # Find all points with unknown value
         cdef vector[Vector3D] points
-        cdef int n_unknown = 0
-        for p in self.grid_points:
-            if not p.known:
-                n_unknown += 1 
+        cdef size_t i
 
-        points.reserve(n_unknown)
-        for p in self.grid_points:
-            if not p.known:
-                points.push_back(p.loc)
+        with nogil:
+            for i in range(self.grid_points.size()):
+                if not self.grid_points[i].known:
+                    points.push_back(self.grid_points[i].loc)
 
         # Convert to numpy
         points_np = np.zeros((points.size(), 3), dtype=np.int64)
         cdef int64_t[:, :] points_view = points_np
-        for i in range(points.size()):
-            points_view[i, 0] = points[i].x
-            points_view[i, 1] = points[i].y
-            points_view[i, 2] = points[i].z
+        with nogil:
+            for i in range(points.size()):
+                points_view[i, 0] = points[i].x
+                points_view[i, 1] = points[i].y
+                points_view[i, 2] = points[i].z
 
         return points_np
 
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
     def to_dense(self):
-        """Output dense matrix at highest resolution."""
-        out_array = np.full((self.resolution + 1,) * 3, np.nan)
+        """Output dense matrix at highest resolution.
+
+        Unknown points take the value of the previous point along x, then y, then z.
+        """
+        cdef long size = self.resolution + 1
+        out_array = np.full((size,) * 3, np.nan)
         cdef double[:, :, :] out_view = out_array
-        cdef GridPoint point
-        cdef int i, j, k
-        
-        for point in self.grid_points:
-            # Take voxel for which points is upper left corner
-            # assert(point.known)
-            out_view[point.loc.x, point.loc.y, point.loc.z] = point.value
-
-        # Complete along x axis
-        for i in range(1, self.resolution + 1):
-            for j in range(self.resolution + 1):
-                for k in range(self.resolution + 1):
-                    if isnan(out_view[i, j, k]):
-                        out_view[i, j, k] = out_view[i-1, j, k]
-
-        # Complete along y axis
-        for i in range(self.resolution + 1):
-            for j in range(1, self.resolution + 1):
-                for k in range(self.resolution + 1):
-                    if isnan(out_view[i, j, k]):
-                        out_view[i, j, k] = out_view[i, j-1, k]
-
-
-        # Complete along z axis
-        for i in range(self.resolution + 1):
-            for j in range(self.resolution + 1):
-                for k in range(1, self.resolution + 1):
-                    if isnan(out_view[i, j, k]):
-                        out_view[i, j, k] = out_view[i, j, k-1]
-                    assert(not isnan(out_view[i, j, k]))
+        cdef long i, j, k
+        cdef size_t n
+
+        with nogil:
+            for n in range(self.grid_points.size()):
+                # Take voxel for which points is upper left corner
+                out_view[self.grid_points[n].loc.x, self.grid_points[n].loc.y, self.grid_points[n].loc.z] = self.grid_points[n].value
+
+            # Complete along x axis
+            for i in range(1, size):
+                for j in range(size):
+                    for k in range(size):
+                        if isnan(out_view[i, j, k]):
+                            out_view[i, j, k] = out_view[i-1, j, k]
+
+            # Complete along y axis
+            for i in range(size):
+                for j in range(1, size):
+                    for k in range(size):
+                        if isnan(out_view[i, j, k]):
+                            out_view[i, j, k] = out_view[i, j-1, k]
+
+            # Complete along z axis
+            for i in range(size):
+                for j in range(size):
+                    for k in range(1, size):
+                        if isnan(out_view[i, j, k]):
+                            out_view[i, j, k] = out_view[i, j, k-1]
         return out_array
 
+    def get_active_voxels(self):
+        """Leaf voxels at the highest resolution with corner values on both sides of the threshold,
+        i.e. the cells the surface passes through, without building the dense grid.
+
+        Returns:
+            locs (np.ndarray): lower corner of each cell at the highest resolution. shape: [M, 3]
+            values (np.ndarray): values at the corners of each cell, indexed [x, y, z]. shape: [M, 2, 2, 2]
+        """
+        cdef vector[long] active
+        cdef vector[double] corner_values
+        cdef size_t n
+        cdef long idx, m
+        cdef int i, j, k
+        cdef bint positive, negative, complete
+        cdef double value
+        cdef Vector3D loc
+
+        with nogil:
+            for n in range(self.voxels.size()):
+                if not self.voxels[n].is_leaf or self.voxels[n].level != self.depth:
+                    continue
+                positive = False
+                negative = False
+                complete = True
+                for i in range(2):
+                    for j in range(2):
+                        for k in range(2):
+                            loc = Vector3D(self.voxels[n].loc.x + i, self.voxels[n].loc.y + j, self.voxels[n].loc.z + k)
+                            idx = self.get_grid_point_idx(loc)
+                            if idx == -1 or not self.grid_points[idx].known:
+                                complete = False
+                                value = NAN
+                            else:
+                                value = self.grid_points[idx].value
+                                positive = positive or value >= self.threshold
+                                negative = negative or value <= self.threshold
+                            corner_values.push_back(value)
+                if complete and positive and negative:
+                    active.push_back(n)
+                else:
+                    corner_values.resize(corner_values.size() - 8)
+
+        locs_np = np.zeros((active.size(), 3), dtype=np.int64)
+        values_np = np.zeros((active.size(), 2, 2, 2), dtype=np.float64)
+        cdef int64_t[:, :] locs_view = locs_np
+        cdef double[:, :, :, :] values_view = values_np
+        with nogil:
+            for m in range(<long>active.size()):
+                locs_view[m, 0] = self.voxels[active[m]].loc.x
+                locs_view[m, 1] = self.voxels[active[m]].loc.y
+                locs_view[m, 2] = self.voxels[active[m]].loc.z
+                for i in range(2):
+                    for j in range(2):
+                        for k in range(2):
+                            values_view[m, i, j, k] = corner_values[8 * m + 4 * i + 2 * j + k]
+
+        return locs_np, values_np
+
     def get_points(self):
         points_np = np.zeros((self.grid_points.size(), 3), dtype=np.int64)
         values_np = np.zeros((self.grid_points.size()), dtype=np.float64)
 
-        cdef long[:, :] points_view = points_np
+        cdef int64_t[:, :] points_view = points_np
         cdef double[:] values_view = values_np
         cdef Vector3D loc
-        cdef int i
+        cdef size_t i
 
-        for i in range(self.grid_points.size()):
-            loc = self.grid_points[i].loc
-            points_view[i, 0] = loc.x
-            points_view[i, 1] = loc.y
-            points_view[i, 2] = loc.z
-            values_view[i] = self.grid_points[i].value
+        with nogil:
+            for i in range(self.grid_points.size()):
+                loc = self.grid_points[i].loc
+                points_view[i, 0] = loc.x
+                points_view[i, 1] = loc.y
+                points_view[i, 2] = loc.z
+                values_view[i] = self.grid_points[i].value
 
         return points_np, values_np
 
-    cdef void subdivide_voxels(self) except +:
+    cdef int subdivide_voxels(self) except -1 nogil:
         cdef vector[bint] next_to_positive
         cdef vector[bint] next_to_negative
         cdef int i, j, k
         cdef long idx
+        cdef size_t n
         cdef Vector3D loc, adj_loc
+        cdef GridPoint grid_point
 
         # Initialize vectors
         next_to_positive.resize(self.voxels.size(), False)
         next_to_negative.resize(self.voxels.size(), False)
-    
+
         # Iterate over grid points and mark voxels active
         # TODO: can move this to update operation and add attibute to voxel
-        for grid_point in self.grid_points:
+        for n in range(self.grid_points.size()):
+            grid_point = self.grid_points[n]
             loc = grid_point.loc
             if not grid_point.known:
                 continue
@@ -212,15 +284,16 @@ cdef class MISE:
                         idx = self.get_voxel_idx(adj_loc)
                         if idx == -1:
                             continue
-            
+
                         if grid_point.value >= self.threshold:
                             next_to_positive[idx] = True
                         if grid_point.value <= self.threshold:
                             next_to_negative[idx] = True
 
-        cdef int n_subdivide = 0
-        
-        for idx in range(self.voxels.size()):
+        cdef long n_subdivide = 0
+        cdef long n_voxels = self.voxels.size()
+
+        for idx in range(n_voxels):
             if not self.voxels[idx].is_leaf or self.voxels[idx].level == self.depth:
                 continue
             if next_to_positive[idx] and next_to_negative[idx]:
@@ -229,25 +302,24 @@ cdef class MISE:
         self.voxels.reserve(self.voxels.size() + 8 * n_subdivide)
         self.grid_points.reserve(self.voxels.size() + 19 * n_subdivide)
 
-        for idx in range(self.voxels.size()):
+        for idx in range(n_voxels):
             if not self.voxels[idx].is_leaf or self.voxels[idx].level == self.depth:
                 continue
             if next_to_positive[idx] and next_to_negative[idx]:
                 self.subdivide_voxel(idx)
+        return 0
 
-    cdef void subdivide_voxel(self, long idx):
+    cdef int subdivide_voxel(self, long idx) except -1 nogil:
         cdef Voxel voxel
         cdef GridPoint point
         cdef Vector3D loc0 = self.voxels[idx].loc
         cdef Vector3D loc
         cdef int new_level = self.voxels[idx].level + 1
         cdef int new_size = 1 << (self.depth - new_level)
-        assert(new_level <= self.depth)
-        assert(1 <= new_size <= self.voxel_size_0)
 
         # Current voxel is not leaf anymore
         self.voxels[idx].is_leaf = False
-        # Add new voxels        
+        # Add new voxels
         cdef int i, j, k
         for i in range(2):
             for j in range(2):
@@ -258,7 +330,7 @@ cdef class MISE:
                         z=loc0.z + k * new_size,
                     )
                     voxel = Voxel(
-                        loc=loc, 
+                        loc=loc,
                         level=new_level,
                         is_leaf=True
                     )
@@ -279,10 +351,11 @@ cdef class MISE:
                     # Only add new grid points
                     if self.get_grid_point_idx(loc) == -1:
                         self.add_grid_point(loc)
+        return 0
 
 
-    @cython.cdivision(True) 
-    cdef long get_voxel_idx(self, Vector3D loc) except +:
+    @cython.cdivision(True)
+    cdef long get_voxel_idx(self, Vector3D loc) noexcept nogil:
         """Utility function for getting voxel index corresponding to 3D coordinates."""
         # Shorthands
         cdef long resolution = self.resolution
@@ -293,34 +366,30 @@ cdef class MISE:
         # Return -1 if point lies outside bounds
         if not (0 <= loc.x < resolution and 0<= loc.y < resolution and 0 <= loc.z < resolution):
             return -1
-        
+
         # Coordinates in coarse voxel grid
         cdef Vector3D loc0 = Vector3D(
             x=loc.x >> depth,
             y=loc.y >> depth,
             z=loc.z >> depth,
-        )       
+        )
 
         # Initial voxels
-        cdef int idx = vec_to_idx(loc0, resolution_0)
+        cdef long idx = vec_to_idx(loc0, resolution_0)
         cdef Voxel voxel = self.voxels[idx]
-        assert(voxel.loc.x == loc0.x * voxel_size_0)
-        assert(voxel.loc.y == loc0.y * voxel_size_0)
-        assert(voxel.loc.z == loc0.z * voxel_size_0)
 
         # Relative coordinates
         cdef Vector3D loc_rel = Vector3D(
             x=loc.x - (loc0.x << depth),
             y=loc.y - (loc0.y << depth),
             z=loc.z - (loc0.z << depth),
-        ) 
+        )
 
         cdef Vector3D loc_offset
         cdef long voxel_size = voxel_size_0
 
         while not voxel.is_leaf:
             voxel_size = voxel_size >> 1
-            assert(voxel_size >= 1)
 
             # Determine child
             loc_offset = Vector3D(
@@ -337,34 +406,25 @@ cdef class MISE:
                 x=loc_rel.x - loc_offset.x * voxel_size,
                 y=loc_rel.y - loc_offset.y * voxel_size,
                 z=loc_rel.z - loc_offset.z * voxel_size,
-            ) 
-
-            assert(0<= loc_rel.x < voxel_size)
-            assert(0<= loc_rel.y < voxel_size)
-            assert(0<= loc_rel.z < voxel_size)
-
+            )
 
         # Return idx
         return idx
 
 
-    cdef inline void add_grid_point(self, Vector3D loc):
+    cdef inline int add_grid_point(self, Vector3D loc) except -1 nogil:
         cdef GridPoint point = GridPoint(
             loc=loc,
             value=0.,
             known=False,
         )
-        self.grid_point_hash[vec_to_idx(loc, self.resolution + 1)] = self.grid_points.size()
+        # insert and push_back are declared except +, a bad_alloc is raised as MemoryError
+        self.grid_point_hash.insert(pair[long, long](vec_to_idx(loc, self.resolution + 1), self.grid_points.size()))
         self.grid_points.push_back(point)
+        return 0
 
-    cdef inline int get_grid_point_idx(self, Vector3D loc):
-        p_idx = self.grid_point_hash.find(vec_to_idx(loc, self.resolution + 1))
+    cdef inline long get_grid_point_idx(self, Vector3D loc) noexcept nogil:
+        cdef unordered_map[long, long].iterator p_idx = self.grid_point_hash.find(vec_to_idx(loc, self.resolution + 1))
         if p_idx == self.grid_point_hash.end():
             return -1
-
-        cdef int idx = dref(p_idx).second
-        assert(self.grid_points[idx].loc.x == loc.x)
-        assert(self.grid_points[idx].loc.y == loc.y)
-        assert(self.grid_points[idx].loc.z == loc.z)
-
-        return idx
\ No newline at end of file
+        return dref(p_idx).second
@@ -1,43 +1,184 @@
+import warnings
 import torch
 import torch.nn.functional as F
 from .smpl import SMPLServer
 from pytorch3d import ops
+from lib.utils.profiler import profiler
+from lib.utils import utils
 
 class SMPLDeformer():
-    def __init__(self, max_dist=0.1, K=1, gender='female', betas=None):
+    def __init__(self, max_dist=0.1, K=1, gender='female', betas=None, use_grid=False, grid_res=64, grid_tol=0.1, device='cuda'):
         super().__init__()
 
         self.max_dist = max_dist
         self.K = K
-        self.smpl = SMPLServer(gender=gender)
+        self.smpl = SMPLServer(gender=gender, device=device)
         smpl_params_canoical = self.smpl.param_canonical.clone()
         smpl_params_canoical[:, 76:] = torch.tensor(betas).float().to(self.smpl.param_canonical.device)
         cano_scale, cano_transl, cano_thetas, cano_betas = torch.split(smpl_params_canoical, [1, 3, 72, 10], dim=1)
         smpl_output = self.smpl(cano_scale, cano_transl, cano_thetas, cano_betas)
         self.smpl_verts = smpl_output['smpl_verts']
         self.smpl_weights = smpl_output['smpl_weights']
-    def forward(self, x, smpl_tfs, return_weights=True, inverse=False, smpl_verts=None):
+
+        # skinning weights of the canonical template baked into a grid, replacing the per-sample KNN.
+        # Posed vertices change with the optimized SMPL pose every step, so posed queries keep the KNN.
+        self.use_grid = use_grid
+        self.grid_res = grid_res
+        self.grid_tol = grid_tol
+        self.grid_cano = None
+        if self.use_grid:
+            self.grid_cano = self.bake_grid(self.smpl_verts[0])
+            if not self.check_grid(self.grid_cano, self.smpl_verts[0]):
+                self.use_grid = False
+                self.grid_cano = None
+
+    def forward(self, x, smpl_tfs, return_weights=True, inverse=False, smpl_verts=None, frame_idx=None):
         if x.shape[0] == 0: return x
+        if frame_idx is not None:
+            return self.forward_multi_frame(x, smpl_tfs, return_weights, inverse, smpl_verts, frame_idx)
         if smpl_verts is None:
-            weights, outlier_mask = self.query_skinning_weights_smpl_multi(x[None], smpl_verts=self.smpl_verts[0], smpl_weights=self.smpl_weights)
+            weights, outlier_mask = self.query_skinning_weights(x[None], smpl_verts=self.smpl_verts[0])
         else:
-            weights, outlier_mask = self.query_skinning_weights_smpl_multi(x[None], smpl_verts=smpl_verts[0], smpl_weights=self.smpl_weights)
+            weights, outlier_mask = self.query_skinning_weights(x[None], smpl_verts=smpl_verts[0])
         if return_weights:
             return weights
 
         x_transformed = skinning(x.unsqueeze(0), weights, smpl_tfs, inverse=inverse)
 
         return x_transformed.squeeze(0), outlier_mask
-    def forward_skinning(self, xc, cond, smpl_tfs):
-        weights, _ = self.query_skinning_weights_smpl_multi(xc, smpl_verts=self.smpl_verts[0], smpl_weights=self.smpl_weights)
-        x_transformed = skinning(xc, weights, smpl_tfs, inverse=False)
+    def forward_multi_frame(self, x, smpl_tfs, return_weights, inverse, smpl_verts, frame_idx):
+        """forward for points of several frames, frame_idx [N] indexes smpl_tfs and smpl_verts."""
+        weights = x.new_zeros(1, x.shape[0], self.smpl_weights.shape[-1])
+        outlier_mask = torch.zeros(x.shape[0], dtype=torch.bool, device=x.device)
+        x_transformed = torch.zeros_like(x)
+        for i in range(smpl_verts.shape[0]):
+            mask = frame_idx == i
+            if not mask.any():
+                continue
+            weights_i, outlier_mask[mask] = self.query_skinning_weights(x[mask].unsqueeze(0), smpl_verts=smpl_verts[i])
+            weights[:, mask] = weights_i
+            if not return_weights:
+                x_transformed[mask] = skinning(x[mask].unsqueeze(0), weights_i, smpl_tfs[i:i+1], inverse=inverse).squeeze(0)
+        if return_weights:
+            return weights
+
+        return x_transformed, outlier_mask
+
+    def forward_skinning(self, xc, cond, smpl_tfs, frame_idx=None):
+        weights, _ = self.query_skinning_weights(xc, smpl_verts=self.smpl_verts[0])
+        if frame_idx is None:
+            x_transformed = skinning(xc, weights, smpl_tfs, inverse=False)
+        else:
+            w_tf = self.blend_transforms(weights, smpl_tfs, frame_idx)
+            x_transformed = torch.einsum('bpij,bpj->bpi', w_tf, F.pad(xc, (0, 1), value=1.0))[:, :, :3]
 
         return x_transformed
 
+    def forward_skinning_jacobian(self, xc, smpl_tfs, frame_idx=None):
+        """Jacobian of forward_skinning w.r.t. xc. shape: [B, N, 3, 3]
+        The skinning weights are detached, so it is the rotation block of the blended bone transformation."""
+        weights, _ = self.query_skinning_weights(xc, smpl_verts=self.smpl_verts[0])
+        if frame_idx is None:
+            return torch.einsum('bpn,bnij->bpij', weights, smpl_tfs[:, :, :3, :3])
+        return self.blend_transforms(weights, smpl_tfs[:, :, :3, :3], frame_idx)
+
+    def blend_transforms(self, weights, tfs, frame_idx):
+        """Blend the bone transformations of the frame of each point.
+        Args:
+            weights (tensor): skinning weights. shape: [1, N, J]
+            tfs (tensor): bone transformations of all frames. shape: [F, J, D, D]
+            frame_idx (tensor): frame of each point. shape: [N]
+        Returns:
+            w_tf (tensor): blended transformations. shape: [1, N, D, D]
+        """
+        w_tf = weights.new_zeros(weights.shape[0], weights.shape[1], tfs.shape[-2], tfs.shape[-1])
+        # blended per frame, so only the output is materialized
+        for i in range(tfs.shape[0]):
+            mask = frame_idx == i
+            w_tf[:, mask] = torch.einsum('bpn,nij->bpij', weights[:, mask], tfs[i])
+        return w_tf
+
+    def query_skinning_weights(self, pts, smpl_verts):
+        """Query skinning weights either from the baked grid or by KNN.
+        Args:
+            pts (tensor): query points. shape: [1, N, 3]
+            smpl_verts (tensor): SMPL vertices the points live with. shape: [V, 3]
+        Returns:
+            weights (tensor): skinning weights. shape: [1, N, J]
+            outlier_mask (tensor): points far from the SMPL surface. shape: [N]
+        """
+        # the canonical vertices are passed as views of self.smpl_verts, which avoids comparing them
+        canonical = smpl_verts.data_ptr() == self.smpl_verts.data_ptr() and smpl_verts.shape == self.smpl_verts.shape[1:]
+        if not self.use_grid or not canonical:
+            return self.query_skinning_weights_smpl_multi(pts, smpl_verts=smpl_verts, smpl_weights=self.smpl_weights)
+
+        with profiler.stage('deformer_grid'):
+            return self.query_skinning_weights_grid(pts, self.grid_cano)
+
+    @torch.no_grad()
+    def bake_grid(self, smpl_verts):
+        """Bake KNN skinning weights and the outlier distance into a dense grid around the canonical vertices."""
+        smpl_verts = smpl_verts.detach()
+        # pad by more than max_dist so that points outside the grid are always outliers
+        padding = 2 * self.max_dist
+        bbox_min = smpl_verts.min(dim=0)[0] - padding
+        bbox_max = smpl_verts.max(dim=0)[0] + padding
+
+        # grid_sample expects [C, D, H, W] with (x, y, z) sampling coordinates
+        xs, ys, zs = [torch.linspace(float(bbox_min[i]), float(bbox_max[i]), self.grid_res, device=smpl_verts.device) for i in range(3)]
+        grid_z, grid_y, grid_x = utils.meshgrid_ij(zs, ys, xs)
+        grid_pts = torch.stack([grid_x, grid_y, grid_z], dim=-1).reshape(1, -1, 3)
+
+        values = []
+        for pts in torch.split(grid_pts, 100000, dim=1):
+            weights, distance = self.knn_skinning_weights(pts, smpl_verts=smpl_verts, smpl_weights=self.smpl_weights)
+            values.append(torch.cat([weights, distance[..., None]], dim=-1))
+        values = torch.cat(values, dim=1)[0]
+        values = values.reshape(self.grid_res, self.grid_res, self.grid_res, -1).permute(3, 0, 1, 2)
+
+        return {'values': values.unsqueeze(0).contiguous(),
+                'bbox_min': bbox_min,
+                'bbox_max': bbox_max}
+
+    def query_skinning_weights_grid(self, pts, grid):
+        bbox_min, bbox_max = grid['bbox_min'], grid['bbox_max']
+        pts_normalized = (pts - bbox_min) / (bbox_max - bbox_min) * 2 - 1
+        outside = (pts_normalized.abs() > 1).any(dim=-1)[0]
+
+        values = F.grid_sample(grid['values'], pts_normalized.reshape(1, 1, 1, -1, 3).to(grid['values'].dtype),
+                               mode='bilinear', padding_mode='border', align_corners=True)
+        values = values.reshape(values.shape[1], -1).transpose(0, 1)
+        weights = values[None, :, :-1].detach()
+        distance = values[:, -1]
+
+        outlier_mask = (distance > self.max_dist) | outside
+        return weights, outlier_mask
+
+    @torch.no_grad()
+    def check_grid(self, grid, smpl_verts, num_points=10000, seed=0):
+        """Compare the grid lookup with the KNN path on points around the SMPL surface.
+        The points come from their own generator, leaving the global random stream untouched."""
+        generator = torch.Generator(device=smpl_verts.device).manual_seed(seed)
+        indices = torch.randint(smpl_verts.shape[0], (num_points,), device=smpl_verts.device, generator=generator)
+        pts = smpl_verts[indices] + torch.randn(num_points, 3, device=smpl_verts.device, generator=generator) * self.max_dist * 0.5
+        weights_knn, _ = self.query_skinning_weights_smpl_multi(pts[None], smpl_verts=smpl_verts, smpl_weights=self.smpl_weights)
+        weights_grid, _ = self.query_skinning_weights_grid(pts[None], grid)
+        error = (weights_knn - weights_grid).abs().sum(-1).mean().item()
+        if error > self.grid_tol:
+            warnings.warn(f'Skinning weight grid error {error:.4f} exceeds tolerance {self.grid_tol}, falling back to KNN.')
+            return False
+        return True
+
     def query_skinning_weights_smpl_multi(self, pts, smpl_verts, smpl_weights):
+        weights, distance = self.knn_skinning_weights(pts, smpl_verts, smpl_weights)
+        outlier_mask = (distance > self.max_dist)[0]
+        return weights, outlier_mask
 
-        distance_batch, index_batch, neighbor_points = ops.knn_points(pts, smpl_verts.unsqueeze(0),
-                                                                      K=self.K, return_nn=True)
+    def knn_skinning_weights(self, pts, smpl_verts, smpl_weights):
+        """Skinning weights of the K nearest vertices and the distance to the nearest one. shape: [1, N, J], [1, N]"""
+        with profiler.stage('deformer_knn'):
+            distance_batch, index_batch, neighbor_points = ops.knn_points(pts, smpl_verts.unsqueeze(0),
+                                                                          K=self.K, return_nn=True)
         distance_batch = torch.clamp(distance_batch, max=4)
         weights_conf = torch.exp(-distance_batch)
         distance_batch = torch.sqrt(distance_batch)
@@ -45,9 +186,7 @@ class SMPLDeformer():
         index_batch = index_batch[0]
         weights = smpl_weights[:, index_batch, :]
         weights = torch.sum(weights * weights_conf.unsqueeze(-1), dim=-2).detach()
-
-        outlier_mask = (distance_batch[..., 0] > self.max_dist)[0]
-        return weights, outlier_mask
+        return weights, distance_batch[..., 0]
 
     def query_weights(self, xc):
         weights = self.forward(xc, None, return_weights=True, inverse=False)
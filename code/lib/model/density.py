@@ -15,7 +15,7 @@ class Density(nn.Module):
 class LaplaceDensity(Density):  # alpha * Laplace(loc=0, scale=beta).cdf(-sdf)
     def __init__(self, params_init={}, beta_min=0.0001):
         super().__init__(params_init=params_init)
-        self.beta_min = torch.tensor(beta_min).cuda()
+        self.beta_min = beta_min
 
     def density_func(self, sdf, beta=None):
         if beta is None:
@@ -41,6 +41,6 @@ class SimpleDensity(Density):  # like NeRF
 
     def density_func(self, sdf, beta=None):
         if self.training and self.noise_std > 0.0:
-            noise = torch.randn(sdf.shape).cuda() * self.noise_std
+            noise = torch.randn_like(sdf) * self.noise_std
             sdf = sdf + noise
         return torch.relu(sdf)
@@ -33,6 +33,37 @@ class Embedder:
     def embed(self, inputs):
         return torch.cat([fn(inputs) for fn in self.embed_fns], -1)
 
+class FourierEmbedder:
+    """Same output layout as Embedder, i.e. [x, p_0(f_0 x), p_1(f_0 x), p_0(f_1 x), ...],
+    but all frequency bands are computed with one batched op per periodic function."""
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        d = self.kwargs['input_dims']
+        max_freq = self.kwargs['max_freq_log2']
+        N_freqs = self.kwargs['num_freqs']
+
+        if self.kwargs['log_sampling']:
+            self.freq_bands = 2. ** torch.linspace(0., max_freq, N_freqs)
+        else:
+            self.freq_bands = torch.linspace(2.**0., 2.**max_freq, N_freqs)
+
+        self.out_dim = N_freqs * len(self.kwargs['periodic_fns']) * d
+        if self.kwargs['include_input']:
+            self.out_dim += d
+
+    def embed(self, inputs):
+        if self.freq_bands.device != inputs.device:
+            self.freq_bands = self.freq_bands.to(inputs.device)
+
+        # [..., N_freqs, d]
+        inputs_freq = inputs.unsqueeze(-2) * self.freq_bands.unsqueeze(-1)
+        # [..., N_freqs, N_fns, d]
+        outputs = torch.stack([p_fn(inputs_freq) for p_fn in self.kwargs['periodic_fns']], dim=-2)
+        outputs = outputs.reshape(*inputs.shape[:-1], -1)
+        if self.kwargs['include_input']:
+            outputs = torch.cat([inputs, outputs], -1)
+        return outputs
+
 def get_embedder(multires, input_dims=3, mode='fourier'):
     embed_kwargs = {
         'include_input': True,
@@ -43,8 +74,10 @@ def get_embedder(multires, input_dims=3, mode='fourier'):
         'periodic_fns': [torch.sin, torch.cos],
     }
     if mode == 'fourier':
+        embedder_obj = FourierEmbedder(**embed_kwargs)
+    elif mode == 'fourier_loop':
         embedder_obj = Embedder(**embed_kwargs)
 
 
     def embed(x, eo=embedder_obj): return eo.embed(x)
-    return embed, embedder_obj.out_dim
\ No newline at end of file
+    return embed, embedder_obj.out_dim
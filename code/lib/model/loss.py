@@ -41,7 +41,7 @@ class Loss(nn.Module):
 
     def forward(self, model_outputs, ground_truth):
         nan_filter = ~torch.any(model_outputs['rgb_values'].isnan(), dim=1)
-        rgb_gt = ground_truth['rgb'][0].cuda()
+        rgb_gt = ground_truth['rgb'].reshape(-1, 3).to(model_outputs['rgb_values'].device)
         rgb_loss = self.get_rgb_loss(model_outputs['rgb_values'][nan_filter], rgb_gt[nan_filter])
         eikonal_loss = self.get_eikonal_loss(model_outputs['grad_theta'])
         bce_loss = self.get_bce_loss(model_outputs['acc_map'])
@@ -0,0 +1,90 @@
+import math
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import kaolin
+from ..utils import utils
+
+
+def mesh_signed_distance(points, verts, faces, face_vertices, point_batch=100000):
+    """Exact signed distance of the points [N, 3] to the closed mesh verts [1, V, 3], faces [F, 3], negative inside."""
+    signed_distance = []
+    for pnts in torch.split(points, point_batch, dim=0):
+        distance, _, _ = kaolin.metrics.trianglemesh.point_to_mesh_distance(pnts.unsqueeze(0).contiguous(), face_vertices)
+        distance = torch.sqrt(distance) # kaolin outputs squared distance
+        sign = kaolin.ops.mesh.check_sign(verts, faces, pnts.unsqueeze(0)).float()
+        sign = 1 - 2 * sign
+        signed_distance.append((sign * distance)[0])
+    return torch.cat(signed_distance)
+
+
+class MeshSDFGrid(nn.Module):
+    """Signed distance to the canonical mesh, baked on a grid and queried with trilinear interpolation.
+
+    The grid spans the bounding box of the mesh padded by padding. Points outside the grid get the value
+    at the closest grid point plus their distance to the grid, which keeps them above padding.
+    After baking, the grid is compared to the exact distance on random points around the mesh whose
+    distance is near the band [0, band]. The grid is only used if the error_quantile of the error there
+    is at most max_error, see accurate. A quantile keeps rare points next to creases of the mesh, where
+    the distance is not smooth, from discarding the grid. The probes are drawn from a generator seeded
+    with seed, so baking leaves the global random stream untouched.
+    """
+    def __init__(self, resolution=128, padding=0.1, band=0.05, max_error=0.01, error_quantile=0.999, num_probes=100000, seed=0):
+        super().__init__()
+        assert padding > band, 'points outside the grid must stay off the band'
+        self.resolution = resolution
+        self.padding = padding
+        self.band = band
+        self.max_error = max_error
+        self.error_quantile = error_quantile
+        self.num_probes = num_probes
+        self.seed = seed
+        self.error = math.inf
+        self.register_buffer('bbox_min', torch.zeros(3), persistent=False)
+        self.register_buffer('bbox_max', torch.zeros(3), persistent=False)
+        self.register_buffer('sdf', torch.zeros(1, 1, 1), persistent=False)
+
+    @property
+    def accurate(self):
+        return self.error <= self.max_error
+
+    def get_nodes(self):
+        coords = torch.linspace(0, 1, self.resolution + 1, device=self.bbox_min.device)
+        grid = torch.stack(utils.meshgrid_ij(coords, coords, coords), dim=-1).reshape(-1, 3)
+        return self.bbox_min + grid * (self.bbox_max - self.bbox_min)
+
+    def interpolate(self, volume, x):
+        u = (x - self.bbox_min) / (self.bbox_max - self.bbox_min)
+        u_inside = u.clamp(0, 1)
+        distance_outside = ((u - u_inside) * (self.bbox_max - self.bbox_min)).norm(dim=-1)
+        # grid_sample takes the coordinates in (W, H, D) order, the volume is indexed [x, y, z]
+        grid = (u_inside * 2 - 1).flip(-1).reshape(1, -1, 1, 1, 3)
+        value = F.grid_sample(volume[None, None], grid, mode='bilinear', align_corners=True).reshape(-1)
+        return value + distance_outside
+
+    @torch.no_grad()
+    def bake(self, verts, faces, face_vertices):
+        """Rebuild the grid around the mesh verts [1, V, 3], faces [F, 3] and check its accuracy.
+        Returns the error_quantile of the error on the probes near the band."""
+        self.bbox_min = verts[0].min(dim=0)[0] - self.padding
+        self.bbox_max = verts[0].max(dim=0)[0] + self.padding
+        sdf = mesh_signed_distance(self.get_nodes(), verts, faces, face_vertices)
+        self.sdf = sdf.reshape(self.resolution + 1, self.resolution + 1, self.resolution + 1)
+
+        # accuracy check on random points around the surface
+        cell_diag = ((self.bbox_max - self.bbox_min) / self.resolution).norm()
+        generator = torch.Generator(device=verts.device).manual_seed(self.seed)
+        idx = torch.randint(0, verts.shape[1], (self.num_probes,), device=verts.device, generator=generator)
+        offsets = F.normalize(torch.randn(self.num_probes, 3, device=verts.device, generator=generator), dim=-1)
+        offsets = offsets * torch.rand(self.num_probes, 1, device=verts.device, generator=generator) * (self.band + cell_diag)
+        probes = verts[0, idx] + offsets
+        exact = mesh_signed_distance(probes, verts, faces, face_vertices)
+        in_band = (exact > -cell_diag) & (exact < self.band + cell_diag)
+        error = (self.interpolate(self.sdf, probes) - exact)[in_band].abs()
+        self.error = torch.quantile(error, self.error_quantile).item() if len(error) > 0 else math.inf
+        return self.error
+
+    @torch.no_grad()
+    def query(self, x):
+        """Signed distance of the canonical points x [N, 3] to the baked mesh."""
+        return self.interpolate(self.sdf, x)
@@ -1,5 +1,6 @@
 import torch.nn as nn
 import torch
+import torch.nn.functional as F
 import numpy as np
 from .embedders import get_embedder
 
@@ -71,7 +72,9 @@ class ImplicitNet(nn.Module):
             setattr(self, "lin" + str(l), lin)
         self.softplus = nn.Softplus(beta=100)
 
-    def forward(self, input, cond, current_epoch=None):
+    def forward(self, input, cond, current_epoch=None, frame_idx=None):
+        """frame_idx [N] selects the row of cond of each point when the points of
+        several frames are passed as a single batch."""
         if input.ndim == 2: input = input.unsqueeze(0)
 
         num_batch, num_point, num_dim = input.shape
@@ -81,11 +84,10 @@ class ImplicitNet(nn.Module):
         input = input.reshape(num_batch * num_point, num_dim)
 
         if self.cond != 'none':
-            num_batch, num_cond = cond[self.cond].shape
+            if frame_idx is None:
+                num_batch, num_cond = cond[self.cond].shape
 
-            input_cond = cond[self.cond].unsqueeze(1).expand(num_batch, num_point, num_cond)
-
-            input_cond = input_cond.reshape(num_batch * num_point, num_cond)
+            input_cond = cond[self.cond]
 
             if self.dim_pose_embed:
                 input_cond = self.lin_p0(input_cond)
@@ -97,11 +99,17 @@ class ImplicitNet(nn.Module):
 
         for l in range(0, self.num_layers - 1):
             lin = getattr(self, "lin" + str(l))
-            if self.cond != 'none' and l in self.cond_layer:
-                x = torch.cat([x, input_cond], dim=-1)
-            if l in self.skip_in:
-                x = torch.cat([x, input], 1) / np.sqrt(2)
-            x = lin(x)
+            if self.cond != 'none' and l in self.cond_layer and l not in self.skip_in:
+                x = self.forward_cond_layer(lin, x, input_cond, num_batch, frame_idx)
+            else:
+                if self.cond != 'none' and l in self.cond_layer:
+                    if frame_idx is None:
+                        x = torch.cat([x, input_cond.repeat_interleave(num_point, dim=0)], dim=-1)
+                    else:
+                        x = torch.cat([x, input_cond[frame_idx]], dim=-1)
+                if l in self.skip_in:
+                    x = torch.cat([x, input], 1) / np.sqrt(2)
+                x = lin(x)
             if l < self.num_layers - 2:
                 x = self.softplus(x)
         
@@ -109,6 +117,22 @@ class ImplicitNet(nn.Module):
 
         return x
 
+    def forward_cond_layer(self, lin, x, cond, num_batch, frame_idx=None):
+        """Same as lin(torch.cat([x, cond per point], dim=-1)), but the condition is constant
+        per frame, so its contribution is computed once per frame and broadcast over the points."""
+        if hasattr(lin, 'weight_g'):
+            # the weight norm reparametrization, as the forward pre-hook of lin would compute it
+            weight = lin.weight_g * lin.weight_v / lin.weight_v.norm(dim=1, keepdim=True)
+        else:
+            weight = lin.weight
+        num_dim = x.shape[-1]
+        x = F.linear(x, weight[:, :num_dim])
+        cond = F.linear(cond, weight[:, num_dim:], lin.bias)
+        if frame_idx is not None:
+            return x + cond[frame_idx]
+        x = x.reshape(num_batch, -1, x.shape[-1]) + cond.unsqueeze(1)
+        return x.reshape(-1, x.shape[-1])
+
     def gradient(self, x, cond):
         x.requires_grad_(True)
         y = self.forward(x, cond)[:, :1]
@@ -152,18 +176,24 @@ class RenderingNet(nn.Module):
         self.relu = nn.ReLU()
         self.sigmoid = nn.Sigmoid()
         
-    def forward(self, points, normals, view_dirs, body_pose, feature_vectors, frame_latent_code=None):
+    def forward(self, points, normals, view_dirs, body_pose, feature_vectors, frame_latent_code=None, frame_idx=None):
         if self.embedview_fn is not None:
             if self.mode == 'nerf_frame_encoding':
                 view_dirs = self.embedview_fn(view_dirs)
 
         if self.mode == 'nerf_frame_encoding':
-            frame_latent_code = frame_latent_code.expand(view_dirs.shape[0], -1)
+            if frame_idx is None:
+                frame_latent_code = frame_latent_code.expand(view_dirs.shape[0], -1)
+            else:
+                frame_latent_code = frame_latent_code[frame_idx]
             rendering_input = torch.cat([view_dirs, frame_latent_code, feature_vectors], dim=-1)
         elif self.mode == 'pose':
             num_points = points.shape[0]
-            body_pose = body_pose.unsqueeze(1).expand(-1, num_points, -1).reshape(num_points, -1)
-            body_pose = self.lin_pose(body_pose)
+            if frame_idx is None:
+                body_pose = body_pose.unsqueeze(1).expand(-1, num_points, -1).reshape(num_points, -1)
+                body_pose = self.lin_pose(body_pose)
+            else:
+                body_pose = self.lin_pose(body_pose)[frame_idx]
             rendering_input = torch.cat([points, normals, body_pose, feature_vectors], dim=-1)
         else:
             raise NotImplementedError
@@ -0,0 +1,57 @@
+import torch
+import torch.nn as nn
+from ..utils import utils
+
+
+class OccupancyGrid(nn.Module):
+    """Coarse binary occupancy of the canonical space, stored as a packed bitfield.
+
+    A cell is occupied if the SDF at its center is below threshold plus margin plus half
+    the cell diagonal, so every point of an empty cell has an SDF of at least
+    empty_sdf = threshold + margin, the value skipped points are given.
+    Points outside the grid are treated as empty. The grid starts fully occupied
+    and only skips points after the first update.
+    """
+    def __init__(self, bbox_min, bbox_max, resolution=64, threshold=0.05):
+        super().__init__()
+        assert resolution % 2 == 0, 'the resolution must be even to pack the grid into bytes'
+        self.resolution = resolution
+        self.threshold = threshold
+        self.register_buffer('bbox_min', bbox_min.float())
+        self.register_buffer('bbox_max', bbox_max.float())
+        self.register_buffer('bitfield', torch.full((resolution ** 3 // 8,), 255, dtype=torch.uint8, device=bbox_min.device))
+        self.register_buffer('empty_sdf', torch.tensor(float(threshold), device=bbox_min.device))
+        self.register_buffer('bit_weights', 2 ** torch.arange(8, device=bbox_min.device), persistent=False)
+
+    @property
+    def cell_size(self):
+        return (self.bbox_max - self.bbox_min) / self.resolution
+
+    def get_cell_centers(self):
+        res = self.resolution
+        coords = torch.arange(res, device=self.bbox_min.device).float() + 0.5
+        grid = torch.stack(utils.meshgrid_ij(coords, coords, coords), dim=-1).reshape(-1, 3)
+        return self.bbox_min + grid * self.cell_size
+
+    @torch.no_grad()
+    def update(self, sdf_func, margin=0., point_batch=100000):
+        """Rebuild the grid from sdf_func, mapping canonical points [N, 3] to their SDF [N, 1].
+        margin widens the occupied band, e.g. by a few beta so that empty cells have a negligible density."""
+        centers = self.get_cell_centers()
+        sdf = torch.cat([sdf_func(pnts).reshape(-1) for pnts in torch.split(centers, point_batch, dim=0)])
+        self.empty_sdf.fill_(self.threshold + margin)
+        occupancy = sdf < self.empty_sdf + 0.5 * self.cell_size.norm()
+        self.bitfield = (occupancy.reshape(-1, 8).long() * self.bit_weights).sum(-1).to(torch.uint8)
+
+    def query(self, x):
+        """Occupancy of the cells containing the canonical points x [N, 3]."""
+        idx = torch.floor((x - self.bbox_min) / self.cell_size).long()
+        inside = ((idx >= 0) & (idx < self.resolution)).all(-1)
+        idx = idx.clamp(0, self.resolution - 1)
+        idx = (idx[:, 0] * self.resolution + idx[:, 1]) * self.resolution + idx[:, 2]
+        occupied = (self.bitfield[idx // 8].long() & self.bit_weights[idx % 8]) > 0
+        return occupied & inside
+
+    def occupancy_ratio(self):
+        occupancy = (self.bitfield.unsqueeze(-1).long() & self.bit_weights) > 0
+        return occupancy.float().mean()
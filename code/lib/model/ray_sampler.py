@@ -1,6 +1,7 @@
 import abc
 import torch
 from lib.utils import utils
+from lib.utils.profiler import profiler
 
 class RaySampler(metaclass=abc.ABCMeta):
     def __init__(self,near, far):
@@ -20,13 +21,13 @@ class UniformSampler(RaySampler):
 
     def get_z_vals(self, ray_dirs, cam_loc, model):
         if not self.take_sphere_intersection:
-            near, far = self.near * torch.ones(ray_dirs.shape[0], 1).cuda(), self.far * torch.ones(ray_dirs.shape[0], 1).cuda()
+            near, far = self.near * torch.ones(ray_dirs.shape[0], 1, device=ray_dirs.device), self.far * torch.ones(ray_dirs.shape[0], 1, device=ray_dirs.device)
         else:
             sphere_intersections = utils.get_sphere_intersections(cam_loc, ray_dirs, r=self.scene_bounding_sphere)
-            near = self.near * torch.ones(ray_dirs.shape[0], 1).cuda()
+            near = self.near * torch.ones(ray_dirs.shape[0], 1, device=ray_dirs.device)
             far = sphere_intersections[:,1:]
 
-        t_vals = torch.linspace(0., 1., steps=self.N_samples).cuda()
+        t_vals = torch.linspace(0., 1., steps=self.N_samples, device=ray_dirs.device)
         z_vals = near * (1. - t_vals) + far * (t_vals)
 
         if model.training:
@@ -35,7 +36,7 @@ class UniformSampler(RaySampler):
             upper = torch.cat([mids, z_vals[..., -1:]], -1)
             lower = torch.cat([z_vals[..., :1], mids], -1)
             # stratified samples in those intervals
-            t_rand = torch.rand(z_vals.shape).cuda()
+            t_rand = torch.rand(z_vals.shape, device=z_vals.device)
 
             z_vals = lower + (upper - lower) * t_rand
 
@@ -44,7 +45,7 @@ class UniformSampler(RaySampler):
 class ErrorBoundSampler(RaySampler):
     def __init__(self, scene_bounding_sphere, near, N_samples, N_samples_eval, N_samples_extra,
                  eps, beta_iters, max_total_iters,
-                 inverse_sphere_bg=False, N_samples_inverse_sphere=0, add_tiny=0.0):
+                 inverse_sphere_bg=False, N_samples_inverse_sphere=0, add_tiny=0.0, beta_search_bits=1):
         super().__init__(near, 2.0 * scene_bounding_sphere)
         self.N_samples = N_samples
         self.N_samples_eval = N_samples_eval
@@ -55,6 +56,7 @@ class ErrorBoundSampler(RaySampler):
         self.eps = eps
         self.beta_iters = beta_iters
         self.max_total_iters = max_total_iters
+        self.beta_search_bits = beta_search_bits
         self.scene_bounding_sphere = scene_bounding_sphere
         self.add_tiny = add_tiny
 
@@ -63,7 +65,8 @@ class ErrorBoundSampler(RaySampler):
             N_samples_inverse_sphere = 32
             self.inverse_sphere_sampler = UniformSampler(1.0, 0.0, N_samples_inverse_sphere, False, far=1.0)
 
-    def get_z_vals(self, ray_dirs, cam_loc, model, cond, smpl_tfs, eval_mode, smpl_verts):
+    def get_z_vals(self, ray_dirs, cam_loc, model, cond, smpl_tfs, eval_mode, smpl_verts, return_cache=False, frame_idx=None,
+                   use_occupancy=False):
         beta0 = model.density.get_beta().detach()
 
         # Start with uniform sampling
@@ -79,121 +82,137 @@ class ErrorBoundSampler(RaySampler):
 
         # VolSDF Algorithm 1
         while not_converge and total_iters < self.max_total_iters:
-            points = cam_loc.unsqueeze(1) + samples.unsqueeze(2) * ray_dirs.unsqueeze(1)
-            points_flat = points.reshape(-1, 3)
-            # Calculating the SDF only for the new sampled points
-            model.implicit_network.eval()
-            with torch.no_grad():
-                samples_sdf = model.sdf_func_with_smpl_deformer(points_flat, cond, smpl_tfs, smpl_verts=smpl_verts)[0] 
-            model.implicit_network.train()
-            if samples_idx is not None:
-                sdf_merge = torch.cat([sdf.reshape(-1, z_vals.shape[1] - samples.shape[1]),
-                                       samples_sdf.reshape(-1, samples.shape[1])], -1)
-                sdf = torch.gather(sdf_merge, 1, samples_idx).reshape(-1, 1)
-            else:
-                sdf = samples_sdf
-
-
-            # Calculating the bound d* (Theorem 1)
-            d = sdf.reshape(z_vals.shape)
-            dists = z_vals[:, 1:] - z_vals[:, :-1]
-            a, b, c = dists, d[:, :-1].abs(), d[:, 1:].abs()
-            first_cond = a.pow(2) + b.pow(2) <= c.pow(2)
-            second_cond = a.pow(2) + c.pow(2) <= b.pow(2)
-            d_star = torch.zeros(z_vals.shape[0], z_vals.shape[1] - 1).cuda()
-            d_star[first_cond] = b[first_cond]
-            d_star[second_cond] = c[second_cond]
-            s = (a + b + c) / 2.0
-            area_before_sqrt = s * (s - a) * (s - b) * (s - c)
-            mask = ~first_cond & ~second_cond & (b + c - a > 0)
-            d_star[mask] = (2.0 * torch.sqrt(area_before_sqrt[mask])) / (a[mask])
-            d_star = (d[:, 1:].sign() * d[:, :-1].sign() == 1) * d_star  # Fixing the sign
-
-
-            # Updating beta using line search
-            curr_error = self.get_error_bound(beta0, model, sdf, z_vals, dists, d_star)
-            beta[curr_error <= self.eps] = beta0
-            beta_min, beta_max = beta0.unsqueeze(0).repeat(z_vals.shape[0]), beta
-            for j in range(self.beta_iters):
-                beta_mid = (beta_min + beta_max) / 2.
-                curr_error = self.get_error_bound(beta_mid.unsqueeze(-1), model, sdf, z_vals, dists, d_star)
-                beta_max[curr_error <= self.eps] = beta_mid[curr_error <= self.eps]
-                beta_min[curr_error > self.eps] = beta_mid[curr_error > self.eps]
-            beta = beta_max
-
-
-            # Upsample more points
-            density = model.density(sdf.reshape(z_vals.shape), beta=beta.unsqueeze(-1))
-
-            dists = torch.cat([dists, torch.tensor([1e10]).cuda().unsqueeze(0).repeat(dists.shape[0], 1)], -1)
-            free_energy = dists * density
-            shifted_free_energy = torch.cat([torch.zeros(dists.shape[0], 1).cuda(), free_energy[:, :-1]], dim=-1)
-            alpha = 1 - torch.exp(-free_energy)
-            transmittance = torch.exp(-torch.cumsum(shifted_free_energy, dim=-1))
-            weights = alpha * transmittance  # probability of the ray hits something here
-
-            # Check if we are done and this is the last sampling
-            total_iters += 1
-            not_converge = beta.max() > beta0
-
-            if not_converge and total_iters < self.max_total_iters:
-                ''' Sample more points proportional to the current error bound'''
-
-                N = self.N_samples_eval
-
-                bins = z_vals
-                error_per_section = torch.exp(-d_star / beta.unsqueeze(-1)) * (dists[:,:-1] ** 2.) / (4 * beta.unsqueeze(-1) ** 2)
-                error_integral = torch.cumsum(error_per_section, dim=-1)
-                bound_opacity = (torch.clamp(torch.exp(error_integral),max=1.e6) - 1.0) * transmittance[:,:-1]
-
-                pdf = bound_opacity + self.add_tiny
-                pdf = pdf / torch.sum(pdf, -1, keepdim=True)
-                cdf = torch.cumsum(pdf, -1)
-                cdf = torch.cat([torch.zeros_like(cdf[..., :1]), cdf], -1)
-
-            else:
-                ''' Sample the final sample set to be used in the volume rendering integral '''
-
-                N = self.N_samples
-
-                bins = z_vals
-                pdf = weights[..., :-1]
-                pdf = pdf + 1e-5  # prevent nans
-                pdf = pdf / torch.sum(pdf, -1, keepdim=True)
-                cdf = torch.cumsum(pdf, -1)
-                cdf = torch.cat([torch.zeros_like(cdf[..., :1]), cdf], -1)  # (batch, len(bins))
-
-
-            # Invert CDF
-            if (not_converge and total_iters < self.max_total_iters) or (not model.training):
-                u = torch.linspace(0., 1., steps=N).cuda().unsqueeze(0).repeat(cdf.shape[0], 1)
-            else:
-                u = torch.rand(list(cdf.shape[:-1]) + [N]).cuda()
-            u = u.contiguous()
-
-            inds = torch.searchsorted(cdf, u, right=True)
-            below = torch.max(torch.zeros_like(inds - 1), inds - 1)
-            above = torch.min((cdf.shape[-1] - 1) * torch.ones_like(inds), inds)
-            inds_g = torch.stack([below, above], -1)  # (batch, N_samples, 2)
-
-            matched_shape = [inds_g.shape[0], inds_g.shape[1], cdf.shape[-1]]
-            cdf_g = torch.gather(cdf.unsqueeze(1).expand(matched_shape), 2, inds_g)
-            bins_g = torch.gather(bins.unsqueeze(1).expand(matched_shape), 2, inds_g)
-
-            denom = (cdf_g[..., 1] - cdf_g[..., 0])
-            denom = torch.where(denom < 1e-5, torch.ones_like(denom), denom)
-            t = (u - cdf_g[..., 0]) / denom
-            samples = bins_g[..., 0] + t * (bins_g[..., 1] - bins_g[..., 0])
-
-
-            # Adding samples if we not converged
-            if not_converge and total_iters < self.max_total_iters:
-                z_vals, samples_idx = torch.sort(torch.cat([z_vals, samples], -1), -1)
+            with profiler.stage('ray_sampler_iteration'):
+                points = cam_loc.unsqueeze(1) + samples.unsqueeze(2) * ray_dirs.unsqueeze(1)
+                points_flat = points.reshape(-1, 3)
+                samples_frame_idx = None if frame_idx is None else frame_idx.repeat_interleave(samples.shape[1])
+                # Calculating the SDF only for the new sampled points
+                model.implicit_network.eval()
+                with torch.no_grad():
+                    if samples_idx is None and use_occupancy:
+                        # skip the empty part of the uniform samples, only valid for the cond the grid was built with
+                        samples_sdf, samples_x_c, samples_evaluated = model.sdf_func_with_occupancy(points_flat, cond, smpl_tfs, smpl_verts=smpl_verts,
+                                                                                                    frame_idx=samples_frame_idx)
+                    else:
+                        samples_sdf, samples_x_c, _ = model.sdf_func_with_smpl_deformer(points_flat, cond, smpl_tfs, smpl_verts=smpl_verts,
+                                                                                        frame_idx=samples_frame_idx)
+                        samples_evaluated = torch.ones_like(samples_sdf[:, 0], dtype=torch.bool)
+                model.implicit_network.train()
+                if samples_idx is not None:
+                    sdf_merge = torch.cat([sdf.reshape(-1, z_vals.shape[1] - samples.shape[1]),
+                                           samples_sdf.reshape(-1, samples.shape[1])], -1)
+                    sdf = torch.gather(sdf_merge, 1, samples_idx).reshape(-1, 1)
+                    if return_cache:
+                        x_c_merge = torch.cat([x_c.reshape(-1, z_vals.shape[1] - samples.shape[1], 3),
+                                               samples_x_c.reshape(-1, samples.shape[1], 3)], 1)
+                        x_c = torch.gather(x_c_merge, 1, samples_idx.unsqueeze(-1).expand(-1, -1, 3)).reshape(-1, 3)
+                        evaluated_merge = torch.cat([evaluated.reshape(-1, z_vals.shape[1] - samples.shape[1]),
+                                                     samples_evaluated.reshape(-1, samples.shape[1])], -1)
+                        evaluated = torch.gather(evaluated_merge, 1, samples_idx).reshape(-1)
+                else:
+                    sdf = samples_sdf
+                    x_c = samples_x_c
+                    evaluated = samples_evaluated
+
+
+                # Calculating the bound d* (Theorem 1)
+                d = sdf.reshape(z_vals.shape)
+                dists = z_vals[:, 1:] - z_vals[:, :-1]
+                a, b, c = dists, d[:, :-1].abs(), d[:, 1:].abs()
+                first_cond = a.pow(2) + b.pow(2) <= c.pow(2)
+                second_cond = a.pow(2) + c.pow(2) <= b.pow(2)
+                d_star = torch.zeros(z_vals.shape[0], z_vals.shape[1] - 1, device=z_vals.device)
+                d_star[first_cond] = b[first_cond]
+                d_star[second_cond] = c[second_cond]
+                s = (a + b + c) / 2.0
+                area_before_sqrt = s * (s - a) * (s - b) * (s - c)
+                mask = ~first_cond & ~second_cond & (b + c - a > 0)
+                d_star[mask] = (2.0 * torch.sqrt(area_before_sqrt[mask])) / (a[mask])
+                d_star = (d[:, 1:].sign() * d[:, :-1].sign() == 1) * d_star  # Fixing the sign
+
+
+                # Updating beta using line search
+                curr_error = self.get_error_bound(beta0.expand(z_vals.shape[0], 1), model, d, dists, d_star)[:, 0]
+                converged = curr_error <= self.eps
+                beta[converged] = beta0
+                # the search interval of converged rays is empty, only search the others
+                if not converged.all():
+                    beta[~converged] = self.beta_line_search(beta0, beta[~converged], model,
+                                                             d[~converged], dists[~converged], d_star[~converged])
+
+
+                # Upsample more points
+                density = model.density(sdf.reshape(z_vals.shape), beta=beta.unsqueeze(-1))
+
+                dists = torch.cat([dists, torch.full((dists.shape[0], 1), 1e10, device=dists.device)], -1)
+                free_energy = dists * density
+                shifted_free_energy = torch.cat([torch.zeros(dists.shape[0], 1, device=dists.device), free_energy[:, :-1]], dim=-1)
+                alpha = 1 - torch.exp(-free_energy)
+                transmittance = torch.exp(-torch.cumsum(shifted_free_energy, dim=-1))
+                weights = alpha * transmittance  # probability of the ray hits something here
+
+                # Check if we are done and this is the last sampling
+                total_iters += 1
+                not_converge = beta.max() > beta0
+
+                if not_converge and total_iters < self.max_total_iters:
+                    ''' Sample more points proportional to the current error bound'''
+
+                    N = self.N_samples_eval
+
+                    bins = z_vals
+                    error_per_section = torch.exp(-d_star / beta.unsqueeze(-1)) * (dists[:,:-1] ** 2.) / (4 * beta.unsqueeze(-1) ** 2)
+                    error_integral = torch.cumsum(error_per_section, dim=-1)
+                    bound_opacity = (torch.clamp(torch.exp(error_integral),max=1.e6) - 1.0) * transmittance[:,:-1]
+
+                    pdf = bound_opacity + self.add_tiny
+                    pdf = pdf / torch.sum(pdf, -1, keepdim=True)
+                    cdf = torch.cumsum(pdf, -1)
+                    cdf = torch.cat([torch.zeros_like(cdf[..., :1]), cdf], -1)
+
+                else:
+                    ''' Sample the final sample set to be used in the volume rendering integral '''
+
+                    N = self.N_samples
+
+                    bins = z_vals
+                    pdf = weights[..., :-1]
+                    pdf = pdf + 1e-5  # prevent nans
+                    pdf = pdf / torch.sum(pdf, -1, keepdim=True)
+                    cdf = torch.cumsum(pdf, -1)
+                    cdf = torch.cat([torch.zeros_like(cdf[..., :1]), cdf], -1)  # (batch, len(bins))
+
+
+                # Invert CDF
+                if (not_converge and total_iters < self.max_total_iters) or (not model.training):
+                    u = torch.linspace(0., 1., steps=N, device=cdf.device).unsqueeze(0).repeat(cdf.shape[0], 1)
+                else:
+                    u = torch.rand(list(cdf.shape[:-1]) + [N], device=cdf.device)
+                u = u.contiguous()
+
+                inds = torch.searchsorted(cdf, u, right=True)
+                below = torch.max(torch.zeros_like(inds - 1), inds - 1)
+                above = torch.min((cdf.shape[-1] - 1) * torch.ones_like(inds), inds)
+                inds_g = torch.stack([below, above], -1)  # (batch, N_samples, 2)
+
+                matched_shape = [inds_g.shape[0], inds_g.shape[1], cdf.shape[-1]]
+                cdf_g = torch.gather(cdf.unsqueeze(1).expand(matched_shape), 2, inds_g)
+                bins_g = torch.gather(bins.unsqueeze(1).expand(matched_shape), 2, inds_g)
+
+                denom = (cdf_g[..., 1] - cdf_g[..., 0])
+                denom = torch.where(denom < 1e-5, torch.ones_like(denom), denom)
+                t = (u - cdf_g[..., 0]) / denom
+                samples = bins_g[..., 0] + t * (bins_g[..., 1] - bins_g[..., 0])
+
+
+                # Adding samples if we not converged
+                if not_converge and total_iters < self.max_total_iters:
+                    z_vals, samples_idx = torch.sort(torch.cat([z_vals, samples], -1), -1)
 
 
         z_samples = samples
 
-        near, far = self.near * torch.ones(ray_dirs.shape[0], 1).cuda(), self.far * torch.ones(ray_dirs.shape[0],1).cuda()
+        near, far = self.near * torch.ones(ray_dirs.shape[0], 1, device=ray_dirs.device), self.far * torch.ones(ray_dirs.shape[0], 1, device=ray_dirs.device)
         if self.inverse_sphere_bg: # if inverse sphere then need to add the far sphere intersection
             far = utils.get_sphere_intersections(cam_loc, ray_dirs, r=self.scene_bounding_sphere)[:,1:]
 
@@ -204,29 +223,71 @@ class ErrorBoundSampler(RaySampler):
                 sampling_idx = torch.linspace(0, z_vals.shape[1]-1, self.N_samples_extra).long()
             z_vals_extra = torch.cat([near, far, z_vals[:,sampling_idx]], -1)
         else:
+            sampling_idx = torch.zeros(0, dtype=torch.long)
             z_vals_extra = torch.cat([near, far], -1)
 
-        z_vals, _ = torch.sort(torch.cat([z_samples, z_vals_extra], -1), -1)
+        sdf = sdf.reshape(z_vals.shape)
+        z_vals, sort_idx = torch.sort(torch.cat([z_samples, z_vals_extra], -1), -1)
+
+        if return_cache:
+            # only the extra samples taken from z_vals have been evaluated above, minus those skipped by the occupancy grid
+            num_uncached = z_samples.shape[1] + 2
+            sdf_cache = torch.cat([torch.zeros(z_vals.shape[0], num_uncached, device=sdf.device), sdf[:, sampling_idx]], -1)
+            x_c = x_c.reshape(z_vals.shape[0], -1, 3)
+            x_c_cache = torch.cat([torch.zeros(z_vals.shape[0], num_uncached, 3, device=x_c.device), x_c[:, sampling_idx]], 1)
+            evaluated = evaluated.reshape(z_vals.shape[0], -1)
+            evaluated_cache = torch.cat([torch.zeros(z_vals.shape[0], num_uncached, dtype=torch.bool, device=evaluated.device),
+                                         evaluated[:, sampling_idx]], -1)
+            sample_cache = {
+                'mask': torch.gather(evaluated_cache, 1, sort_idx),
+                'sdf': torch.gather(sdf_cache, 1, sort_idx).unsqueeze(-1),
+                'canonical_points': torch.gather(x_c_cache, 1, sort_idx.unsqueeze(-1).expand(-1, -1, 3)),
+            }
 
         # add some of the near surface points
-        idx = torch.randint(z_vals.shape[-1], (z_vals.shape[0],)).cuda()
+        idx = torch.randint(z_vals.shape[-1], (z_vals.shape[0],), device=z_vals.device)
         z_samples_eik = torch.gather(z_vals, 1, idx.unsqueeze(-1))
 
         if self.inverse_sphere_bg:
-            z_vals_inverse_sphere = self.inverse_sphere_sampler.get_z_vals(ray_dirs, cam_loc, model)
-            z_vals_inverse_sphere = z_vals_inverse_sphere * (1./self.scene_bounding_sphere)
+            z_vals_inverse_sphere = self.get_z_vals_bg(ray_dirs, cam_loc, model)
             z_vals = (z_vals, z_vals_inverse_sphere)
 
+        if return_cache:
+            return z_vals, z_samples_eik, sample_cache
         return z_vals, z_samples_eik
 
-    def get_error_bound(self, beta, model, sdf, z_vals, dists, d_star):
-        density = model.density(sdf.reshape(z_vals.shape), beta=beta)
-        shifted_free_energy = torch.cat([torch.zeros(dists.shape[0], 1).cuda(), dists * density[:, :-1]], dim=-1)
+    def get_z_vals_bg(self, ray_dirs, cam_loc, model):
+        z_vals_inverse_sphere = self.inverse_sphere_sampler.get_z_vals(ray_dirs, cam_loc, model)
+        return z_vals_inverse_sphere * (1./self.scene_bounding_sphere)
+
+    def beta_line_search(self, beta0, beta_max, model, sdf, dists, d_star):
+        """Bisection for the smallest beta in [beta0, beta_max] meeting the error bound,
+        resolving beta_search_bits bisection steps per batched evaluation of 2^bits - 1 betas."""
+        beta_min = beta0.expand_as(beta_max)
+        iters = self.beta_iters
+        while iters > 0:
+            bits = min(self.beta_search_bits, iters)
+            iters -= bits
+            steps = torch.arange(1, 2 ** bits, device=beta_max.device) / 2 ** bits
+            candidates = beta_min.unsqueeze(-1) * (1 - steps) + beta_max.unsqueeze(-1) * steps
+            curr_error = self.get_error_bound(candidates, model, sdf, dists, d_star)
+            # number of candidates before the first one meeting the bound
+            first = (torch.cumsum(curr_error <= self.eps, dim=-1) == 0).sum(-1, keepdim=True)
+            bounds = torch.cat([beta_min.unsqueeze(-1), candidates, beta_max.unsqueeze(-1)], -1)
+            beta_min = torch.gather(bounds, 1, first).squeeze(-1)
+            beta_max = torch.gather(bounds, 1, first + 1).squeeze(-1)
+        return beta_max
+
+    def get_error_bound(self, beta, model, sdf, dists, d_star):
+        """Maximum error bound of each ray (Theorem 1) for each of the C betas in beta [rays, C]."""
+        beta = beta.unsqueeze(-1)
+        sdf, dists, d_star = sdf.unsqueeze(1), dists.unsqueeze(1), d_star.unsqueeze(1)
+        density = model.density(sdf, beta=beta)
+        free_energy = dists * density[..., :-1]
+        shifted_free_energy = torch.cat([torch.zeros_like(free_energy[..., :1]), free_energy], dim=-1)
         integral_estimation = torch.cumsum(shifted_free_energy, dim=-1)
         error_per_section = torch.exp(-d_star / beta) * (dists ** 2.) / (4 * beta ** 2)
         error_integral = torch.cumsum(error_per_section, dim=-1)
-        bound_opacity = (torch.clamp(torch.exp(error_integral), max=1.e6) - 1.0) * torch.exp(-integral_estimation[:, :-1])
+        bound_opacity = (torch.clamp(torch.exp(error_integral), max=1.e6) - 1.0) * torch.exp(-integral_estimation[..., :-1])
 
         return bound_opacity.max(-1)[0]
-
-
@@ -5,7 +5,7 @@ from ..smpl.body_models import SMPL
 
 class SMPLServer(torch.nn.Module):
 
-    def __init__(self, gender='neutral', betas=None, v_template=None):
+    def __init__(self, gender='neutral', betas=None, v_template=None, device='cuda'):
         super().__init__()
 
 
@@ -14,7 +14,7 @@ class SMPLServer(torch.nn.Module):
                          batch_size=1,
                          use_hands=False,
                          use_feet_keypoints=False,
-                         dtype=torch.float32).cuda()
+                         dtype=torch.float32).to(device)
 
         self.bone_parents = self.smpl.bone_parents.astype(int)
         self.bone_parents[0] = -1
@@ -23,17 +23,20 @@ class SMPLServer(torch.nn.Module):
         for i in range(24): self.bone_ids.append([self.bone_parents[i], i])
 
         if v_template is not None:
-            self.v_template = torch.tensor(v_template).float().cuda()
+            self.v_template = torch.tensor(v_template, dtype=torch.float32, device=device)
         else:
             self.v_template = None
 
         if betas is not None:
-            self.betas = torch.tensor(betas).float().cuda()
+            self.betas = torch.tensor(betas, dtype=torch.float32, device=device)
         else:
             self.betas = None
 
+        # shaped template and joints of the last betas, see get_shape
+        self.shape_cache = None
+
         # define the canonical pose
-        param_canonical = torch.zeros((1, 86),dtype=torch.float32).cuda()
+        param_canonical = torch.zeros((1, 86),dtype=torch.float32, device=device)
         param_canonical[0, 0] = 1
         param_canonical[0, 9] = np.pi / 6
         param_canonical[0, 12] = -np.pi / 6
@@ -47,7 +50,21 @@ class SMPLServer(torch.nn.Module):
         self.tfs_c_inv = output['smpl_tfs'].squeeze(0).inverse()
 
 
-    def forward(self, scale, transl, thetas, betas, absolute=False):
+    def get_shape(self, betas):
+        """Shaped template and its joints for betas, reused while betas stay the same.
+        Returns None, None if betas require grad, then lbs recomputes them in the graph.
+        """
+        if betas.requires_grad and torch.is_grad_enabled():
+            return None, None
+        cache = self.shape_cache
+        if cache is None or cache['betas'].shape != betas.shape or cache['betas'].device != betas.device \
+                or not torch.equal(cache['betas'], betas):
+            v_shaped, joints = self.smpl.get_shape(betas, v_template=self.v_template)
+            cache = {'betas': betas.detach().clone(), 'v_shaped': v_shaped, 'joints': joints}
+            self.shape_cache = cache
+        return cache['v_shaped'], cache['joints']
+
+    def forward(self, scale, transl, thetas, betas, absolute=False, return_verts=True):
         """return SMPL output from params
         Args:
             scale : scale factor. shape: [B, 1]
@@ -55,6 +72,7 @@ class SMPLServer(torch.nn.Module):
             thetas: pose. shape: [B, 72]
             betas: shape. shape: [B, 10]
             absolute (bool): if true return smpl_tfs wrt thetas=0. else wrt thetas=thetas_canonical. 
+            return_verts (bool): if false only return smpl_tfs and smpl_jnts, skipping pose blend shapes and skinning.
         Returns:
             smpl_verts: vertices. shape: [B, 6893. 3]
             smpl_tfs: bone transformations. shape: [B, 24, 4, 4]
@@ -67,17 +85,20 @@ class SMPLServer(torch.nn.Module):
         if self.v_template is not None:
             betas = torch.zeros_like(betas)
 
-        
+        v_shaped, joints_shaped = self.get_shape(betas)
         smpl_output = self.smpl.forward(betas=betas,
                                         transl=torch.zeros_like(transl),
                                         body_pose=thetas[:, 3:],
                                         global_orient=thetas[:, :3],
-                                        return_verts=True,
+                                        return_verts=return_verts,
                                         return_full_pose=True,
-                                        v_template=self.v_template)
+                                        v_template=self.v_template,
+                                        v_shaped=v_shaped,
+                                        joints_shaped=joints_shaped)
 
-        verts = smpl_output.vertices.clone()
-        output['smpl_verts'] = verts * scale.unsqueeze(1) + transl.unsqueeze(1) * scale.unsqueeze(1)
+        if return_verts:
+            verts = smpl_output.vertices.clone()
+            output['smpl_verts'] = verts * scale.unsqueeze(1) + transl.unsqueeze(1) * scale.unsqueeze(1)
 
         joints = smpl_output.joints.clone()
         output['smpl_jnts'] = joints * scale.unsqueeze(1) + transl.unsqueeze(1) * scale.unsqueeze(1)
@@ -90,5 +111,6 @@ class SMPLServer(torch.nn.Module):
             tf_mats = torch.einsum('bnij,njk->bnik', tf_mats, self.tfs_c_inv)
         
         output['smpl_tfs'] = tf_mats
-        output['smpl_weights'] = smpl_output.weights
+        if return_verts:
+            output['smpl_weights'] = smpl_output.weights
         return output
\ No newline at end of file
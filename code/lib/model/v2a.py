@@ -3,20 +3,22 @@ from .density import LaplaceDensity, AbsDensity
 from .ray_sampler import ErrorBoundSampler
 from .deformer import SMPLDeformer
 from .smpl import SMPLServer
+from .occupancy_grid import OccupancyGrid
+from .mesh_sdf_grid import MeshSDFGrid, mesh_signed_distance
 
 from .sampler import PointInSpace
 
 from ..utils import utils
+from ..utils.profiler import profiler
 
 import numpy as np
 import torch
 import torch.nn as nn
 from torch.autograd import grad
 import hydra
-import kaolin
 from kaolin.ops.mesh import index_vertices_by_faces
 class V2A(nn.Module):
-    def __init__(self, opt, betas_path, gender, num_training_frames):
+    def __init__(self, opt, betas_path, gender, num_training_frames, device='cuda'):
         super().__init__()
 
         # Foreground networks
@@ -35,35 +37,64 @@ class V2A(nn.Module):
         self.use_smpl_deformer = opt.use_smpl_deformer
         self.gender = gender
         if self.use_smpl_deformer:
-            self.deformer = SMPLDeformer(betas=betas, gender=self.gender)
+            self.deformer = SMPLDeformer(betas=betas, gender=self.gender, device=device, **opt.deformer)
         
         # pre-defined bounding sphere
         self.sdf_bounding_sphere = 3.0
         
         # threshold for the out-surface points
         self.threshold = 0.05
+
+        # compute the deformation Jacobian in closed form instead of with three autograd passes
+        self.analytic_jacobian = opt.analytic_jacobian
+
+        # skip the foreground branch at inference for rays missing the padded SMPL bounding box
+        self.ray_culling = opt.ray_culling
+        self.ray_culling_padding = opt.ray_culling_padding
+        self.early_termination = opt.early_termination
+        self.early_termination_opacity = opt.early_termination_opacity
         
         self.density = LaplaceDensity(**opt.density)
         self.bg_density = AbsDensity()
 
         self.ray_sampler = ErrorBoundSampler(self.sdf_bounding_sphere, inverse_sphere_bg=True, **opt.ray_sampler)
-        self.smpl_server = SMPLServer(gender=self.gender, betas=betas)
+        self.smpl_server = SMPLServer(gender=self.gender, betas=betas, device=device)
 
         if opt.smpl_init:
-            smpl_model_state = torch.load(hydra.utils.to_absolute_path('../assets/smpl_init.pth'))
+            smpl_model_state = torch.load(hydra.utils.to_absolute_path('../assets/smpl_init.pth'), map_location=device)
             self.implicit_network.load_state_dict(smpl_model_state["model_state_dict"])
 
         self.smpl_v_cano = self.smpl_server.verts_c
         self.smpl_f_cano = torch.tensor(self.smpl_server.smpl.faces.astype(np.int64), device=self.smpl_v_cano.device)
 
-        self.mesh_v_cano = self.smpl_server.verts_c
-        self.mesh_f_cano = torch.tensor(self.smpl_server.smpl.faces.astype(np.int64), device=self.smpl_v_cano.device)
-        self.mesh_face_vertices = index_vertices_by_faces(self.mesh_v_cano, self.mesh_f_cano)
+        # signed distance to the canonical mesh baked on a grid, exact distances are used if it is not accurate enough
+        if opt.cano_mesh_sdf.mode == 'grid':
+            self.cano_mesh_sdf_grid = MeshSDFGrid(resolution=opt.cano_mesh_sdf.resolution,
+                                                  padding=opt.cano_mesh_sdf.padding,
+                                                  band=self.threshold,
+                                                  max_error=opt.cano_mesh_sdf.max_error).to(device)
+        elif opt.cano_mesh_sdf.mode == 'exact':
+            self.cano_mesh_sdf_grid = None
+        else:
+            raise ValueError(f'Unknown canonical mesh SDF mode {opt.cano_mesh_sdf.mode}')
+        self.update_cano_mesh(self.smpl_server.verts_c, torch.tensor(self.smpl_server.smpl.faces.astype(np.int64), device=self.smpl_v_cano.device),
+                              is_template=True)
+
+        # canonical occupancy used by the ray sampler to skip the SDF of empty uniform samples
+        if opt.occupancy_grid.enabled:
+            verts_c = self.smpl_server.verts_c[0]
+            self.occupancy_grid = OccupancyGrid(verts_c.min(dim=0)[0] - opt.occupancy_grid.padding,
+                                                verts_c.max(dim=0)[0] + opt.occupancy_grid.padding,
+                                                resolution=opt.occupancy_grid.resolution,
+                                                threshold=opt.occupancy_grid.threshold)
+        else:
+            self.occupancy_grid = None
 
-    def sdf_func_with_smpl_deformer(self, x, cond, smpl_tfs, smpl_verts):
+    def sdf_func_with_smpl_deformer(self, x, cond, smpl_tfs, smpl_verts, frame_idx=None):
         if hasattr(self, "deformer"):
-            x_c, outlier_mask = self.deformer.forward(x, smpl_tfs, return_weights=False, inverse=True, smpl_verts=smpl_verts)
-            output = self.implicit_network(x_c, cond)[0]
+            x_c, outlier_mask = self.deformer.forward(x, smpl_tfs, return_weights=False, inverse=True, smpl_verts=smpl_verts, frame_idx=frame_idx)
+            with profiler.stage('implicit_network'):
+                output = self.implicit_network(x_c, cond, frame_idx=frame_idx)[0]
             sdf = output[:, 0:1]
             feature = output[:, 1:]
             if not self.training:
@@ -71,14 +102,54 @@ class V2A(nn.Module):
             
         return sdf, x_c, feature
     
-    def check_off_in_surface_points_cano_mesh(self, x_cano, N_samples, threshold=0.05):
+    @staticmethod
+    def is_zero_pose_epoch(epoch):
+        """Whether training conditions the implicit network on the zero pose in this epoch."""
+        return epoch < 20 or epoch % 20 == 0
+
+    def sdf_func_with_occupancy(self, x, cond, smpl_tfs, smpl_verts, frame_idx=None):
+        """Like sdf_func_with_smpl_deformer, but the implicit network is only evaluated on points in
+        occupied cells. The others get the SDF lower bound of empty cells, at which the density is negligible.
+        Returns the SDF, the canonical points and the mask of evaluated points."""
+        x_c, outlier_mask = self.deformer.forward(x, smpl_tfs, return_weights=False, inverse=True, smpl_verts=smpl_verts, frame_idx=frame_idx)
+        occupied = self.occupancy_grid.query(x_c)
+        sdf = self.occupancy_grid.empty_sdf.expand(x.shape[0], 1).clone()
+        if occupied.any():
+            with profiler.stage('implicit_network'):
+                sdf[occupied] = self.implicit_network(x_c[occupied], cond,
+                                                      frame_idx=None if frame_idx is None else frame_idx[occupied])[0][:, 0:1]
+        if not self.training:
+            sdf[outlier_mask] = 4. # set a large SDF value for outlier points
+        return sdf, x_c, occupied
+
+    def sdf_func_with_sample_cache(self, x, cond, smpl_tfs, smpl_verts, sample_cache, frame_idx=None):
+        """SDF and canonical points of x, taking the samples already evaluated by the ray sampler from its cache."""
+        cached = sample_cache['mask'][:, :-1].reshape(-1)
+        sdf = sample_cache['sdf'][:, :-1].reshape(-1, 1).clone()
+        x_c = sample_cache['canonical_points'][:, :-1].reshape(-1, 3).clone()
+        if not cached.all():
+            sdf[~cached], x_c[~cached], _ = self.sdf_func_with_smpl_deformer(x[~cached], cond, smpl_tfs, smpl_verts,
+                                                                              frame_idx=None if frame_idx is None else frame_idx[~cached])
+        return sdf, x_c
+
+    def update_cano_mesh(self, verts, faces, is_template=False):
+        """Set the canonical mesh verts [1, V, 3], faces [F, 3] and rebake its SDF grid.
+        is_template marks the SMPL template, which is not an extracted surface to track.
+        Returns the error of the grid near the threshold band, or None without grid."""
+        self.cano_mesh_is_template = is_template
+        self.mesh_v_cano = verts
+        self.mesh_f_cano = faces
+        self.mesh_face_vertices = index_vertices_by_faces(self.mesh_v_cano, self.mesh_f_cano)
+        if self.cano_mesh_sdf_grid is not None:
+            return self.cano_mesh_sdf_grid.bake(self.mesh_v_cano, self.mesh_f_cano, self.mesh_face_vertices)
 
-        distance, _, _ = kaolin.metrics.trianglemesh.point_to_mesh_distance(x_cano.unsqueeze(0).contiguous(), self.mesh_face_vertices)
+    def check_off_in_surface_points_cano_mesh(self, x_cano, N_samples, threshold=0.05):
 
-        distance = torch.sqrt(distance) # kaolin outputs squared distance
-        sign = kaolin.ops.mesh.check_sign(self.mesh_v_cano, self.mesh_f_cano, x_cano.unsqueeze(0)).float()
-        sign = 1 - 2 * sign
-        signed_distance = sign * distance
+        if self.cano_mesh_sdf_grid is not None and self.cano_mesh_sdf_grid.accurate:
+            signed_distance = self.cano_mesh_sdf_grid.query(x_cano)
+        else:
+            with torch.no_grad():
+                signed_distance = mesh_signed_distance(x_cano, self.mesh_v_cano, self.mesh_f_cano, self.mesh_face_vertices)
         batch_size = x_cano.shape[0] // N_samples
         signed_distance = signed_distance.reshape(batch_size, N_samples, 1)
 
@@ -98,21 +169,43 @@ class V2A(nn.Module):
         smpl_pose = input["smpl_pose"]
         smpl_shape = input["smpl_shape"]
         smpl_trans = input["smpl_trans"]
-        smpl_output = self.smpl_server(scale, smpl_trans, smpl_pose, smpl_shape)
+        with profiler.stage('smpl_server'):
+            smpl_output = self.smpl_server(scale, smpl_trans, smpl_pose, smpl_shape)
 
         smpl_tfs = smpl_output['smpl_tfs']
 
         cond = {'smpl': smpl_pose[:, 3:]/np.pi}
-        if self.training:
-            if input['current_epoch'] < 20 or input['current_epoch'] % 20 == 0:
-                cond = {'smpl': smpl_pose[:, 3:] * 0.}
-        ray_dirs, cam_loc = utils.get_camera_params(uv, pose, intrinsics)
+        zero_pose_cond = self.training and self.is_zero_pose_epoch(input['current_epoch'])
+        if zero_pose_cond:
+            cond = {'smpl': smpl_pose[:, 3:] * 0.}
+        # the occupancy grid is built with the zero pose cond, a cell empty for it may be occupied for another pose
+        use_occupancy = self.occupancy_grid is not None and zero_pose_cond
+        with profiler.stage('ray_generation'):
+            ray_dirs, cam_loc = utils.get_camera_params(uv, pose, intrinsics)
         batch_size, num_pixels, _ = ray_dirs.shape
 
         cam_loc = cam_loc.unsqueeze(1).repeat(1, num_pixels, 1).reshape(-1, 3)
         ray_dirs = ray_dirs.reshape(-1, 3)
 
-        z_vals, _ = self.ray_sampler.get_z_vals(ray_dirs, cam_loc, self, cond, smpl_tfs, eval_mode=True, smpl_verts=smpl_output['smpl_verts'])
+        # frame of each ray when the batch mixes rays of several frames
+        if batch_size > 1:
+            ray_frame_idx = torch.arange(batch_size, device=ray_dirs.device).repeat_interleave(num_pixels)
+        else:
+            ray_frame_idx = None
+
+        if self.ray_culling and not self.training and batch_size == 1 and input.get('ray_culling', True):
+            fg_mask = self.get_fg_ray_mask(cam_loc, ray_dirs, smpl_output['smpl_verts'][0])
+            if not fg_mask.all():
+                return self.forward_culled(input, fg_mask, cam_loc, ray_dirs)
+
+        with profiler.stage('ray_sampler'):
+            if self.training:
+                z_vals, _ = self.ray_sampler.get_z_vals(ray_dirs, cam_loc, self, cond, smpl_tfs, eval_mode=True, smpl_verts=smpl_output['smpl_verts'],
+                                                        frame_idx=ray_frame_idx, use_occupancy=use_occupancy)
+            else:
+                z_vals, _, sample_cache = self.ray_sampler.get_z_vals(ray_dirs, cam_loc, self, cond, smpl_tfs, eval_mode=True,
+                                                                      smpl_verts=smpl_output['smpl_verts'], return_cache=True,
+                                                                      frame_idx=ray_frame_idx, use_occupancy=use_occupancy)
 
         z_vals, z_vals_bg = z_vals
         z_max = z_vals[:,-1]
@@ -123,82 +216,84 @@ class V2A(nn.Module):
         points_flat = points.reshape(-1, 3)
 
         dirs = ray_dirs.unsqueeze(1).repeat(1,N_samples,1)
-        sdf_output, canonical_points, feature_vectors = self.sdf_func_with_smpl_deformer(points_flat, cond, smpl_tfs, smpl_output['smpl_verts'])
+        frame_idx = None if ray_frame_idx is None else ray_frame_idx.repeat_interleave(N_samples)
+        if self.training:
+            sdf_output, canonical_points, feature_vectors = self.sdf_func_with_smpl_deformer(points_flat, cond, smpl_tfs, smpl_output['smpl_verts'],
+                                                                                             frame_idx=frame_idx)
+        else:
+            # no gradients are needed through the SDF at inference, only evaluate the samples the sampler has not
+            sdf_output, canonical_points = self.sdf_func_with_sample_cache(points_flat, cond, smpl_tfs, smpl_output['smpl_verts'], sample_cache,
+                                                                           frame_idx=frame_idx)
+            # get_rbg_value recomputes the features at the canonical points
+            feature_vectors = None
 
         sdf_output = sdf_output.unsqueeze(1)
 
         if self.training:
             index_off_surface, index_in_surface = self.check_off_in_surface_points_cano_mesh(canonical_points, N_samples, threshold=self.threshold)
-            canonical_points = canonical_points.reshape(num_pixels, N_samples, 3) 
+            canonical_points = canonical_points.reshape(-1, N_samples, 3) 
 
             canonical_points = canonical_points.reshape(-1, 3)
 
             # sample canonical SMPL surface pnts for the eikonal loss
             smpl_verts_c = self.smpl_server.verts_c.repeat(batch_size, 1,1)
             
-            indices = torch.randperm(smpl_verts_c.shape[1])[:num_pixels].cuda()
+            indices = torch.randperm(smpl_verts_c.shape[1], device=smpl_verts_c.device)[:num_pixels]
             verts_c = torch.index_select(smpl_verts_c, 1, indices)
             sample = self.sampler.get_points(verts_c, global_ratio=0.)
 
             sample.requires_grad_()
-            local_pred = self.implicit_network(sample, cond)[..., 0:1]
+            with profiler.stage('implicit_network'):
+                local_pred = self.implicit_network(sample, cond)[..., 0:1]
             grad_theta = gradient(sample, local_pred)
 
             differentiable_points = canonical_points 
 
         else:
-            differentiable_points = canonical_points.reshape(num_pixels, N_samples, 3).reshape(-1, 3)
+            differentiable_points = canonical_points.reshape(-1, N_samples, 3).reshape(-1, 3)
             grad_theta = None
 
-        sdf_output = sdf_output.reshape(num_pixels, N_samples, 1).reshape(-1, 1)
+        sdf_output = sdf_output.reshape(-1, N_samples, 1).reshape(-1, 1)
         z_vals = z_vals
         view = -dirs.reshape(-1, 3) 
 
-        if differentiable_points.shape[0] > 0:
+        weights, bg_transmittance = self.volume_rendering(z_vals, z_max, sdf_output)
+        early_termination = self.early_termination and not self.training
+
+        if early_termination:
+            # only shade the samples in front of the saturated part of each ray
+            active = self.get_active_samples(weights).reshape(-1)
+            fg_rgb_flat = torch.zeros_like(points_flat)
+            normal_values = torch.zeros_like(points_flat)
+            if active.any():
+                fg_rgb_active, others = self.get_rbg_value(points_flat[active], differentiable_points[active], view[active],
+                                                           cond, smpl_tfs, feature_vectors=None, is_training=False,
+                                                           frame_idx=None if frame_idx is None else frame_idx[active])
+                fg_rgb_flat[active] = fg_rgb_active
+                normal_values[active] = others['normals']
+        elif differentiable_points.shape[0] > 0:
             fg_rgb_flat, others = self.get_rbg_value(points_flat, differentiable_points, view,
-                                                     cond, smpl_tfs, feature_vectors=feature_vectors, is_training=self.training)                  
+                                                     cond, smpl_tfs, feature_vectors=feature_vectors, is_training=self.training,
+                                                     frame_idx=frame_idx)
             normal_values = others['normals']
 
-        if 'image_id' in input.keys():
-            frame_latent_code = self.frame_latent_encoder(input['image_id'])
-        else:
-            frame_latent_code = self.frame_latent_encoder(input['idx'])
-
         fg_rgb = fg_rgb_flat.reshape(-1, N_samples, 3)
         normal_values = normal_values.reshape(-1, N_samples, 3)
-        weights, bg_transmittance = self.volume_rendering(z_vals, z_max, sdf_output)
 
         fg_rgb_values = torch.sum(weights.unsqueeze(-1) * fg_rgb, 1)
 
         # Background rendering
-        if input['idx'] is not None:
-            N_bg_samples = z_vals_bg.shape[1]
-            z_vals_bg = torch.flip(z_vals_bg, dims=[-1, ])  # 1--->0
-
-            bg_dirs = ray_dirs.unsqueeze(1).repeat(1,N_bg_samples,1)
-            bg_locs = cam_loc.unsqueeze(1).repeat(1,N_bg_samples,1)
-
-            bg_points = self.depth2pts_outside(bg_locs, bg_dirs, z_vals_bg)  # [..., N_samples, 4]
-            bg_points_flat = bg_points.reshape(-1, 4)
-            bg_dirs_flat = bg_dirs.reshape(-1, 3)
-            bg_output = self.bg_implicit_network(bg_points_flat, {'frame': frame_latent_code})[0]
-            bg_sdf = bg_output[:, :1]
-            bg_feature_vectors = bg_output[:, 1:]
-            
-            bg_rendering_output = self.bg_rendering_network(None, None, bg_dirs_flat, None, bg_feature_vectors, frame_latent_code)
-            if bg_rendering_output.shape[-1] == 4:
-                bg_rgb_flat = bg_rendering_output[..., :-1]
-                shadow_r = bg_rendering_output[..., -1]
-                bg_rgb = bg_rgb_flat.reshape(-1, N_bg_samples, 3)
-                shadow_r = shadow_r.reshape(-1, N_bg_samples, 1)
-                bg_rgb = (1 - shadow_r) * bg_rgb
+        with profiler.stage('background'):
+            if early_termination:
+                # rays the foreground has made opaque do not see the background
+                bg_mask = bg_transmittance > 1 - self.early_termination_opacity
+                bg_rgb_values = torch.zeros_like(ray_dirs)
+                if bg_mask.any():
+                    bg_rgb_values[bg_mask] = self.get_bg_rgb_values(input, cam_loc[bg_mask], ray_dirs[bg_mask], z_vals_bg[bg_mask],
+                                                                    early_termination=True,
+                                                                    frame_idx=None if ray_frame_idx is None else ray_frame_idx[bg_mask])
             else:
-                bg_rgb_flat = bg_rendering_output
-                bg_rgb = bg_rgb_flat.reshape(-1, N_bg_samples, 3)
-            bg_weights = self.bg_volume_rendering(z_vals_bg, bg_sdf)
-            bg_rgb_values = torch.sum(bg_weights.unsqueeze(-1) * bg_rgb, 1)
-        else:
-            bg_rgb_values = torch.ones_like(fg_rgb_values, device=fg_rgb_values.device)
+                bg_rgb_values = self.get_bg_rgb_values(input, cam_loc, ray_dirs, z_vals_bg, frame_idx=ray_frame_idx)
 
         # Composite foreground and background
         bg_rgb_values = bg_transmittance.unsqueeze(-1) * bg_rgb_values
@@ -230,43 +325,142 @@ class V2A(nn.Module):
             }
         return output
 
-    def get_rbg_value(self, x, points, view_dirs, cond, tfs, feature_vectors, is_training=True):
+    def get_fg_ray_mask(self, cam_loc, ray_dirs, smpl_verts):
+        """Rays intersecting the padded bounding box of the posed SMPL vertices."""
+        bbox_min = smpl_verts.min(dim=0)[0] - self.ray_culling_padding
+        bbox_max = smpl_verts.max(dim=0)[0] + self.ray_culling_padding
+        bbox_intersections = utils.get_bbox_intersections(cam_loc, ray_dirs, bbox_min, bbox_max)
+        return bbox_intersections[:, 1] > bbox_intersections[:, 0]
+
+    def forward_culled(self, input, fg_mask, cam_loc, ray_dirs):
+        """Render rays in fg_mask with the full model and the remaining rays with the
+        background only, i.e. zero foreground weight and full background transmittance."""
+        num_rays = ray_dirs.shape[0]
+        device = ray_dirs.device
+        N_samples = self.ray_sampler.N_samples + self.ray_sampler.N_samples_extra + 1
+        output = {
+            'acc_map': torch.zeros(num_rays, device=device),
+            'rgb_values': torch.zeros(num_rays, 3, device=device),
+            'fg_rgb_values': torch.ones(num_rays, 3, device=device),
+            'normal_values': torch.zeros(num_rays, 3, device=device),
+            'sdf_output': torch.full((num_rays, N_samples, 1), 4., device=device),
+        }
+
+        if fg_mask.any():
+            fg_input = input.copy()
+            fg_input['uv'] = input['uv'][:, fg_mask]
+            fg_input['ray_culling'] = False
+            fg_output = self.forward(fg_input)
+            for k, v in output.items():
+                v[fg_mask] = fg_output[k].reshape(-1, *v.shape[1:])
+
+        bg_mask = ~fg_mask
+        z_vals_bg = self.ray_sampler.get_z_vals_bg(ray_dirs[bg_mask], cam_loc[bg_mask], self)
+        with profiler.stage('background'):
+            output['rgb_values'][bg_mask] = self.get_bg_rgb_values(input, cam_loc[bg_mask], ray_dirs[bg_mask], z_vals_bg,
+                                                                   early_termination=self.early_termination)
+        output['sdf_output'] = output['sdf_output'].reshape(-1, 1)
+        return output
+
+    def get_active_samples(self, weights):
+        """Samples whose accumulated opacity in front of them is still below
+        early_termination_opacity; the rest contribute at most 1 - early_termination_opacity."""
+        opacity = torch.cumsum(weights, dim=-1) - weights
+        return opacity < self.early_termination_opacity
+
+    def get_bg_rgb_values(self, input, cam_loc, ray_dirs, z_vals_bg, early_termination=False, frame_idx=None):
+        if input['idx'] is None:
+            return torch.ones_like(ray_dirs)
+
+        if 'image_id' in input.keys():
+            frame_latent_code = self.frame_latent_encoder(input['image_id'])
+        else:
+            frame_latent_code = self.frame_latent_encoder(input['idx'])
+
+        N_bg_samples = z_vals_bg.shape[1]
+        z_vals_bg = torch.flip(z_vals_bg, dims=[-1, ])  # 1--->0
+
+        bg_dirs = ray_dirs.unsqueeze(1).repeat(1,N_bg_samples,1)
+        bg_locs = cam_loc.unsqueeze(1).repeat(1,N_bg_samples,1)
+
+        bg_points = self.depth2pts_outside(bg_locs, bg_dirs, z_vals_bg)  # [..., N_samples, 4]
+        bg_points_flat = bg_points.reshape(-1, 4)
+        bg_dirs_flat = bg_dirs.reshape(-1, 3)
+        bg_frame_idx = None if frame_idx is None else frame_idx.repeat_interleave(N_bg_samples)
+        bg_output = self.bg_implicit_network(bg_points_flat, {'frame': frame_latent_code}, frame_idx=bg_frame_idx)[0]
+        bg_sdf = bg_output[:, :1]
+        bg_feature_vectors = bg_output[:, 1:]
+
+        bg_weights = self.bg_volume_rendering(z_vals_bg, bg_sdf)
+
+        if early_termination:
+            # bg_implicit_network already ran on every sample, its densities decide where the ray saturates,
+            # so only the rendering network is skipped here. Rays made opaque by the foreground are not
+            # passed in at all and skip both networks.
+            active = self.get_active_samples(bg_weights).reshape(-1)
+            bg_rendering_active = self.bg_rendering_network(None, None, bg_dirs_flat[active], None, bg_feature_vectors[active], frame_latent_code,
+                                                            frame_idx=None if bg_frame_idx is None else bg_frame_idx[active])
+            bg_rendering_output = torch.zeros(bg_dirs_flat.shape[0], bg_rendering_active.shape[-1], device=bg_dirs_flat.device)
+            bg_rendering_output[active] = bg_rendering_active
+        else:
+            bg_rendering_output = self.bg_rendering_network(None, None, bg_dirs_flat, None, bg_feature_vectors, frame_latent_code,
+                                                            frame_idx=bg_frame_idx)
+        if bg_rendering_output.shape[-1] == 4:
+            bg_rgb_flat = bg_rendering_output[..., :-1]
+            shadow_r = bg_rendering_output[..., -1]
+            bg_rgb = bg_rgb_flat.reshape(-1, N_bg_samples, 3)
+            shadow_r = shadow_r.reshape(-1, N_bg_samples, 1)
+            bg_rgb = (1 - shadow_r) * bg_rgb
+        else:
+            bg_rgb_flat = bg_rendering_output
+            bg_rgb = bg_rgb_flat.reshape(-1, N_bg_samples, 3)
+        bg_rgb_values = torch.sum(bg_weights.unsqueeze(-1) * bg_rgb, 1)
+        return bg_rgb_values
+
+    def get_rbg_value(self, x, points, view_dirs, cond, tfs, feature_vectors, is_training=True, frame_idx=None):
         pnts_c = points
         others = {}
 
-        _, gradients, feature_vectors = self.forward_gradient(x, pnts_c, cond, tfs, create_graph=is_training, retain_graph=is_training)
+        with profiler.stage('forward_gradient'):
+            _, gradients, feature_vectors = self.forward_gradient(x, pnts_c, cond, tfs, create_graph=is_training, retain_graph=is_training,
+                                                                  frame_idx=frame_idx)
         # ensure the gradient is normalized
         normals = nn.functional.normalize(gradients, dim=-1, eps=1e-6)
-        fg_rendering_output = self.rendering_network(pnts_c, normals, view_dirs, cond['smpl'],
-                                                     feature_vectors)
+        with profiler.stage('rendering_network'):
+            fg_rendering_output = self.rendering_network(pnts_c, normals, view_dirs, cond['smpl'],
+                                                         feature_vectors, frame_idx=frame_idx)
         
         rgb_vals = fg_rendering_output[:, :3]
         others['normals'] = normals
         return rgb_vals, others
 
-    def forward_gradient(self, x, pnts_c, cond, tfs, create_graph=True, retain_graph=True):
+    def forward_gradient(self, x, pnts_c, cond, tfs, create_graph=True, retain_graph=True, frame_idx=None):
         if pnts_c.shape[0] == 0:
             return pnts_c.detach()
         pnts_c.requires_grad_(True)
 
-        pnts_d = self.deformer.forward_skinning(pnts_c.unsqueeze(0), None, tfs).squeeze(0)
-        num_dim = pnts_d.shape[-1]
-        grads = []
-        for i in range(num_dim):
-            d_out = torch.zeros_like(pnts_d, requires_grad=False, device=pnts_d.device)
-            d_out[:, i] = 1
-            grad = torch.autograd.grad(
-                outputs=pnts_d,
-                inputs=pnts_c,
-                grad_outputs=d_out,
-                create_graph=create_graph,
-                retain_graph=True if i < num_dim - 1 else retain_graph,
-                only_inputs=True)[0]
-            grads.append(grad)
-        grads = torch.stack(grads, dim=-2)
+        if self.analytic_jacobian:
+            grads = self.deformer.forward_skinning_jacobian(pnts_c.unsqueeze(0), tfs, frame_idx=frame_idx).squeeze(0)
+        else:
+            pnts_d = self.deformer.forward_skinning(pnts_c.unsqueeze(0), None, tfs, frame_idx=frame_idx).squeeze(0)
+            num_dim = pnts_d.shape[-1]
+            grads = []
+            for i in range(num_dim):
+                d_out = torch.zeros_like(pnts_d, requires_grad=False, device=pnts_d.device)
+                d_out[:, i] = 1
+                grad = torch.autograd.grad(
+                    outputs=pnts_d,
+                    inputs=pnts_c,
+                    grad_outputs=d_out,
+                    create_graph=create_graph,
+                    retain_graph=True if i < num_dim - 1 else retain_graph,
+                    only_inputs=True)[0]
+                grads.append(grad)
+            grads = torch.stack(grads, dim=-2)
         grads_inv = grads.inverse()
 
-        output = self.implicit_network(pnts_c, cond)[0]
+        with profiler.stage('implicit_network'):
+            output = self.implicit_network(pnts_c, cond, frame_idx=frame_idx)[0]
         sdf = output[:, :1]
         
         feature = output[:, 1:]
@@ -291,7 +485,7 @@ class V2A(nn.Module):
 
         # LOG SPACE
         free_energy = dists * density
-        shifted_free_energy = torch.cat([torch.zeros(dists.shape[0], 1).cuda(), free_energy], dim=-1)  # add 0 for transperancy 1 at t_0
+        shifted_free_energy = torch.cat([torch.zeros(dists.shape[0], 1, device=dists.device), free_energy], dim=-1)  # add 0 for transperancy 1 at t_0
         alpha = 1 - torch.exp(-free_energy)  # probability of it is not empty here
         transmittance = torch.exp(-torch.cumsum(shifted_free_energy, dim=-1))  # probability of everything is empty up to now
         fg_transmittance = transmittance[:, :-1]
@@ -305,11 +499,11 @@ class V2A(nn.Module):
         bg_density = bg_density_flat.reshape(-1, z_vals_bg.shape[1]) # (batch_size * num_pixels) x N_samples
 
         bg_dists = z_vals_bg[:, :-1] - z_vals_bg[:, 1:]
-        bg_dists = torch.cat([bg_dists, torch.tensor([1e10]).cuda().unsqueeze(0).repeat(bg_dists.shape[0], 1)], -1)
+        bg_dists = torch.cat([bg_dists, torch.full((bg_dists.shape[0], 1), 1e10, device=bg_dists.device)], -1)
 
         # LOG SPACE
         bg_free_energy = bg_dists * bg_density
-        bg_shifted_free_energy = torch.cat([torch.zeros(bg_dists.shape[0], 1).cuda(), bg_free_energy[:, :-1]], dim=-1)  # shift one step
+        bg_shifted_free_energy = torch.cat([torch.zeros(bg_dists.shape[0], 1, device=bg_dists.device), bg_free_energy[:, :-1]], dim=-1)  # shift one step
         bg_alpha = 1 - torch.exp(-bg_free_energy)  # probability of it is not empty here
         bg_transmittance = torch.exp(-torch.cumsum(bg_shifted_free_energy, dim=-1))  # probability of everything is empty up to now
         bg_weights = bg_alpha * bg_transmittance # probability of the ray hits something here
@@ -23,7 +23,6 @@ import os
 import os.path as osp
 
 
-import pickle
 
 import numpy as np
 
@@ -36,7 +35,7 @@ from .lbs import (
     lbs, vertices2joints, blend_shapes)
 
 from .vertex_ids import vertex_ids as VERTEX_IDS
-from .utils import Struct, to_np, to_tensor
+from .utils import to_np, to_tensor, load_model_data
 from .vertex_joint_selector import VertexJointSelector
 
 
@@ -128,11 +127,12 @@ class SMPL(nn.Module):
                 smpl_path = os.path.join(model_path, model_fn)
             else:
                 smpl_path = model_path
-            assert osp.exists(smpl_path), 'Path {} does not exist!'.format(
+            # the npz converted from the pkl is enough
+            assert osp.exists(smpl_path) or osp.exists(
+                osp.splitext(smpl_path)[0] + '.npz'), 'Path {} does not exist!'.format(
                 smpl_path)
 
-            with open(smpl_path, 'rb') as smpl_file:
-                data_struct = Struct(**pickle.load(smpl_file,encoding='latin1'))
+            data_struct = load_model_data(smpl_path)
         super(SMPL, self).__init__()
         self.batch_size = batch_size
 
@@ -261,11 +261,19 @@ class SMPL(nn.Module):
                 param.fill_(0)
 
     def get_T_hip(self, betas=None):
-        v_shaped = self.v_template + blend_shapes(betas, self.shapedirs)
-        J = vertices2joints(self.J_regressor, v_shaped)
+        _, J = self.get_shape(betas)
         T_hip = J[0,0]
         return T_hip
 
+    def get_shape(self, betas, v_template=None):
+        ''' Shaped template and its joints, the input of forward for
+            v_shaped and joints_shaped '''
+        if v_template is None:
+            v_template = self.v_template
+        v_shaped = v_template + blend_shapes(betas, self.shapedirs)
+        J = vertices2joints(self.J_regressor, v_shaped)
+        return v_shaped, J
+
     def get_num_verts(self):
         return self.v_template.shape[0]
 
@@ -277,7 +285,7 @@ class SMPL(nn.Module):
 
     def forward(self, betas=None, body_pose=None, global_orient=None,
                 transl=None, return_verts=True, return_full_pose=False,displacement=None,v_template=None,
-                **kwargs):
+                v_shaped=None, joints_shaped=None, **kwargs):
         ''' Forward pass for the SMPL model
 
             Parameters
@@ -303,9 +311,15 @@ class SMPL(nn.Module):
                 `transl` is predicted from some external model.
                 (default=None)
             return_verts: bool, optional
-                Return the vertices. (default=True)
+                Return the vertices. If False, only the joints and the bone
+                transformations are computed. (default=True)
             return_full_pose: bool, optional
                 Returns the full axis-angle pose vector (default=False)
+            v_shaped: torch.tensor, optional, shape BxVx3
+                Shaped template of betas from lbs.shape_blend, skips the
+                shape blend shapes if given with joints_shaped. (default=None)
+            joints_shaped: torch.tensor, optional, shape BxJx3
+                Joints of v_shaped from lbs.shape_blend. (default=None)
 
             Returns
             -------
@@ -334,25 +348,19 @@ class SMPL(nn.Module):
             vertices, joints_smpl, T_weighted, W, T = lbs(betas, full_pose, v_template+displacement,
                                    self.shapedirs, self.posedirs,
                                    self.J_regressor, self.parents,
-                                   self.lbs_weights, dtype=self.dtype,pose_blend=self.pose_blend)
+                                   self.lbs_weights, dtype=self.dtype,pose_blend=self.pose_blend,
+                                   return_verts=return_verts)
         else:
             vertices, joints_smpl,T_weighted, W, T = lbs(betas, full_pose, v_template,
                                         self.shapedirs, self.posedirs,
                                         self.J_regressor, self.parents,
-                                        self.lbs_weights, dtype=self.dtype,pose_blend=self.pose_blend)
-
-        # if self.gender is not 'neutral':
-        joints = self.vertex_joint_selector(vertices, joints_smpl)
-        # else:
-        # joints = torch.matmul(vertices.permute(0,2,1),self.joint_regressor).permute(0,2,1)
-        # Map the joints to the current dataset
-        if self.joint_mapper is not None:
-            joints = self.joint_mapper(joints)
+                                        self.lbs_weights, dtype=self.dtype,pose_blend=self.pose_blend,
+                                        v_shaped=v_shaped, J=joints_shaped, return_verts=return_verts)
 
         if apply_trans:
             joints_smpl = joints_smpl + transl.unsqueeze(dim=1)
-            joints = joints + transl.unsqueeze(dim=1)
-            vertices = vertices + transl.unsqueeze(dim=1)
+            if return_verts:
+                vertices = vertices + transl.unsqueeze(dim=1)
 
         output = ModelOutput(vertices=vertices if return_verts else None,
                              faces=self.faces,
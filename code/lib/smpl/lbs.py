@@ -134,7 +134,8 @@ def vertices2landmarks(vertices, faces, lmk_faces_idx, lmk_bary_coords):
 
 
 def lbs(betas, pose, v_template, shapedirs, posedirs, J_regressor, parents,
-        lbs_weights, pose2rot=True, dtype=torch.float32, pose_blend=True):
+        lbs_weights, pose2rot=True, dtype=torch.float32, pose_blend=True,
+        v_shaped=None, J=None, return_verts=True):
     ''' Performs Linear Blend Skinning with the given shape and pose parameters
 
         Parameters
@@ -163,6 +164,14 @@ def lbs(betas, pose, v_template, shapedirs, posedirs, J_regressor, parents,
             should already contain rotation matrices and have a size of
             Bx(J + 1)x9
         dtype: torch.dtype, optional
+        v_shaped: torch.tensor BxVx3, optional
+            The shaped template from shape_blend, skips the shape blend
+            shapes if given together with J
+        J: torch.tensor BxJx3, optional
+            The joints of v_shaped from shape_blend
+        return_verts: bool, optional
+            If False, only the joints and the bone transformations are
+            computed and verts, T and W are None. (default=True)
 
         Returns
         -------
@@ -176,12 +185,9 @@ def lbs(betas, pose, v_template, shapedirs, posedirs, J_regressor, parents,
     batch_size = max(betas.shape[0], pose.shape[0])
     device = betas.device
 
-    # Add shape contribution
-    v_shaped = v_template + blend_shapes(betas, shapedirs)
-
-    # Get the joints
-    # NxJx3 array
-    J = vertices2joints(J_regressor, v_shaped)
+    # Add shape contribution and get the joints
+    if v_shaped is None or J is None:
+        v_shaped, J = shape_blend(betas, v_template, shapedirs, J_regressor)
 
     # 3. Add pose blend shapes
     # N x J x 3 x 3
@@ -191,31 +197,28 @@ def lbs(betas, pose, v_template, shapedirs, posedirs, J_regressor, parents,
     if pose2rot:
         rot_mats = batch_rodrigues(
             pose.view(-1, 3), dtype=dtype).view([batch_size, -1, 3, 3])
-
-        pose_feature = (rot_mats[:, 1:, :, :] - ident).view([batch_size, -1])
-        # (N x P) x (P, V * 3) -> N x V x 3
-        pose_offsets = torch.matmul(pose_feature, posedirs) \
-            .view(batch_size, -1, 3)
     else:
-        pose_feature = pose[:, 1:].view(batch_size, -1, 3, 3) - ident
         rot_mats = pose.view(batch_size, -1, 3, 3)
 
-        pose_offsets = torch.matmul(pose_feature.view(batch_size, -1),
-                                    posedirs).view(batch_size, -1, 3)
+    # 4. Get the global joint location
+    J_transformed, A = batch_rigid_transform(rot_mats, J, parents, dtype=dtype)
+    num_joints = J_regressor.shape[0]
+    if not return_verts:
+        return None, J_transformed, None, None, A.view(batch_size, num_joints, 4,4)
 
     if pose_blend:
+        pose_feature = (rot_mats[:, 1:, :, :] - ident).view([batch_size, -1])
+        # (N x P) x (P, V * 3) -> N x V x 3
+        pose_offsets = torch.matmul(pose_feature, posedirs) \
+            .view(batch_size, -1, 3)
         v_posed = pose_offsets + v_shaped
     else:
         v_posed = v_shaped
 
-    # 4. Get the global joint location
-    J_transformed, A = batch_rigid_transform(rot_mats, J, parents, dtype=dtype)
-
     # 5. Do skinning:
     # W is N x V x (J + 1)
     W = lbs_weights.unsqueeze(dim=0).expand([batch_size, -1, -1])
     # (N x V x (J + 1)) x (N x (J + 1) x 16)
-    num_joints = J_regressor.shape[0]
     T = torch.matmul(W, A.view(batch_size, num_joints, 16)) \
         .view(batch_size, -1, 4, 4)
 
@@ -229,6 +232,35 @@ def lbs(betas, pose, v_template, shapedirs, posedirs, J_regressor, parents,
     return verts, J_transformed, T, W, A.view(batch_size, num_joints, 4,4)
 
 
+def shape_blend(betas, v_template, shapedirs, J_regressor):
+    ''' Shapes the template and regresses its joints, the part of lbs that
+        only depends on the shape parameters
+
+        Parameters
+        ----------
+        betas : torch.tensor BxNB
+            The tensor of shape parameters
+        v_template torch.tensor BxVx3
+            The template mesh
+        shapedirs : torch.tensor 1xNB
+            The tensor of PCA shape displacements
+        J_regressor : torch.tensor JxV
+            The regressor array that is used to calculate the joints from
+            the position of the vertices
+
+        Returns
+        -------
+        v_shaped: torch.tensor BxVx3
+            The template with the shape displacements
+        J: torch.tensor BxJx3
+            The joints of v_shaped
+    '''
+    v_shaped = v_template + blend_shapes(betas, shapedirs)
+    # NxJx3 array
+    J = vertices2joints(J_regressor, v_shaped)
+    return v_shaped, J
+
+
 def vertices2joints(J_regressor, vertices):
     ''' Calculates the 3D joint locations from the vertices
 
@@ -1,17 +1,14 @@
+import functools
 import numpy as np
 import torch
 from skimage import measure
 from lib.libmise import mise
 import trimesh
 
-def generate_mesh(func, verts, level_set=0, res_init=32, res_up=3, point_batch=5000):
+def generate_mesh(func, verts, level_set=0, res_init=32, res_up=3, point_batch=5000, sparse=False):
     
-    scale = 1.1  # Scale of the padded bbox regarding the tight one.
-    verts = verts.data.cpu().numpy()
-    
-    gt_bbox = np.stack([verts.min(axis=0), verts.max(axis=0)], axis=0)
-    gt_center = (gt_bbox[0] + gt_bbox[1]) * 0.5
-    gt_scale = (gt_bbox[1] - gt_bbox[0]).max()
+    device = verts.device
+    gt_center, gt_scale = get_bbox(verts)
 
     mesh_extractor = mise.MISE(res_init, res_up, level_set)
     points = mesh_extractor.query()
@@ -20,31 +17,122 @@ def generate_mesh(func, verts, level_set=0, res_init=32, res_up=3, point_batch=5
     while points.shape[0] != 0:
         
         orig_points = points
-        points = points.astype(np.float32)
-        points = (points / mesh_extractor.resolution - 0.5) * scale
-        points = points * gt_scale + gt_center
-        points = torch.tensor(points).float().cuda()
-        
-        values = []
-        for _, pnts in enumerate((torch.split(points,point_batch,dim=0))):
-            out = func(pnts)
-            values.append(out['sdf'].data.cpu().numpy())
-        values = np.concatenate(values, axis=0).astype(np.float64)[:,0]
+        points = grid_to_world(points, mesh_extractor.resolution, gt_center, gt_scale)
+        values = evaluate_sdf(func, points, device, point_batch)
         
         mesh_extractor.update(orig_points, values)
         
         points = mesh_extractor.query()
     
-    value_grid = mesh_extractor.to_dense()
+    if sparse:
+        # marching cube over the cells refined to full depth only, memory scales with the surface area
+        cell_locs, cell_values = mesh_extractor.get_active_voxels()
+        verts, faces = sparse_marching_cubes(cell_locs, cell_values, level=level_set)
+        normals, values = None, None
+    else:
+        value_grid = mesh_extractor.to_dense()
+
+        # marching cube
+        verts, faces, normals, values = measure.marching_cubes_lewiner(
+                                                    volume=value_grid,
+                                                    gradient_direction='ascent',
+                                                    level=level_set)
+
+    verts = grid_to_world(verts, mesh_extractor.resolution, gt_center, gt_scale)
+    return export_mesh(verts, faces, normals, values)
+
+
+def generate_mesh_incremental(func, verts, prev_verts, prev_faces, level_set=0, res_init=32, res_up=3, point_batch=5000, max_face_change=0.5):
+    """Re-extract the mesh of generate_mesh(sparse=True) starting from a previous mesh of the same SDF.
+    The full resolution cells holding prev_verts seed a surface tracking, which then only visits the
+    neighbours across cell faces the surface passes through. If no seed cell is crossed by the surface
+    anymore or the number of faces changes by more than max_face_change, the topology is considered
+    to have changed and a full extraction is run instead.
+    Args:
+        prev_verts (np.ndarray): vertices of the previous mesh, in the same space as verts. shape: [V, 3]
+        prev_faces (np.ndarray): faces of the previous mesh. shape: [F, 3]
+    Returns:
+        mesh (trimesh.Trimesh): the largest connected component
+        incremental (bool): False if it fell back to a full extraction
+    """
+    device = verts.device
+    gt_center, gt_scale = get_bbox(verts)
+    resolution = res_init * 2 ** res_up
+
+    # visited cells and evaluated corners are kept dense at the full resolution, only the band is evaluated
+    visited = np.zeros(resolution ** 3, dtype=bool)
+    corner_values = np.full((resolution + 1) ** 3, np.nan, dtype=np.float32)
+    seeds = np.floor(world_to_grid(prev_verts, resolution, gt_center, gt_scale)).astype(np.int64)
+    frontier = np.unique(seeds.clip(0, resolution - 1), axis=0)
+    cell_locs, cell_values = [], []
+    while len(frontier) > 0:
+        visited[grid_to_key(frontier, resolution)] = True
+        keys = grid_to_key((frontier[:, None] + CUBE_CORNERS[None]).reshape(-1, 3), resolution + 1)
+        new_keys = np.unique(keys[np.isnan(corner_values[keys])])
+        if len(new_keys) > 0:
+            new_locs = np.stack(np.unravel_index(new_keys, (resolution + 1,) * 3), axis=-1)
+            corner_values[new_keys] = evaluate_sdf(func, grid_to_world(new_locs, resolution, gt_center, gt_scale), device, point_batch)
+        values = corner_values[keys].astype(np.float64).reshape(-1, 2, 2, 2)
+
+        inside = values < level_set
+        crossing = inside.reshape(-1, 8).any(-1) & ~inside.reshape(-1, 8).all(-1)
+        cell_locs.append(frontier[crossing])
+        cell_values.append(values[crossing])
+
+        # the surface continues into the neighbour across each face with corners on both sides
+        neighbors = []
+        for axis in range(3):
+            for side in range(2):
+                face = np.take(inside, side, axis=axis + 1).reshape(-1, 4)
+                step = np.zeros(3, dtype=np.int64)
+                step[axis] = 2 * side - 1
+                neighbors.append(frontier[face.any(-1) & ~face.all(-1)] + step)
+        neighbors = np.concatenate(neighbors)
+        neighbors = neighbors[((neighbors >= 0) & (neighbors < resolution)).all(-1)]
+        neighbor_keys, first = np.unique(grid_to_key(neighbors, resolution), return_index=True)
+        frontier = neighbors[first][~visited[neighbor_keys]]
+
+    cell_locs, cell_values = np.concatenate(cell_locs), np.concatenate(cell_values)
+    if len(cell_locs) == 0:
+        return generate_mesh(func, verts, level_set, res_init, res_up, point_batch, sparse=True), False
+
+    mesh_verts, mesh_faces = sparse_marching_cubes(cell_locs, cell_values, level=level_set)
+    mesh = export_mesh(grid_to_world(mesh_verts, resolution, gt_center, gt_scale), mesh_faces)
+    if abs(len(mesh.faces) / len(prev_faces) - 1) > max_face_change:
+        return generate_mesh(func, verts, level_set, res_init, res_up, point_batch, sparse=True), False
+    return mesh, True
+
+
+def get_bbox(verts, scale=1.1):
+    """Center and size of the cube that MISE grids span, padded by scale around the tight bbox of verts."""
+    verts = verts.data.cpu().numpy()
+    gt_bbox = np.stack([verts.min(axis=0), verts.max(axis=0)], axis=0)
+    gt_center = (gt_bbox[0] + gt_bbox[1]) * 0.5
+    gt_scale = (gt_bbox[1] - gt_bbox[0]).max() * scale
+    return gt_center, gt_scale
+
+
+def grid_to_world(points, resolution, gt_center, gt_scale):
+    return (points / resolution - 0.5) * gt_scale + gt_center
 
-    # marching cube
-    verts, faces, normals, values = measure.marching_cubes_lewiner(
-                                                volume=value_grid,
-                                                gradient_direction='ascent',
-                                                level=level_set)
 
-    verts = (verts / mesh_extractor.resolution - 0.5) * scale
-    verts = verts * gt_scale + gt_center
+def world_to_grid(points, resolution, gt_center, gt_scale):
+    return ((points - gt_center) / gt_scale + 0.5) * resolution
+
+
+def grid_to_key(locs, size):
+    return (locs[:, 0] * size + locs[:, 1]) * size + locs[:, 2]
+
+
+def evaluate_sdf(func, points, device, point_batch):
+    points = torch.tensor(points, dtype=torch.float32, device=device)
+    values = []
+    for pnts in torch.split(points, point_batch, dim=0):
+        values.append(func(pnts)['sdf'].data.cpu().numpy())
+    return np.concatenate(values, axis=0).astype(np.float64)[:, 0]
+
+
+def export_mesh(verts, faces, normals=None, values=None):
     faces = faces[:, [0,2,1]]
     meshexport = trimesh.Trimesh(verts, faces, normals, vertex_colors=values)
 
@@ -61,3 +149,125 @@ def generate_mesh(func, verts, level_set=0, res_init=32, res_up=3, point_batch=5
     return meshexport
 
 
+
+
+CUBE_CORNERS = np.array([[c >> 2 & 1, c >> 1 & 1, c & 1] for c in range(8)])
+CUBE_EDGES = np.array([[a, b] for a in range(8) for b in range(a + 1, 8) if bin(a ^ b).count('1') == 1])
+
+
+@functools.lru_cache(maxsize=None)
+def get_triangle_table():
+    """Triangles of the 256 inside/outside configurations of a cell, as indices into CUBE_EDGES.
+    Corner c = 4 * i + 2 * j + k sits at (i, j, k) and is inside (below the level) if bit c of the case is set.
+    The surface polygons are traced over the cell faces. A face with four crossings separates
+    its inside corners, so neighbouring cells always agree on the shared face and the mesh is closed.
+    Triangles are wound like those of measure.marching_cubes with gradient_direction='ascent'.
+    Returns:
+        triangles (np.ndarray): padded with -1. shape: [256, T, 3]
+        num_triangles (np.ndarray): shape: [256]
+    """
+    edge_index = {tuple(edge): n for n, edge in enumerate(CUBE_EDGES.tolist())}
+    faces = []
+    for d in range(3):
+        u, v = [axis for axis in range(3) if axis != d]
+        for side in range(2):
+            cycle = []
+            for pu, pv in [(0, 0), (1, 0), (1, 1), (0, 1)]:
+                pos = [0, 0, 0]
+                pos[d], pos[u], pos[v] = side, pu, pv
+                cycle.append(4 * pos[0] + 2 * pos[1] + pos[2])
+            faces.append(cycle)
+
+    triangles = []
+    for case in range(256):
+        inside = [(case >> c) & 1 for c in range(8)]
+
+        # connect the crossed edges of each face, face edge n joins cycle[n] and cycle[n + 1]
+        neighbors = {}
+        for cycle in faces:
+            face_edges = [edge_index[tuple(sorted((cycle[n], cycle[(n + 1) % 4])))] for n in range(4)]
+            crossing = [n for n in range(4) if inside[cycle[n]] != inside[cycle[(n + 1) % 4]]]
+            if len(crossing) == 2:
+                pairs = [crossing]
+            elif len(crossing) == 4:
+                pairs = [(3, 0), (1, 2)] if inside[cycle[0]] else [(0, 1), (2, 3)]
+            else:
+                pairs = []
+            for a, b in pairs:
+                neighbors.setdefault(face_edges[a], []).append(face_edges[b])
+                neighbors.setdefault(face_edges[b], []).append(face_edges[a])
+
+        # walk the closed loops and fan triangulate them
+        case_triangles = []
+        visited = set()
+        for start in sorted(neighbors):
+            if start in visited:
+                continue
+            loop, prev, curr = [start], None, start
+            while True:
+                visited.add(curr)
+                nxt = neighbors[curr][0] if neighbors[curr][0] != prev else neighbors[curr][1]
+                if nxt == start:
+                    break
+                loop.append(nxt)
+                prev, curr = curr, nxt
+
+            # orient the loop so that its normal points from the outside to the inside corners
+            midpoints = CUBE_CORNERS[CUBE_EDGES[loop]].mean(axis=1)
+            normal = np.cross(midpoints, np.roll(midpoints, -1, axis=0)).sum(axis=0)
+            outward = sum(CUBE_CORNERS[b] - CUBE_CORNERS[a] if inside[a] else CUBE_CORNERS[a] - CUBE_CORNERS[b]
+                          for a, b in CUBE_EDGES[loop])
+            if np.dot(normal, outward) > 0:
+                loop = loop[::-1]
+            case_triangles += [[loop[0], loop[n], loop[n + 1]] for n in range(1, len(loop) - 1)]
+        triangles.append(case_triangles)
+
+    num_triangles = np.array([len(case_triangles) for case_triangles in triangles])
+    table = np.full((256, num_triangles.max(), 3), -1, dtype=np.int64)
+    for case, case_triangles in enumerate(triangles):
+        if case_triangles:
+            table[case, :len(case_triangles)] = case_triangles
+    return table, num_triangles
+
+
+def sparse_marching_cubes(locs, values, level=0.):
+    """Marching cubes over a sparse set of cells of an integer grid.
+    Vertices on edges shared by several cells are merged, so the mesh is stitched.
+    Args:
+        locs (np.ndarray): lower corner of each cell. shape: [M, 3]
+        values (np.ndarray): values at the corners of each cell, indexed [x, y, z]. shape: [M, 2, 2, 2]
+        level (float): iso level
+    Returns:
+        verts (np.ndarray): vertices in grid coordinates. shape: [V, 3]
+        faces (np.ndarray): triangles, wound like get_triangle_table. shape: [F, 3]
+    """
+    table, num_triangles = get_triangle_table()
+    values = values.reshape(-1, 8)
+    cases = ((values < level).astype(np.int64) << np.arange(8)).sum(-1)
+
+    # one row per output triangle
+    valid = np.arange(table.shape[1])[None] < num_triangles[cases][:, None]
+    cell_idx, slot = np.nonzero(valid)
+    tri_edges = table[cases[cell_idx], slot]
+
+    # identify each edge globally by its lower corner and axis
+    corner_a = CUBE_EDGES[tri_edges, 0]
+    corner_b = CUBE_EDGES[tri_edges, 1]
+    axis = 2 - np.log2(corner_b - corner_a).astype(np.int64)
+    lower = locs[cell_idx][:, None] + CUBE_CORNERS[corner_a]
+    size = locs.max() + 2 if len(locs) > 0 else 1
+    keys = ((lower[..., 0] * size + lower[..., 1]) * size + lower[..., 2]) * 3 + axis
+    _, first, faces = np.unique(keys.reshape(-1), return_index=True, return_inverse=True)
+
+    # interpolate the vertex of each unique edge
+    edge_cells = np.repeat(cell_idx, 3)[first]
+    corner_a = corner_a.reshape(-1)[first]
+    corner_b = corner_b.reshape(-1)[first]
+    value_a = values[edge_cells, corner_a]
+    value_b = values[edge_cells, corner_b]
+    t = (level - value_a) / (value_b - value_a)
+    pos_a = locs[edge_cells] + CUBE_CORNERS[corner_a]
+    pos_b = locs[edge_cells] + CUBE_CORNERS[corner_b]
+    verts = pos_a + t[:, None] * (pos_b - pos_a)
+
+    return verts, faces.reshape(-1, 3)
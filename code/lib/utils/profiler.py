@@ -0,0 +1,112 @@
+import json
+import time
+import torch
+
+
+class NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+NULL_STAGE = NullStage()
+
+
+class Stage:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.peak_memory = 0
+
+    def __enter__(self):
+        profiler = self.profiler
+        if profiler.synchronize:
+            torch.cuda.synchronize()
+        if profiler.track_memory:
+            # the peak reached so far belongs to the enclosing stage
+            if profiler.stack:
+                profiler.stack[-1].peak_memory = max(profiler.stack[-1].peak_memory, torch.cuda.max_memory_allocated())
+            torch.cuda.reset_peak_memory_stats()
+        profiler.stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        profiler = self.profiler
+        wall_time = time.perf_counter() - self.start
+        if profiler.synchronize:
+            torch.cuda.synchronize()
+        synchronized_time = time.perf_counter() - self.start
+        profiler.stack.pop()
+        if profiler.track_memory:
+            self.peak_memory = max(self.peak_memory, torch.cuda.max_memory_allocated())
+            if profiler.stack:
+                profiler.stack[-1].peak_memory = max(profiler.stack[-1].peak_memory, self.peak_memory)
+            torch.cuda.reset_peak_memory_stats()
+        profiler.record(self.name, wall_time, synchronized_time, self.peak_memory)
+        return False
+
+
+class StageProfiler:
+    """Wall time, device synchronized time and peak device memory of named stages of a step.
+
+    Stages are opened with `with profiler.stage(name):` and may nest, the time and memory of a stage
+    include its nested stages. Records are aggregated over report_interval steps by step().
+    When disabled, stage() returns a shared no-op context manager.
+    """
+    def __init__(self):
+        self.configure(enabled=False)
+
+    def configure(self, enabled=True, synchronize=True, track_memory=True, report_interval=100, output=None):
+        cuda = torch.cuda.is_available()
+        self.enabled = enabled
+        self.synchronize = enabled and synchronize and cuda
+        self.track_memory = enabled and track_memory and cuda
+        self.report_interval = report_interval
+        self.output = output
+        self.stack = []
+        self.records = {}
+        self.reports = []
+        self.num_steps = 0
+
+    def stage(self, name):
+        if not self.enabled:
+            return NULL_STAGE
+        return Stage(self, name)
+
+    def record(self, name, wall_time, synchronized_time, peak_memory):
+        record = self.records.setdefault(name, {'count': 0, 'wall_time': 0., 'synchronized_time': 0., 'peak_memory': 0})
+        record['count'] += 1
+        record['wall_time'] += wall_time
+        record['synchronized_time'] += synchronized_time
+        record['peak_memory'] = max(record['peak_memory'], peak_memory)
+
+    def step(self):
+        """Count a step. Every report_interval steps, returns the report of the stages and writes
+        all reports to output, otherwise returns None."""
+        if not self.enabled:
+            return None
+        self.num_steps += 1
+        if self.num_steps % self.report_interval != 0:
+            return None
+
+        report = {}
+        for name, record in self.records.items():
+            report[name] = {
+                'calls_per_step': record['count'] / self.report_interval,
+                'wall_ms_per_step': 1000 * record['wall_time'] / self.report_interval,
+                'synchronized_ms_per_step': 1000 * record['synchronized_time'] / self.report_interval,
+                'peak_memory_mb': record['peak_memory'] / 2 ** 20,
+            }
+        self.records = {}
+        self.reports.append({'step': self.num_steps, 'stages': report})
+        if self.output is not None:
+            with open(self.output, 'w') as f:
+                json.dump(self.reports, f, indent=2)
+        return report
+
+
+# shared by all modules, set up from the config by V2AModel
+profiler = StageProfiler()
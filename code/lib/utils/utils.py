@@ -4,6 +4,15 @@ import torch
 from torch.nn import functional as F
 
 
+def meshgrid_ij(*tensors):
+    """torch.meshgrid with matrix indexing, passed explicitly where torch accepts the indexing argument."""
+    try:
+        return torch.meshgrid(*tensors, indexing='ij')
+    except TypeError:
+        # torch < 1.10 has no indexing argument and always uses matrix indexing
+        return torch.meshgrid(*tensors)
+
+
 def split_input(model_input, total_pixels, n_pixels = 10000):
     '''
      Split the input to fit Cuda memory for large resolution.
@@ -12,7 +21,7 @@ def split_input(model_input, total_pixels, n_pixels = 10000):
 
     split = []
 
-    for i, indx in enumerate(torch.split(torch.arange(total_pixels).cuda(), n_pixels, dim=0)):
+    for i, indx in enumerate(torch.split(torch.arange(total_pixels, device=model_input['uv'].device), n_pixels, dim=0)):
         data = model_input.copy()
         data['uv'] = torch.index_select(model_input['uv'], 1, indx)
         split.append(data)
@@ -41,7 +50,7 @@ def get_psnr(img1, img2, normalize_rgb=False):
         img2 = (img2 + 1. ) / 2.
 
     mse = torch.mean((img1 - img2) ** 2)
-    psnr = -10. * torch.log(mse) / torch.log(torch.Tensor([10.]).cuda())
+    psnr = -10. * torch.log(mse) / np.log(10.)
 
     return psnr
 
@@ -74,7 +83,7 @@ def get_camera_params(uv, pose, intrinsics):
     if pose.shape[1] == 7: #In case of quaternion vector representation
         cam_loc = pose[:, 4:]
         R = quat_to_rot(pose[:,:4])
-        p = torch.eye(4).repeat(pose.shape[0],1,1).cuda().float()
+        p = torch.eye(4, device=pose.device).repeat(pose.shape[0],1,1).float()
         p[:, :3, :3] = R
         p[:, :3, 3] = cam_loc
     else: # In case of pose matrix representation
@@ -83,7 +92,7 @@ def get_camera_params(uv, pose, intrinsics):
 
     batch_size, num_samples, _ = uv.shape
 
-    depth = torch.ones((batch_size, num_samples)).cuda()
+    depth = torch.ones((batch_size, num_samples), device=uv.device)
     x_cam = uv[:, :, 0].view(batch_size, -1)
     y_cam = uv[:, :, 1].view(batch_size, -1)
     z_cam = depth.view(batch_size, -1)
@@ -101,7 +110,7 @@ def get_camera_params(uv, pose, intrinsics):
 
 def lift(x, y, z, intrinsics):
     # parse intrinsics
-    intrinsics = intrinsics.cuda()
+    intrinsics = intrinsics.to(x.device)
     fx = intrinsics[:, 0, 0]
     fy = intrinsics[:, 1, 1]
     cx = intrinsics[:, 0, 2]
@@ -112,13 +121,13 @@ def lift(x, y, z, intrinsics):
     y_lift = (y - cy.unsqueeze(-1)) / fy.unsqueeze(-1) * z
 
     # homogeneous
-    return torch.stack((x_lift, y_lift, z, torch.ones_like(z).cuda()), dim=-1)
+    return torch.stack((x_lift, y_lift, z, torch.ones_like(z)), dim=-1)
 
 
 def quat_to_rot(q):
     batch_size, _ = q.shape
     q = F.normalize(q, dim=1)
-    R = torch.ones((batch_size, 3,3)).cuda()
+    R = torch.ones((batch_size, 3,3), device=q.device)
     qr=q[:,0]
     qi = q[:, 1]
     qj = q[:, 2]
@@ -137,7 +146,7 @@ def quat_to_rot(q):
 
 def rot_to_quat(R):
     batch_size, _,_ = R.shape
-    q = torch.ones((batch_size, 4)).cuda()
+    q = torch.ones((batch_size, 4), device=R.device)
 
     R00 = R[:, 0,0]
     R01 = R[:, 0, 1]
@@ -169,11 +178,23 @@ def get_sphere_intersections(cam_loc, ray_directions, r = 1.0):
         print('BOUNDING SPHERE PROBLEM!')
         exit()
 
-    sphere_intersections = torch.sqrt(under_sqrt) * torch.Tensor([-1, 1]).cuda().float() - ray_cam_dot
+    sphere_intersections = torch.sqrt(under_sqrt) * torch.tensor([-1., 1.], device=cam_loc.device) - ray_cam_dot
     sphere_intersections = sphere_intersections.clamp_min(0.0)
 
     return sphere_intersections
 
+def get_bbox_intersections(cam_loc, ray_directions, bbox_min, bbox_max):
+    # Input: n_rays x 3 ; n_rays x 3 ; 3 ; 3
+    # Output: n_rays x 2 (close and far), close >= far if the ray misses the box
+
+    ray_directions = torch.where(ray_directions.abs() < 1e-8, torch.full_like(ray_directions, 1e-8), ray_directions)
+    t0 = (bbox_min - cam_loc) / ray_directions
+    t1 = (bbox_max - cam_loc) / ray_directions
+    near = torch.min(t0, t1).max(dim=-1)[0].clamp_min(0.0)
+    far = torch.max(t0, t1).min(dim=-1)[0]
+
+    return torch.stack([near, far], dim=-1)
+
 def bilinear_interpolation(xs, ys, dist_map):
     x1 = np.floor(xs).astype(np.int32)
     y1 = np.floor(ys).astype(np.int32)
@@ -19,8 +19,8 @@ def main(opt):
     logger = WandbLogger(project=opt.project_name, name=f"{opt.exp}/{opt.run}")
 
     trainer = pl.Trainer(
-        gpus=1,
-        accelerator="gpu",
+        gpus=1 if opt.device == 'cuda' else None,
+        accelerator="gpu" if opt.device == 'cuda' else "cpu",
         callbacks=[checkpoint_callback],
         max_epochs=8000,
         check_val_every_n_epoch=50,
@@ -31,7 +31,7 @@ def main(opt):
 
     model = V2AModel(opt)
     checkpoint = sorted(glob.glob("checkpoints/*.ckpt"))[-1]
-    testset = create_dataset(opt.dataset.metainfo, opt.dataset.test)
+    testset = create_dataset(opt.dataset.metainfo, opt.dataset.test, device=opt.device)
 
     trainer.test(model, testset, ckpt_path=checkpoint)
 
@@ -19,8 +19,8 @@ def main(opt):
     logger = WandbLogger(project=opt.project_name, name=f"{opt.exp}/{opt.run}")
 
     trainer = pl.Trainer(
-        gpus=1,
-        accelerator="gpu",
+        gpus=1 if opt.device == 'cuda' else None,
+        accelerator="gpu" if opt.device == 'cuda' else "cpu",
         callbacks=[checkpoint_callback],
         max_epochs=8000,
         check_val_every_n_epoch=50,
@@ -31,8 +31,8 @@ def main(opt):
 
     
     model = V2AModel(opt)
-    trainset = create_dataset(opt.dataset.metainfo, opt.dataset.train)
-    validset = create_dataset(opt.dataset.metainfo, opt.dataset.valid)
+    trainset = create_dataset(opt.dataset.metainfo, opt.dataset.train, device=opt.device)
+    validset = create_dataset(opt.dataset.metainfo, opt.dataset.valid, device=opt.device)
 
     if opt.model.is_continue == True:
         checkpoint = sorted(glob.glob("checkpoints/*.ckpt"))[-1]
@@ -8,12 +8,14 @@ import torch
 from lib.model.loss import Loss
 import hydra
 import os
+from collections import OrderedDict
 import numpy as np
-from lib.utils.meshing import generate_mesh
-from kaolin.ops.mesh import index_vertices_by_faces
+from lib.utils.meshing import generate_mesh, generate_mesh_incremental
 import trimesh
 from lib.model.deformer import skinning
 from lib.utils import utils
+from lib.utils.profiler import profiler
+from lib.datasets import Dataset, PixelSampler
 class V2AModel(pl.LightningModule):
     def __init__(self, opt) -> None:
         super().__init__()
@@ -22,7 +24,7 @@ class V2AModel(pl.LightningModule):
         num_training_frames = opt.dataset.metainfo.end_frame - opt.dataset.metainfo.start_frame
         self.betas_path = os.path.join(hydra.utils.to_absolute_path('..'), 'data', opt.dataset.metainfo.data_dir, 'mean_shape.npy')
         self.gender = opt.dataset.metainfo.gender
-        self.model = V2A(opt.model, self.betas_path, self.gender, num_training_frames)
+        self.model = V2A(opt.model, self.betas_path, self.gender, num_training_frames, device=opt.device)
         self.start_frame = opt.dataset.metainfo.start_frame
         self.end_frame = opt.dataset.metainfo.end_frame
         self.training_modules = ["model"]
@@ -36,6 +38,23 @@ class V2AModel(pl.LightningModule):
         self.training_modules += ['body_model_params']
         
         self.loss = Loss(opt.model.loss)
+
+        # built in on_train_start if pixels are sampled on the device
+        self.pixel_sampler = None
+
+        # global step of the last occupancy grid update
+        self.occupancy_grid_step = None
+
+        # test-time caches shared across frames
+        self.test_deformers = None
+        # least recently used meshes first, at most test_mesh_cache_size of them
+        self.test_mesh_cache = OrderedDict()
+
+        if opt.profiling.enabled:
+            profiler.configure(synchronize=opt.profiling.synchronize,
+                               track_memory=opt.profiling.track_memory,
+                               report_interval=opt.profiling.report_interval,
+                               output=opt.profiling.output)
         
     def load_body_model_params(self):
         body_model_params = {param_name: [] for param_name in self.body_model_params.param_names}
@@ -58,6 +77,22 @@ class V2AModel(pl.LightningModule):
             self.optimizer, milestones=self.opt.model.sched_milestones, gamma=self.opt.model.sched_factor)
         return [self.optimizer], [self.scheduler]
 
+    def on_train_start(self):
+        if self.opt.dataset.train.device_sampling and self.pixel_sampler is None:
+            dataset = Dataset(self.opt.dataset.metainfo, self.opt.dataset.train)
+            # the dataset samples in the workers when its frames are too large for the device
+            if dataset.device_sampling:
+                self.pixel_sampler = PixelSampler(dataset, self.opt.dataset.train.num_sample).to(self.device)
+
+    def on_after_batch_transfer(self, batch, dataloader_idx):
+        inputs, targets = batch[0], batch[1]
+        if self.pixel_sampler is not None and 'uv' not in inputs:
+            uv, rgb, index_outside = self.pixel_sampler(inputs['idx'])
+            inputs['uv'] = uv
+            inputs['index_outside'] = index_outside
+            targets['rgb'] = rgb
+        return batch
+
     def training_step(self, batch):
         inputs, targets = batch
 
@@ -69,9 +104,12 @@ class V2AModel(pl.LightningModule):
         inputs['smpl_trans'] = body_model_params['transl']
 
         inputs['current_epoch'] = self.current_epoch
-        model_outputs = self.model(inputs)
+        self.update_occupancy_grid()
+        with profiler.stage('forward'):
+            model_outputs = self.model(inputs)
 
-        loss_output = self.loss(model_outputs, targets)
+        with profiler.stage('loss'):
+            loss_output = self.loss(model_outputs, targets)
         for k, v in loss_output.items():
             if k in ["loss"]:
                 self.log(k, v.item(), prog_bar=True, on_step=True)
@@ -79,14 +117,60 @@ class V2AModel(pl.LightningModule):
                 self.log(k, v.item(), prog_bar=True, on_step=True)
         return loss_output["loss"]
 
+    def backward(self, loss, optimizer, optimizer_idx, *args, **kwargs):
+        with profiler.stage('backward'):
+            super().backward(loss, optimizer, optimizer_idx, *args, **kwargs)
+
+    def on_train_batch_end(self, outputs, batch, batch_idx, *args):
+        report = profiler.step()
+        if report is not None:
+            for name, stage in report.items():
+                for k, v in stage.items():
+                    self.log(f'profile/{name}/{k}', v, on_step=True)
+
+    def update_occupancy_grid(self):
+        # the grid is only read with the zero pose cond, it is not refreshed in the other epochs
+        if self.model.occupancy_grid is None or not self.model.is_zero_pose_epoch(self.current_epoch):
+            return
+        opt = self.opt.model.occupancy_grid
+        if self.global_step < opt.warmup_steps:
+            return
+        if self.occupancy_grid_step is None or self.global_step - self.occupancy_grid_step >= opt.update_interval:
+            cond = {'smpl': torch.zeros(1, 69, device=self.device)}
+            # empty cells are beta_margin betas further than the threshold, their density is at most exp(-beta_margin) / (2 beta)
+            margin = opt.beta_margin * self.model.density.get_beta().item()
+            self.model.occupancy_grid.update(lambda x: self.query_oc(x, cond)['sdf'], margin=margin)
+            self.occupancy_grid_step = self.global_step
+            self.log('occupancy_ratio', self.model.occupancy_grid.occupancy_ratio().item(), on_step=True)
+
+    def on_load_checkpoint(self, checkpoint):
+        # checkpoints saved before the occupancy grid was, or with another occupancy_grid.enabled
+        state_dict = checkpoint['state_dict']
+        own_state_dict = self.state_dict()
+        for key in list(state_dict):
+            if key.startswith('model.occupancy_grid.') and key not in own_state_dict:
+                del state_dict[key]
+        for key, value in own_state_dict.items():
+            if key.startswith('model.occupancy_grid.') and key not in state_dict:
+                state_dict[key] = value
+
     def training_epoch_end(self, outputs) -> None:        
         # Canonical mesh update every 20 epochs
         if self.current_epoch != 0 and self.current_epoch % 20 == 0:
-            cond = {'smpl': torch.zeros(1, 69).float().cuda()}
-            mesh_canonical = generate_mesh(lambda x: self.query_oc(x, cond), self.model.smpl_server.verts_c[0], point_batch=10000, res_up=2)
-            self.model.mesh_v_cano = torch.tensor(mesh_canonical.vertices[None], device = self.model.smpl_v_cano.device).float()
-            self.model.mesh_f_cano = torch.tensor(mesh_canonical.faces.astype(np.int64), device=self.model.smpl_v_cano.device)
-            self.model.mesh_face_vertices = index_vertices_by_faces(self.model.mesh_v_cano, self.model.mesh_f_cano)
+            cond = {'smpl': torch.zeros(1, 69, device=self.device)}
+            # track the surface from the previous canonical mesh, falls back to a full extraction.
+            # The first refresh starts from the SMPL template, whose face count never matches the extracted mesh
+            if self.opt.model.incremental_mesh_refresh and not self.model.cano_mesh_is_template:
+                mesh_canonical, incremental = generate_mesh_incremental(lambda x: self.query_oc(x, cond), self.model.smpl_server.verts_c[0],
+                                                                        self.model.mesh_v_cano[0].cpu().numpy(), self.model.mesh_f_cano.cpu().numpy(),
+                                                                        point_batch=10000, res_up=2)
+                self.log('incremental_mesh_refresh', float(incremental))
+            else:
+                mesh_canonical = generate_mesh(lambda x: self.query_oc(x, cond), self.model.smpl_server.verts_c[0], point_batch=10000, res_up=2, sparse=self.opt.model.sparse_marching_cubes)
+            error = self.model.update_cano_mesh(torch.tensor(mesh_canonical.vertices[None], device = self.model.smpl_v_cano.device).float(),
+                                                torch.tensor(mesh_canonical.faces.astype(np.int64), device=self.model.smpl_v_cano.device))
+            if error is not None:
+                self.log('cano_mesh_sdf_error', error)
         return super().training_epoch_end(outputs)
 
     def query_oc(self, x, cond):
@@ -112,7 +196,7 @@ class V2AModel(pl.LightningModule):
         return {'sdf': sdf}
 
     def get_deformed_mesh_fast_mode(self, verts, smpl_tfs):
-        verts = torch.tensor(verts).cuda().float()
+        verts = torch.tensor(verts, dtype=torch.float32, device=self.device)
         weights = self.model.deformer.query_weights(verts)
         verts_deformed = skinning(verts.unsqueeze(0),  weights, smpl_tfs).data.cpu().numpy()[0]
         return verts_deformed
@@ -130,7 +214,7 @@ class V2AModel(pl.LightningModule):
         inputs['smpl_trans'] = body_model_params['transl']
 
         cond = {'smpl': inputs["smpl_pose"][:, 3:]/np.pi}
-        mesh_canonical = generate_mesh(lambda x: self.query_oc(x, cond), self.model.smpl_server.verts_c[0], point_batch=10000, res_up=3)
+        mesh_canonical = generate_mesh(lambda x: self.query_oc(x, cond), self.model.smpl_server.verts_c[0], point_batch=10000, res_up=3, sparse=self.opt.model.sparse_marching_cubes)
         
         mesh_canonical = trimesh.Trimesh(mesh_canonical.vertices, mesh_canonical.faces)
         
@@ -212,6 +296,34 @@ class V2AModel(pl.LightningModule):
         cv2.imwrite(f"normal/{self.current_epoch}.png", normal[:, :, ::-1])
         cv2.imwrite(f"fg_rendering/{self.current_epoch}.png", fg_rgb[:, :, ::-1])
     
+    def get_test_canonical_mesh(self, cond):
+        """Extract the canonical mesh for a test frame, reusing earlier extractions if
+        test_mesh_cache is 'zero_pose' (one mesh for all frames) or 'quantized_pose'
+        (one mesh per pose quantized with test_mesh_pose_step, the test_mesh_cache_size
+        most recent are kept). Only 'zero_pose' is expected to hit for every frame, the
+        69 quantized pose parameters rarely repeat except for near static frames."""
+        mode = self.opt.model.test_mesh_cache
+        if mode == 'none':
+            return generate_mesh(lambda x: self.query_oc(x, cond), self.model.smpl_server.verts_c[0], point_batch=10000, res_up=4, sparse=self.opt.model.sparse_marching_cubes)
+        elif mode == 'zero_pose':
+            cond = {'smpl': torch.zeros_like(cond['smpl'])}
+            key = 'zero_pose'
+        elif mode == 'quantized_pose':
+            step = self.opt.model.test_mesh_pose_step
+            cond = {'smpl': torch.round(cond['smpl'] / step) * step}
+            key = tuple(torch.round(cond['smpl'] / step).long().flatten().tolist())
+        else:
+            raise ValueError(f'Unknown test mesh cache mode {mode}')
+
+        if key in self.test_mesh_cache:
+            self.test_mesh_cache.move_to_end(key)
+            return self.test_mesh_cache[key]
+        mesh = generate_mesh(lambda x: self.query_oc(x, cond), self.model.smpl_server.verts_c[0], point_batch=10000, res_up=4, sparse=self.opt.model.sparse_marching_cubes)
+        self.test_mesh_cache[key] = mesh
+        if len(self.test_mesh_cache) > self.opt.model.test_mesh_cache_size:
+            self.test_mesh_cache.popitem(last=False)
+        return mesh
+
     def test_step(self, batch, *args, **kwargs):
         inputs, targets, pixel_per_batch, total_pixels, idx = batch
         num_splits = (total_pixels + pixel_per_batch -
@@ -225,12 +337,19 @@ class V2AModel(pl.LightningModule):
         smpl_trans = body_model_params['transl']
         smpl_pose = torch.cat((body_model_params['global_orient'], body_model_params['body_pose']), dim=1)
 
-        smpl_outputs = self.model.smpl_server(scale, smpl_trans, smpl_pose, smpl_shape)
+        smpl_outputs = self.model.smpl_server(scale, smpl_trans, smpl_pose, smpl_shape, return_verts=False)
         smpl_tfs = smpl_outputs['smpl_tfs']
         cond = {'smpl': smpl_pose[:, 3:]/np.pi}
 
-        mesh_canonical = generate_mesh(lambda x: self.query_oc(x, cond), self.model.smpl_server.verts_c[0], point_batch=10000, res_up=4)
-        self.model.deformer = SMPLDeformer(betas=np.load(self.betas_path), gender=self.gender, K=7)
+        if self.test_deformers is None:
+            betas = np.load(self.betas_path)
+            self.test_deformers = {
+                'mesh': SMPLDeformer(betas=betas, gender=self.gender, K=7, device=self.device, **self.opt.model.deformer),
+                'render': SMPLDeformer(betas=betas, gender=self.gender, device=self.device, **self.opt.model.deformer),
+            }
+
+        mesh_canonical = self.get_test_canonical_mesh(cond)
+        self.model.deformer = self.test_deformers['mesh']
         verts_deformed = self.get_deformed_mesh_fast_mode(mesh_canonical.vertices, smpl_tfs)
         mesh_deformed = trimesh.Trimesh(vertices=verts_deformed, faces=mesh_canonical.faces, process=False)
 
@@ -242,7 +361,7 @@ class V2AModel(pl.LightningModule):
         
         mesh_canonical.export(f"test_mesh/{int(idx.cpu().numpy()):04d}_canonical.ply")
         mesh_deformed.export(f"test_mesh/{int(idx.cpu().numpy()):04d}_deformed.ply")
-        self.model.deformer = SMPLDeformer(betas=np.load(self.betas_path), gender=self.gender)
+        self.model.deformer = self.test_deformers['render']
         for i in range(num_splits):
             indices = list(range(i * pixel_per_batch,
                                 min((i + 1) * pixel_per_batch, total_pixels)))
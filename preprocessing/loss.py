@@ -4,7 +4,7 @@ num_joints = 25
 joints_to_ign = [1,9,12]
 joint_weights = torch.ones(num_joints)   
 joint_weights[joints_to_ign] = 0
-joint_weights = joint_weights.reshape((-1,1)).cuda()
+joint_weights = joint_weights.reshape((-1,1))
 
 robustifier = GMoF(rho=100)
 
@@ -17,9 +17,17 @@ def get_loss_weights():
 def joints_2d_loss(gt_joints_2d=None, joints_2d=None, joint_confidence=None):
 
     joint_diff = robustifier(gt_joints_2d - joints_2d)
-    joints_2dloss = torch.mean((joint_confidence*joint_weights[:, 0]).unsqueeze(-1) ** 2 * joint_diff)
+    weights = joint_weights[:, 0].to(joint_diff.device)
+    joints_2dloss = torch.mean((joint_confidence*weights).unsqueeze(-1) ** 2 * joint_diff)
     return joints_2dloss
 
 def pose_temporal_loss(last_pose, param_pose):
     temporal_loss = torch.mean(torch.square(last_pose - param_pose))
-    return temporal_loss
\ No newline at end of file
+    return temporal_loss
+
+def pose_smoothness_loss(last_pose, param_pose):
+    """pose_temporal_loss of each frame of param_pose [B, 72] to the frame before it, summed over the frames.
+    The first frame is compared to last_pose [1, 72]."""
+    prev_pose = torch.cat([last_pose, param_pose[:-1]], dim=0)
+    temporal_loss = torch.mean(torch.square(prev_pose - param_pose), dim=1).sum()
+    return temporal_loss
@@ -1,18 +1,135 @@
 import numpy as np
 import pickle as pkl
 import torch
-import trimesh
 import cv2
 import os
 from tqdm import tqdm
 import glob
 import argparse
-from preprocessing_utils import (smpl_to_pose, PerspectiveCamera, Renderer, render_trimesh, \
+from preprocessing_utils import (smpl_to_pose, PerspectiveCamera, Renderer, render_meshes, \
                                 estimate_translation_cv2, transform_smpl)
-from loss import joints_2d_loss, pose_temporal_loss, get_loss_weights
+from loss import joints_2d_loss, pose_temporal_loss, pose_smoothness_loss, get_loss_weights
+
+def load_romp_frames(romp_file_paths, cam_intrinsics):
+    """ROMP estimate of the tracked person in each frame: vertices, betas, thetas and translation."""
+    last_j3d = None
+    actor_id = 0
+    for idx, romp_file_path in enumerate(romp_file_paths):
+        seq_file = np.load(romp_file_path, allow_pickle=True)['results'][()]
+
+        # tracking in case of two persons or wrong ROMP detection
+        if len(seq_file['smpl_thetas']) >= 2:
+            dist = []
+            if idx == 0:
+                last_j3d = seq_file['joints'][actor_id]
+            for i in range(len(seq_file['smpl_thetas'])):
+                dist.append(np.linalg.norm(seq_file['joints'][i].mean(0) - last_j3d.mean(0, keepdims=True)))
+            actor_id = np.argmin(dist)
+        smpl_verts = seq_file['verts'][actor_id]
+        pj2d_org = seq_file['pj2d_org'][actor_id]
+        joints3d = seq_file['joints'][actor_id]
+        last_j3d = joints3d.copy()
+        tra_pred = estimate_translation_cv2(joints3d, pj2d_org, proj_mat=cam_intrinsics)
+
+        smpl_verts += tra_pred
+        yield smpl_verts, seq_file['smpl_betas'][actor_id][:10], seq_file['smpl_thetas'][actor_id], tra_pred
+
+def refine_smpl_batched(smpl_model, romp_frames, openpose_paths, cam_intrinsics, smpl2op_mapping,
+                        window, opt_num_iters, device):
+    """Refine the SMPL parameters of all frames, window frames at a time jointly in one batched SMPL forward.
+
+    As in the per-frame refinement, every frame is pulled towards the pose of the frame before it, here by the
+    smoothness term over all neighbours of the window. The first frame of a window is pulled towards the refined
+    pose of the last frame of the previous window, the first frame of the video towards its ROMP pose.
+    Returns the refined pose [N, 72], trans [N, 3], shape [N, 10] and vertices [N, 6890, 3] of the frames.
+    """
+    weight_dict = get_loss_weights()
+    init_shape = np.stack([romp_frame[1] for romp_frame in romp_frames], axis=0)
+    init_pose = np.stack([romp_frame[2] for romp_frame in romp_frames], axis=0)
+    init_trans = np.stack([romp_frame[3] for romp_frame in romp_frames], axis=0)
+    openpose = np.stack([np.load(openpose_path) for openpose_path in openpose_paths[:len(romp_frames)]], axis=0)
+
+    last_pose = torch.tensor(init_pose[:1], dtype=torch.float32, device=device)
+    refined = {'pose': [], 'trans': [], 'shape': [], 'verts': []}
+    for start in range(0, len(romp_frames), window):
+        end = min(start + window, len(romp_frames))
+        num_frames = end - start
+        openpose_j2d = torch.tensor(openpose[start:end, :, :2], dtype=torch.float32, device=device)
+        openpose_conf = torch.tensor(openpose[start:end, :, -1], dtype=torch.float32, device=device)
+        cam = PerspectiveCamera(focal_length_x=torch.tensor(cam_intrinsics[0, 0], dtype=torch.float32),
+                                focal_length_y=torch.tensor(cam_intrinsics[1, 1], dtype=torch.float32),
+                                center=torch.tensor(cam_intrinsics[0:2, 2]).float().unsqueeze(0),
+                                batch_size=num_frames).to(device)
+
+        opt_betas = torch.tensor(init_shape[start:end], dtype=torch.float32, requires_grad=True, device=device)
+        opt_pose = torch.tensor(init_pose[start:end], dtype=torch.float32, requires_grad=True, device=device)
+        opt_trans = torch.tensor(init_trans[start:end], dtype=torch.float32, requires_grad=True, device=device)
+
+        opt_params = [{'params': opt_betas, 'lr': 1e-3},
+                    {'params': opt_pose, 'lr': 1e-3},
+                    {'params': opt_trans, 'lr': 1e-3}]
+        optimizer = torch.optim.Adam(opt_params, lr=2e-3, betas=(0.9, 0.999))
+        loop = tqdm(range(opt_num_iters))
+        for it in loop:
+            optimizer.zero_grad()
+
+            smpl_output = smpl_model(betas=opt_betas,
+                                     body_pose=opt_pose[:,3:],
+                                     global_orient=opt_pose[:,:3],
+                                     transl=opt_trans)
+
+            smpl_joints_2d = cam(torch.index_select(smpl_output.joints, 1, smpl2op_mapping))
+
+            # losses are summed over the frames, so each frame is weighted as in the per-frame refinement
+            loss = dict()
+            loss['J2D_Loss'] = joints_2d_loss(openpose_j2d, smpl_joints_2d, openpose_conf) * num_frames
+            loss['Temporal_Loss'] = pose_smoothness_loss(last_pose, opt_pose)
+            w_loss = dict()
+            for k in loss:
+                w_loss[k] = weight_dict[k](loss[k], it)
+
+            tot_loss = list(w_loss.values())
+            tot_loss = torch.stack(tot_loss).sum()
+            tot_loss.backward()
+            optimizer.step()
+
+            l_str = 'Frames: %d-%d, Iter: %d' % (start, end - 1, it)
+            for k in loss:
+                l_str += ', %s: %0.4f' % (k, w_loss[k].item() / num_frames)
+            loop.set_description(l_str)
+
+        with torch.no_grad():
+            smpl_output = smpl_model(betas=opt_betas,
+                                     body_pose=opt_pose[:,3:],
+                                     global_orient=opt_pose[:,:3],
+                                     transl=opt_trans)
+        last_pose = opt_pose.detach()[-1:].clone()
+        refined['pose'].append(opt_pose.detach().cpu().numpy())
+        refined['trans'].append(opt_trans.detach().cpu().numpy())
+        refined['shape'].append(opt_betas.detach().cpu().numpy())
+        refined['verts'].append(smpl_output.vertices.cpu().numpy())
+    return {k: np.concatenate(v, axis=0) for k, v in refined.items()}
+
+def write_rendered_frames(renderer, frames, faces, R, T, out_dir, mode):
+    """Render the SMPL meshes of frames [(idx, input_img, smpl_verts)] in one batch and write the mask of each frame,
+    in refine mode also the mesh overlaid on the input image."""
+    rendered_images = render_meshes(renderer, np.stack([frame[2] for frame in frames], axis=0), faces, R, T, 'n')
+    for (idx, input_img, _), rendered_image in zip(frames, rendered_images):
+        if input_img.shape[0] < input_img.shape[1]:
+            rendered_image = rendered_image[abs(input_img.shape[0]-input_img.shape[1])//2:(input_img.shape[0]+input_img.shape[1])//2,...] 
+        else:
+            rendered_image = rendered_image[:,abs(input_img.shape[0]-input_img.shape[1])//2:(input_img.shape[0]+input_img.shape[1])//2]   
+        valid_mask = (rendered_image[:,:,-1] > 0)[:, :, np.newaxis]
+
+        if mode == 'mask':
+            cv2.imwrite(os.path.join(f'{out_dir}/init_mask', '%04d.png' % idx), valid_mask*255)
+        elif mode == 'refine':
+            output_img = (rendered_image[:,:,:-1] * valid_mask + input_img * (1 - valid_mask)).astype(np.uint8)
+            cv2.imwrite(os.path.join(f'{out_dir}/init_refined_smpl', '%04d.png' % idx), output_img)
+            cv2.imwrite(os.path.join(f'{out_dir}/init_refined_mask', '%04d.png' % idx), valid_mask*255)
 
 def main(args):
-    device = torch.device("cuda:0")
+    device = torch.device(args.device)
     seq = args.seq
     gender = args.gender
     DIR = './raw_data'
@@ -50,7 +167,7 @@ def main(args):
     else:
         print('Please specify the source of the dataset (custom, neuman, deepcap). We will continue to update the sources in the future.')
         raise NotImplementedError
-    renderer = Renderer(img_size = [input_img.shape[0], input_img.shape[1]], cam_intrinsic=cam_intrinsics)
+    renderer = Renderer(img_size = [input_img.shape[0], input_img.shape[1]], cam_intrinsic=cam_intrinsics, device=device)
 
     if args.mode == 'mask':
         if not os.path.exists(f'{DIR}/{seq}/init_mask'):
@@ -71,7 +188,7 @@ def main(args):
                                 center=torch.tensor(cam_intrinsics[0:2, 2]).unsqueeze(0)).to(device)
         mean_shape = []
         smpl2op_mapping = torch.tensor(smpl_to_pose(model_type='smpl', use_hands=False, use_face=False,
-                                            use_face_contour=False, openpose_format='coco25'), dtype=torch.long).cuda()
+                                            use_face_contour=False, openpose_format='coco25'), dtype=torch.long).to(device)
     elif args.mode == 'final':
         refined_smpl_dir = f'{DIR}/{seq}/init_refined_smpl_files'
         refined_smpl_mask_dir = f'{DIR}/{seq}/init_refined_mask'
@@ -101,39 +218,29 @@ def main(args):
         output_pose = []
         output_P = {}
 
-    last_j3d = None
-    actor_id = 0
     cam_extrinsics = np.eye(4)
     R = torch.tensor(cam_extrinsics[:3,:3])[None].float()
     T = torch.tensor(cam_extrinsics[:3, 3])[None].float() 
+    romp_frames = load_romp_frames(romp_file_paths[:len(img_paths)], cam_intrinsics)
+    render_queue = []
+    refined_smpl = None
+    if args.mode == 'refine' and args.refine_window > 0:
+        romp_frames = list(romp_frames)
+        refined_smpl = refine_smpl_batched(smpl_model, romp_frames, openpose_paths, cam_intrinsics, smpl2op_mapping,
+                                           args.refine_window, opt_num_iters, device)
+        romp_frames = iter(romp_frames)
     for idx, img_path in enumerate(tqdm(img_paths)):
         input_img = cv2.imread(img_path)
         if args.mode == 'mask' or args.mode == 'refine':
-            seq_file = np.load(romp_file_paths[idx], allow_pickle=True)['results'][()]
-            
-            # tracking in case of two persons or wrong ROMP detection
-            if len(seq_file['smpl_thetas']) >= 2:
-                dist = []
-                if idx == 0:
-                    last_j3d = seq_file['joints'][actor_id]
-                for i in range(len(seq_file['smpl_thetas'])):
-                    dist.append(np.linalg.norm(seq_file['joints'][i].mean(0) - last_j3d.mean(0, keepdims=True)))
-                actor_id = np.argmin(dist)
-            smpl_verts = seq_file['verts'][actor_id]
-            pj2d_org = seq_file['pj2d_org'][actor_id]
-            joints3d = seq_file['joints'][actor_id]
-            last_j3d = joints3d.copy()
-            tra_pred = estimate_translation_cv2(joints3d, pj2d_org, proj_mat=cam_intrinsics)
-            
-            smpl_verts += tra_pred
+            smpl_verts, smpl_shape, smpl_pose, tra_pred = next(romp_frames)
 
-            if args.mode == 'refine':
+            if refined_smpl is not None:
+                smpl_verts = refined_smpl['verts'][idx]
+            elif args.mode == 'refine':
                 openpose = np.load(openpose_paths[idx])
                 openpose_j2d = torch.tensor(openpose[:, :2][None], dtype=torch.float32, requires_grad=False, device=device)
                 openpose_conf = torch.tensor(openpose[:, -1][None], dtype=torch.float32, requires_grad=False, device=device)
 
-                smpl_shape = seq_file['smpl_betas'][actor_id][:10]
-                smpl_pose = seq_file['smpl_thetas'][actor_id]
                 smpl_trans = tra_pred
 
                 opt_betas = torch.tensor(smpl_shape[None], dtype=torch.float32, requires_grad=True, device=device)
@@ -175,28 +282,24 @@ def main(args):
                         l_str += ', %s: %0.4f' % (k, weight_dict[k](loss[k], it).mean().item())
                         loop.set_description(l_str)
 
-            smpl_mesh = trimesh.Trimesh(smpl_verts, smpl_model.faces, process=False)
-            R = torch.tensor(cam_extrinsics[:3,:3])[None].float()
-            T = torch.tensor(cam_extrinsics[:3, 3])[None].float() 
-            rendered_image = render_trimesh(renderer, smpl_mesh, R, T, 'n')
-            if input_img.shape[0] < input_img.shape[1]:
-                rendered_image = rendered_image[abs(input_img.shape[0]-input_img.shape[1])//2:(input_img.shape[0]+input_img.shape[1])//2,...] 
-            else:
-                rendered_image = rendered_image[:,abs(input_img.shape[0]-input_img.shape[1])//2:(input_img.shape[0]+input_img.shape[1])//2]   
-            valid_mask = (rendered_image[:,:,-1] > 0)[:, :, np.newaxis]
-            
-            if args.mode == 'mask':
-                cv2.imwrite(os.path.join(f'{DIR}/{seq}/init_mask', '%04d.png' % idx), valid_mask*255)
-            elif args.mode == 'refine':
-                output_img = (rendered_image[:,:,:-1] * valid_mask + input_img * (1 - valid_mask)).astype(np.uint8)
-                cv2.imwrite(os.path.join(f'{DIR}/{seq}/init_refined_smpl', '%04d.png' % idx), output_img)
-                cv2.imwrite(os.path.join(f'{DIR}/{seq}/init_refined_mask', '%04d.png' % idx), valid_mask*255)
-                last_pose.pop(0)
-                last_pose.append(opt_pose.detach().clone())
+            # the meshes are rendered render_batch frames at a time
+            render_queue.append((idx, input_img, smpl_verts))
+            if len(render_queue) == args.render_batch or idx == len(img_paths) - 1:
+                write_rendered_frames(renderer, render_queue, smpl_model.faces, R, T, f'{DIR}/{seq}', args.mode)
+                render_queue = []
+
+            if args.mode == 'refine':
                 smpl_dict = {}
-                smpl_dict['pose'] = opt_pose.data.squeeze().cpu().numpy()
-                smpl_dict['trans'] = opt_trans.data.squeeze().cpu().numpy()
-                smpl_dict['shape'] = opt_betas.data.squeeze().cpu().numpy()
+                if refined_smpl is not None:
+                    smpl_dict['pose'] = refined_smpl['pose'][idx]
+                    smpl_dict['trans'] = refined_smpl['trans'][idx]
+                    smpl_dict['shape'] = refined_smpl['shape'][idx]
+                else:
+                    last_pose.pop(0)
+                    last_pose.append(opt_pose.detach().clone())
+                    smpl_dict['pose'] = opt_pose.data.squeeze().cpu().numpy()
+                    smpl_dict['trans'] = opt_trans.data.squeeze().cpu().numpy()
+                    smpl_dict['shape'] = opt_betas.data.squeeze().cpu().numpy()
 
                 mean_shape.append(smpl_dict['shape'])
                 pkl.dump(smpl_dict, open(os.path.join(f'{DIR}/{seq}/init_refined_smpl_files', '%04d.pkl' % idx), 'wb'))
@@ -261,5 +364,11 @@ if __name__ == '__main__':
     parser.add_argument('--mode', type=str, help="mask mode or refine mode: mask or refine or final")
     # scale factor for the input image
     parser.add_argument('--scale_factor', type=int, default=2, help="scale factor for the input image")
+    # batched refinement
+    parser.add_argument('--refine_window', type=int, default=0, help="refine mode: number of frames refined jointly, 0 refines frame by frame")
+    # device of the SMPL fitting
+    parser.add_argument('--device', type=str, default='cuda:0', help="device of the SMPL fitting and rendering: cuda:0 or cpu")
+    # batched mask rendering
+    parser.add_argument('--render_batch', type=int, default=1, help="mask or refine mode: number of frames rendered in one rasterization call, the shader memory grows linearly with it")
     args = parser.parse_args()
     main(args)
\ No newline at end of file
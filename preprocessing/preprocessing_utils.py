@@ -140,15 +140,27 @@ def smpl_to_pose(model_type='smplx', use_hands=True, use_face=True,
 
 def render_trimesh(renderer,mesh,R,T, mode='np'):
     
-    verts = torch.tensor(mesh.vertices).cuda().float()[None]
-    faces = torch.tensor(mesh.faces).cuda()[None]
-    colors = torch.tensor(mesh.visual.vertex_colors).float().cuda()[None,...,:3]/255
+    verts = torch.tensor(mesh.vertices).to(renderer.device).float()[None]
+    faces = torch.tensor(mesh.faces).to(renderer.device)[None]
+    colors = torch.tensor(mesh.visual.vertex_colors).float().to(renderer.device)[None,...,:3]/255
     renderer.set_camera(R,T)
     image = renderer.render_mesh_recon(verts, faces, colors=colors, mode=mode)[0]
     image = (255*image).data.cpu().numpy().astype(np.uint8)
     
     return image
 
+def render_meshes(renderer, verts, faces, R, T, mode='np'):
+    """Render the meshes of vertices verts [N, V, 3] sharing the faces [F, 3] in one rasterization call.
+    Returns the images [N, H, W, 4] as uint8 numpy arrays, like render_trimesh."""
+    verts = torch.as_tensor(verts, dtype=torch.float32).to(renderer.device)
+    faces = torch.as_tensor(np.asarray(faces, dtype=np.int64)).to(renderer.device)
+    faces = faces[None].expand(verts.shape[0], -1, -1)
+    renderer.set_camera(R,T)
+    images = renderer.render_mesh_recon(verts, faces, mode=mode)
+    images = (255*images).data.cpu().numpy().astype(np.uint8)
+
+    return images
+
 def estimate_translation_cv2(joints_3d, joints_2d, focal_length=600, img_size=np.array([512.,512.]), proj_mat=None, cam_dist=None):
     if proj_mat is None:
         camK = np.eye(3)
@@ -297,12 +309,13 @@ class PerspectiveCamera(nn.Module):
     
 class Renderer():
     
-    def __init__(self, principal_point=None, img_size=None, cam_intrinsic = None):
+    def __init__(self, principal_point=None, img_size=None, cam_intrinsic = None, device='cuda:0'):
     
         super().__init__()
 
-        self.device = torch.device("cuda:0")
-        torch.cuda.set_device(self.device)
+        self.device = torch.device(device)
+        if self.device.type == 'cuda':
+            torch.cuda.set_device(self.device)
         self.cam_intrinsic = cam_intrinsic
         self.image_size = img_size
         self.render_img_size = np.max(img_size)
@@ -312,9 +325,9 @@ class Renderer():
 
         self.cam_R = torch.from_numpy(np.array([[-1., 0., 0.],
                                                 [0., -1., 0.],
-                                                [0., 0., 1.]])).cuda().float().unsqueeze(0)
+                                                [0., 0., 1.]])).to(self.device).float().unsqueeze(0)
 
-        self.cam_T = torch.zeros((1,3)).cuda().float()
+        self.cam_T = torch.zeros((1,3)).to(self.device).float()
 
         half_max_length = max(self.cam_intrinsic[0:2,2])
         self.focal_length = torch.tensor([(self.cam_intrinsic[0,0]/half_max_length).astype(np.float32), \
@@ -332,15 +345,15 @@ class Renderer():
         self.renderer = MeshRenderer(rasterizer=self.rasterizer, shader=self.shader)
     
     def set_camera(self, R, T):
-        self.cam_R = R
-        self.cam_T = T
-        self.cam_R[:, :2, :] *= -1.0
-        self.cam_T[:, :2] *= -1.0
-        self.cam_R = torch.transpose(self.cam_R,1,2)
-        self.cameras = SfMPerspectiveCameras(focal_length=self.focal_length, principal_point=self.principal_point, R=self.cam_R, T=self.cam_T, device=self.device)
-        self.rasterizer = MeshRasterizer(cameras=self.cameras, raster_settings=self.raster_settings)
-        self.shader = SoftPhongShader(device=self.device, cameras=self.cameras, lights=self.lights)
-        self.renderer = MeshRenderer(rasterizer=self.rasterizer, shader=self.shader)
+        # the rasterizer and the shader share self.cameras, so updating its extrinsics is enough
+        cam_R = R.to(device=self.device, dtype=torch.float32, copy=True)
+        cam_T = T.to(device=self.device, dtype=torch.float32, copy=True)
+        cam_R[:, :2, :] *= -1.0
+        cam_T[:, :2] *= -1.0
+        self.cam_R = torch.transpose(cam_R,1,2)
+        self.cam_T = cam_T
+        self.cameras.R = self.cam_R
+        self.cameras.T = self.cam_T
 
     def render_mesh_recon(self, verts, faces, R=None, T=None, colors=None, mode='npat'):
         '''
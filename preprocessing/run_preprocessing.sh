@@ -17,7 +17,7 @@ python run_openpose.py --openpose_dir {PATH_TO_OPENPOSE} --seq $seq
 
 # offline refine poses
 echo "Refining poses offline"
-python preprocessing.py --source $source --seq $seq --gender $gender --mode refine
+python preprocessing.py --source $source --seq $seq --gender $gender --mode refine --refine_window 100
 
 # scale images and center the human in 3D space
 echo "Scaling images and centering human in 3D space"
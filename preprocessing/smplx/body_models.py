@@ -30,7 +30,7 @@ from .lbs import (
 
 from .vertex_ids import vertex_ids as VERTEX_IDS
 from .utils import (
-    Struct, to_np, to_tensor, Tensor, Array,
+    Struct, to_np, to_tensor, Tensor, Array, load_model_data,
     SMPLOutput,
     SMPLHOutput,
     SMPLXOutput,
@@ -126,12 +126,12 @@ class SMPL(nn.Module):
                 smpl_path = os.path.join(model_path, model_fn)
             else:
                 smpl_path = model_path
-            assert osp.exists(smpl_path), 'Path {} does not exist!'.format(
+            # the npz converted from the pkl is enough
+            assert osp.exists(smpl_path) or osp.exists(
+                osp.splitext(smpl_path)[0] + '.npz'), 'Path {} does not exist!'.format(
                 smpl_path)
 
-            with open(smpl_path, 'rb') as smpl_file:
-                data_struct = Struct(**pickle.load(smpl_file,
-                                                   encoding='latin1'))
+            data_struct = load_model_data(smpl_path)
 
         super(SMPL, self).__init__()
         self.batch_size = batch_size
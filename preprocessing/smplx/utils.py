@@ -14,8 +14,12 @@
 #
 # Contact: ps-license@tuebingen.mpg.de
 
-from typing import NewType, Union, Optional
+from typing import NewType, Union, Optional, Dict
 from dataclasses import dataclass, asdict, fields
+import os
+import os.path as osp
+import pickle
+import tempfile
 import numpy as np
 import torch
 
@@ -111,6 +115,67 @@ class Struct(object):
             setattr(self, key, val)
 
 
+# model data of each model file, shared by all models of the process
+MODEL_DATA_CACHE = {}
+
+
+def convert_model_data(
+    pkl_path: str, npz_path: Optional[str] = None
+) -> Dict[str, Array]:
+    ''' Loads the pickled model, which needs chumpy, as plain numpy arrays and
+        writes them to npz_path if given. Entries that are not arrays are
+        dropped. '''
+    with open(pkl_path, 'rb') as pkl_file:
+        model_data = pickle.load(pkl_file, encoding='latin1')
+    arrays = {}
+    for key, val in model_data.items():
+        if 'scipy.sparse' in str(type(val)):
+            val = val.todense()
+        val = np.asarray(val)
+        if val.dtype != object:
+            arrays[key] = val
+    if npz_path is not None:
+        tmp_path = None
+        try:
+            # written to a unique file next to the model and renamed, so readers never see a
+            # partial file and concurrent conversions do not write to the same file
+            fd, tmp_path = tempfile.mkstemp(dir=osp.dirname(osp.abspath(npz_path)), suffix='.npz.tmp')
+            with os.fdopen(fd, 'wb') as npz_file:
+                np.savez(npz_file, **arrays)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, npz_path)
+        except OSError:
+            if tmp_path is not None and osp.exists(tmp_path):
+                os.remove(tmp_path)
+    return arrays
+
+
+def load_model_data(model_path: str) -> Struct:
+    ''' Loads the model file as a Struct of read-only numpy arrays
+
+        A pickled model is converted once to an npz next to it, which is
+        loaded instead from then on, and the arrays are cached for the
+        process, so constructing a model again does not touch the disk.
+    '''
+    model_path = osp.abspath(model_path)
+    if model_path in MODEL_DATA_CACHE:
+        return MODEL_DATA_CACHE[model_path]
+
+    npz_path = osp.splitext(model_path)[0] + '.npz'
+    if osp.exists(npz_path) and (not osp.exists(model_path)
+                                 or osp.getmtime(npz_path) >= osp.getmtime(model_path)):
+        with np.load(npz_path) as npz_file:
+            arrays = {key: npz_file[key] for key in npz_file.files}
+    else:
+        arrays = convert_model_data(model_path, npz_path)
+    for val in arrays.values():
+        val.flags.writeable = False
+
+    data_struct = Struct(**arrays)
+    MODEL_DATA_CACHE[model_path] = data_struct
+    return data_struct
+
+
 def to_np(array, dtype=np.float32):
     if 'scipy.sparse' in str(type(array)):
         array = array.todense()